@@ -18,6 +18,7 @@ class TransformerSpec:
     override_weights_strip_prefix: Optional[str] = None
     load_weights: bool = True
     kwargs: Dict[str, Any] = field(default_factory=dict)
+    quantize: Optional[str] = None
 
     def __hash__(self):
         return hash((
@@ -26,10 +27,41 @@ class TransformerSpec:
             self.override_weights_file,
             self.override_weights_strip_prefix,
             self.load_weights,
-            det_hash(self.kwargs)
+            det_hash(self.kwargs),
+            self.quantize
         ))
 
 
+QUANTIZATION_MODES = {"int8-dynamic"}
+
+
+def _conv1d_to_linear(module: torch.nn.Module) -> None:
+    """Replaces the `Conv1D` layers of GPT-2 style models, which are linear layers with transposed weights."""
+    from transformers.pytorch_utils import Conv1D
+
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            linear = torch.nn.Linear(child.weight.shape[0], child.nf, dtype=child.weight.dtype)
+            linear.weight.data = child.weight.data.t().contiguous()
+            linear.bias.data = child.bias.data
+            setattr(module, name, linear)
+        else:
+            _conv1d_to_linear(child)
+
+
+def quantize_model(model: torch.nn.Module, quantize: str) -> torch.nn.Module:
+    """
+    Quantizes a model for CPU inference. `"int8-dynamic"` applies PyTorch dynamic quantization to the
+    linear layers, which stores their weights in int8 and quantizes the activations on the fly.
+    """
+    if quantize not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization {quantize}, expected one of {sorted(QUANTIZATION_MODES)}")
+    if any(parameter.device.type != "cpu" for parameter in model.parameters()):
+        raise ValueError(f"Quantization {quantize} only runs on the CPU")
+    _conv1d_to_linear(model)
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
 _model_cache: Dict[TransformerSpec, transformers.PreTrainedModel] = {}
 
 
@@ -43,6 +75,7 @@ def get(
     override_weights_file: Optional[str] = None,
     override_weights_strip_prefix: Optional[str] = None,
     load_weights: bool = True,
+    quantize: Optional[str] = None,
     **kwargs,
 ) -> T:
     """
@@ -68,15 +101,22 @@ def get(
         If set to `False`, no weights will be loaded. This is helpful when you only
         want to initialize the architecture, like when you've already fine-tuned a model
         and are going to load the weights from a state dict elsewhere.
+    quantize : `str`, optional (default = `None`)
+        If set to `"int8-dynamic"`, the model is quantized for CPU inference after it is loaded,
+        see :func:`quantize_model`. Quantized models always load on the CPU.
     """
     global _model_cache
+    if quantize is not None and kwargs.get("device_map") is not None:
+        logger.warning(f"Loading the model on the CPU for quantization {quantize}, ignoring device_map")
+        kwargs = {key: value for key, value in kwargs.items() if key != "device_map"}
     spec = TransformerSpec(
         cls,
         model_name,
         override_weights_file,
         override_weights_strip_prefix,
         load_weights,
-        kwargs
+        kwargs,
+        quantize
     )
     transformer = _model_cache.get(spec, None)
     if transformer is None:
@@ -129,6 +169,8 @@ def get(
                 **kwargs,
             )
 
+        if quantize is not None:
+            transformer = quantize_model(transformer.eval(), quantize)
         _model_cache[spec] = transformer
     if make_copy:
         import copy
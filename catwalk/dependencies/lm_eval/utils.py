@@ -5,6 +5,7 @@ import collections
 import functools
 import inspect
 import sys
+import numpy as np
 import pytest
 from typing import List
 
@@ -71,6 +72,23 @@ def general_detokenize(string):
     return string
 
 
+def rolling_token_window_ends(num_tokens, max_seq_len, context_len):
+    """
+    Vectorized layout of the windows of get_rolling_token_windows: the end of every window in the token
+    list, and how many tokens it predicts. Both are numpy arrays with one entry per window.
+    """
+    assert 1 <= context_len <= max_seq_len
+    if num_tokens == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    # +1 offset, going from input->preds
+    pred_len = max_seq_len - context_len + 1
+    # Special handling for first window: predict all tokens
+    first_seq_len = min(max_seq_len, num_tokens)
+    num_more_windows = -(-(num_tokens - first_seq_len) // pred_len)
+    window_ends = np.minimum(first_seq_len + pred_len * np.arange(num_more_windows + 1, dtype=np.int64), num_tokens)
+    return window_ends, np.diff(window_ends, prepend=0)
+
+
 def get_rolling_token_windows(token_list, prefix_token, max_seq_len, context_len):
     """
     - context_len allows for a rolling window context, allowing each prediction window to potentially
@@ -89,27 +107,15 @@ def get_rolling_token_windows(token_list, prefix_token, max_seq_len, context_len
             (input_tokens, pred_tokens)
         Note: Score only the last len(pred_tokens) logits of the LM
     """
-    assert 1 <= context_len <= max_seq_len
-    if not token_list:
-        return
-    # +1 offset, going from input->preds
-    pred_len = max_seq_len - context_len + 1
-    predicted = 0
-
-    # Special handling for first window: predict all tokens
-    first_seq_len = min(max_seq_len, len(token_list))
-    yield ([prefix_token] + token_list[: first_seq_len - 1], token_list[:first_seq_len])
-    predicted += first_seq_len
-
-    while predicted < len(token_list):
-        window_pred_len = min(len(token_list) - predicted, pred_len)
-        window_end = predicted + window_pred_len
-
-        yield (
-            token_list[window_end - max_seq_len - 1 : window_end - 1],
-            token_list[window_end - window_pred_len : window_end],
-        )
-        predicted += window_pred_len
+    window_ends, window_pred_lens = rolling_token_window_ends(len(token_list), max_seq_len, context_len)
+    for i, (window_end, window_pred_len) in enumerate(zip(window_ends.tolist(), window_pred_lens.tolist())):
+        if i == 0:
+            yield ([prefix_token] + token_list[: window_end - 1], token_list[:window_end])
+        else:
+            yield (
+                token_list[window_end - max_seq_len - 1 : window_end - 1],
+                token_list[window_end - window_pred_len : window_end],
+            )
 
 
 def make_disjoint_window(pair):
@@ -0,0 +1,125 @@
+import argparse
+import json
+import logging
+import os
+from typing import Any, Dict, List
+
+from tango.common.logging import initialize_logging
+
+from catwalk.models import MODELS
+from catwalk.run_lm_eval import instance_prediction, load_task, log_metrics, register_model, write_outputs
+from catwalk.steps_simple import CalculateMetricsStep
+
+# Merges the full outputs of the shards of a sharded run_lm_eval run (--num_shards and --shard_index) into the
+# output of an unsharded run, recomputing the metrics of every task from the merged predictions. The raw
+# predictions are read from the file each shard writes next to its full output (out.predictions.shard-2-of-8.jsonl
+# next to out.shard-2-of-8.jsonl), for example:
+#
+#   python -m catwalk.merge_lm_eval --full_output_file out.jsonl --metrics_file metrics.json out.shard-*.jsonl
+
+_parser = argparse.ArgumentParser()
+_parser.add_argument('files', type=str, nargs="+", help="Full output files of all the shards")
+_parser.add_argument('--full_output_file', type=str, default=None, help="Filename for merged verbose output")
+_parser.add_argument('--metrics_file', type=str, default=None, help="Filename for merged metrics output")
+
+logger = logging.getLogger()
+
+
+def merge_task_outputs(shard_outputs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Merges the outputs of one task from every shard, in any order, into the output of an unsharded run."""
+    task_name = shard_outputs[0]["task"]
+    num_shards = shard_outputs[0]["shard"]["num_shards"]
+    by_index = {}
+    for output in shard_outputs:
+        shard = output["shard"]
+        if shard["num_shards"] != num_shards:
+            raise ValueError(f"Outputs of task {task_name} come from runs with different --num_shards")
+        if shard["shard_index"] in by_index:
+            raise ValueError(f"Shard {shard['shard_index']} of task {task_name} appears more than once")
+        by_index[shard["shard_index"]] = output
+    missing = sorted(set(range(num_shards)) - set(by_index))
+    if missing:
+        raise ValueError(f"Missing shards {missing} of task {task_name}")
+    shards = [by_index[shard_index] for shard_index in range(num_shards)]
+
+    # shard i has the instances i, i + num_shards, i + 2 * num_shards, ... of the task
+    num_instances = sum(len(shard["per_instance"]) for shard in shards)
+    for shard_index, shard in enumerate(shards):
+        if len(shard["per_instance"]) != len(range(shard_index, num_instances, num_shards)):
+            raise ValueError(f"Shard {shard_index} of task {task_name} has the wrong number of instances")
+    per_instance = [
+        shards[index % num_shards]["per_instance"][index // num_shards] for index in range(num_instances)]
+    raw_predictions = [
+        shards[index % num_shards]["shard"]["raw_predictions"][index // num_shards] for index in range(num_instances)]
+
+    first = shards[0]
+    register_model(first["model"])
+    task = dict(first["shard"]["task_spec"])
+    load_task(task)
+    metrics, predictions_updated = CalculateMetricsStep().run(
+        model=MODELS[first["model"]],
+        task=task['task_obj'],
+        predictions=raw_predictions)
+    for res1, pred in zip(per_instance, predictions_updated):
+        res1["prediction"], _ = instance_prediction(pred)
+
+    output = {key: value for key, value in first.items() if key not in ("shard", "per_instance")}
+    output["task_options"] = {
+        key: value for key, value in first["task_options"].items() if key not in ("num_shards", "shard_index")}
+    output["metrics"] = metrics
+    output["num_instances"] = num_instances
+    output["processing_time_seconds"] = sum(shard["processing_time_seconds"] for shard in shards)
+    if "performance" in first:
+        # the throughput of one job, and the peak memory of the largest one
+        output["performance"] = {key: max(shard["performance"][key] for shard in shards) for key in first["performance"]}
+        output["performance"]["instances_per_second"] = num_instances / max(output["processing_time_seconds"], 1e-9)
+    if "request_cache" in first:
+        output["request_cache"] = {key: sum(shard["request_cache"][key] for shard in shards)
+                                   for key in first["request_cache"]}
+    if "pooled" in first:
+        output["pooled"] = {key: sum(shard["pooled"][key] for shard in shards) for key in first["pooled"]}
+    if "prefix_cache" in first:
+        output["prefix_cache"] = {key: sum(shard["prefix_cache"][key] for shard in shards)
+                                  for key in first["prefix_cache"]}
+    output["per_instance"] = per_instance
+    return output
+
+
+def read_raw_predictions(file_name: str) -> Dict[str, List[Dict[str, Any]]]:
+    """Reads the raw predictions a shard wrote for each of its tasks."""
+    result = {}
+    with open(file_name, 'r') as file:
+        for line in file:
+            if line.strip():
+                d = json.loads(line)
+                result[d["task"]] = d["raw_predictions"]
+    return result
+
+
+def main(args: argparse.Namespace):
+    initialize_logging(log_level="INFO")
+    outputs_by_task: Dict[str, List[Dict[str, Any]]] = {}
+    for file_name in args.files:
+        with open(file_name, 'r') as file:
+            raw_predictions = None
+            for line in file:
+                if line.strip():
+                    output = json.loads(line)
+                    if "shard" not in output:
+                        raise ValueError(f"{file_name} is not the output of a sharded run")
+                    if raw_predictions is None:
+                        raw_predictions = read_raw_predictions(
+                            os.path.join(os.path.dirname(file_name), output["shard"]["raw_predictions_file"]))
+                    output["shard"]["raw_predictions"] = raw_predictions[output["task"]]
+                    outputs_by_task.setdefault(output["task"], []).append(output)
+
+    verbose_output = []
+    for task_name, shard_outputs in outputs_by_task.items():
+        logger.info(f"Merging {len(shard_outputs)} shards of task: {task_name}")
+        verbose_output.append(merge_task_outputs(shard_outputs))
+    write_outputs(verbose_output, args.full_output_file, args.metrics_file)
+    log_metrics(verbose_output)
+
+
+if __name__ == "__main__":
+    main(_parser.parse_args())
@@ -58,6 +58,12 @@ class Model(Registrable, DetHashWithVersion, ABC):
     VERSION = "002lst"
 
     def predict(self, task: Task, instances: Sequence[Dict[str, Any]], **kwargs) -> Iterator[Dict[str, Any]]:
+        """
+        Yields the prediction of every instance, in order. Models that take `num_shots` should also take
+        `instance_indices`, the index of every instance in the whole task, and seed the few-shot examples of an
+        instance with it when no `fewshot_seed` is given, so that a shard of the instances is predicted as it
+        would be in an unsharded run. See :attr:`supports_instance_indices`.
+        """
         raise NotImplementedError()
 
     def calculate_metrics(self, task: Task, predictions: Sequence[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
@@ -93,6 +99,10 @@ class Model(Registrable, DetHashWithVersion, ABC):
     def supports_fewshot(self) -> bool:
         return "num_shots" in inspect.signature(self.predict).parameters
 
+    @property
+    def supports_instance_indices(self) -> bool:
+        return "instance_indices" in inspect.signature(self.predict).parameters
+
     def trainable_copy(self, **kwargs) -> "TrainableModel":
         """Returns a trainable version of this model.
 
@@ -0,0 +1,175 @@
+import logging
+from dataclasses import dataclass
+from typing import List, Optional, Sequence
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Batch:
+    """A batch of requests, given as indices into the list of requests, and their (unpadded) lengths."""
+    indices: List[int]
+    lengths: List[int]
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    @property
+    def max_length(self) -> int:
+        return max(self.lengths)
+
+    @property
+    def num_tokens(self) -> int:
+        return sum(self.lengths)
+
+    @property
+    def num_padded_tokens(self) -> int:
+        return self.max_length * len(self.indices)
+
+    @property
+    def padding_efficiency(self) -> float:
+        """The fraction of the padded `[batch, seq]` tensor that holds real tokens."""
+        if self.num_padded_tokens == 0:
+            return 1.0
+        return self.num_tokens / self.num_padded_tokens
+
+
+def logits_bytes_per_token(model: torch.nn.Module) -> int:
+    """
+    Estimates how many bytes each position whose logits are computed costs in the logits tensor,
+    counting the logits themselves, in the dtype of the model, and the float32 log-softmax output.
+    """
+    vocab_size = model.config.vocab_size
+    dtype = getattr(model, "dtype", torch.float32)
+    return vocab_size * (torch.finfo(dtype).bits // 8 + 4)
+
+
+def make_batches(
+    lengths: Sequence[int],
+    *,
+    indices: Optional[Sequence[int]] = None,
+    batch_size: int = 32,
+    max_batch_tokens: Optional[int] = None,
+    max_batch_memory: Optional[int] = None,
+    bytes_per_token: int = 0,
+    logit_lengths: Optional[Sequence[int]] = None,
+) -> List[Batch]:
+    """
+    Sorts requests by length, longest first, and cuts them into batches.
+
+    Every batch has at most `batch_size` requests. With `max_batch_tokens` and/or `max_batch_memory`,
+    batches of long requests shrink further, so that they fit the budget. `max_batch_tokens` counts padded
+    tokens, i.e., the length of the longest request times the number of requests. `max_batch_memory` counts
+    the logits, of the `logit_lengths` positions of each request, or of every padded position without them.
+    A request that does not fit the budget on its own gets a batch to itself.
+
+    # Parameters
+
+    lengths : `Sequence[int]`
+        The length of each request, after any truncation.
+    indices : `Sequence[int]`, optional
+        The indices the batches refer to. Defaults to `range(len(lengths))`.
+    batch_size : `int`, optional (default = `32`)
+        The maximum number of requests per batch.
+    max_batch_tokens : `int`, optional
+        The maximum number of padded tokens in a batch.
+    max_batch_memory : `int`, optional
+        The maximum number of bytes a batch may need, estimated as the number of positions whose logits
+        are computed times `bytes_per_token`. See :func:`logits_bytes_per_token`.
+    bytes_per_token : `int`, optional (default = `0`)
+        The memory cost of the logits of one position, used with `max_batch_memory`.
+    logit_lengths : `Sequence[int]`, optional
+        The number of positions of each request whose logits are computed, such as its continuation
+        tokens. Defaults to every padded position.
+    """
+    if indices is None:
+        indices = range(len(lengths))
+    assert len(indices) == len(lengths)
+    assert logit_lengths is None or len(logit_lengths) == len(lengths)
+    memory_token_budget = None
+    if max_batch_memory and bytes_per_token > 0:
+        memory_token_budget = max(1, max_batch_memory // bytes_per_token)
+
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches: List[Batch] = []
+    current = Batch([], [])
+    current_logit_tokens = 0
+    for i in order:
+        length = lengths[i]
+        logit_length = length if logit_lengths is None else logit_lengths[i]
+        if len(current) > 0:
+            # Sorting means the first request in the batch is the longest one.
+            padded_size = max(current.lengths[0], length) * (len(current) + 1)
+            full = len(current) >= batch_size
+            if max_batch_tokens is not None:
+                full = full or padded_size > max_batch_tokens
+            if memory_token_budget is not None:
+                logit_tokens = padded_size if logit_lengths is None else current_logit_tokens + logit_length
+                full = full or logit_tokens > memory_token_budget
+            if full:
+                batches.append(current)
+                current = Batch([], [])
+                current_logit_tokens = 0
+        current.indices.append(indices[i])
+        current.lengths.append(length)
+        current_logit_tokens += logit_length
+    if len(current) > 0:
+        batches.append(current)
+
+    if batches and logger.isEnabledFor(logging.DEBUG):
+        for batch_number, batch in enumerate(batches):
+            logger.debug(
+                "Batch %d: %d requests, max length %d, padding efficiency %.1f%%",
+                batch_number, len(batch), batch.max_length, 100 * batch.padding_efficiency)
+    log_padding_efficiency(batches)
+    return batches
+
+
+def log_padding_efficiency(batches: Sequence[Batch]) -> None:
+    num_tokens = sum(batch.num_tokens for batch in batches)
+    num_padded_tokens = sum(batch.num_padded_tokens for batch in batches)
+    if num_padded_tokens == 0:
+        return
+    logger.info(
+        "Scheduled %d requests into %d batches, padding efficiency %.1f%% (%d of %d tokens)",
+        sum(len(batch) for batch in batches), len(batches),
+        100 * num_tokens / num_padded_tokens, num_tokens, num_padded_tokens)
+
+
+def make_packed_rows(
+    lengths: Sequence[int],
+    *,
+    indices: Optional[Sequence[int]] = None,
+    max_length: int,
+) -> List[Batch]:
+    """
+    Packs requests into rows of at most `max_length` tokens each, so that several short requests share one
+    row instead of being padded to the longest request in the batch. Uses best-fit decreasing: requests are
+    placed longest first into the row with the least space left that still fits them.
+
+    Each returned :class:`Batch` is one row, listing its requests in the order they appear in the row.
+    """
+    if indices is None:
+        indices = range(len(lengths))
+    assert len(indices) == len(lengths)
+    rows: List[Batch] = []
+    # rows_by_space[n] holds the rows that have exactly n tokens of space left
+    rows_by_space: List[List[int]] = [[] for _ in range(max_length + 1)]
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+        length = lengths[i]
+        assert length <= max_length, f"Request of length {length} does not fit into a row of {max_length}"
+        space = length
+        while space <= max_length and len(rows_by_space[space]) == 0:
+            space += 1
+        if space > max_length:
+            row_index = len(rows)
+            rows.append(Batch([], []))
+            space = max_length
+        else:
+            row_index = rows_by_space[space].pop()
+        rows[row_index].indices.append(indices[i])
+        rows[row_index].lengths.append(length)
+        rows_by_space[space - length].append(row_index)
+    return rows
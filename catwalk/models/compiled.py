@@ -0,0 +1,128 @@
+import logging
+import time
+import weakref
+from typing import Any, Dict, Optional, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# torch.compile keeps at most this many graphs for one function before it gives up and runs eagerly
+MAX_COMPILED_SHAPES = 8
+
+_compiled_modules: "weakref.WeakKeyDictionary[torch.nn.Module, Dict[Tuple[int, int], BucketedCompiledModule]]" = \
+    weakref.WeakKeyDictionary()
+
+
+def bucket_shape(batch_size: int, length: int, bucket_size: int, max_length: int) -> Optional[Tuple[int, int]]:
+    """
+    Rounds a `[batch, seq]` shape up to its bucket: the batch size to a power of two, and the length to a
+    multiple of `bucket_size`, but to no more than `max_length`. Lengths beyond `max_length` have no bucket.
+    """
+    if length > max_length:
+        return None
+    bucket_length = -(-length // bucket_size) * bucket_size
+    return 1 << (batch_size - 1).bit_length(), min(bucket_length, max_length)
+
+
+class BucketedCompiledModule:
+    """
+    Runs a causal module, such as the body of a decoder-only model, through `torch.compile` at a small set of
+    fixed shapes. The inputs of every call are padded with zeros, on the right and at the bottom, up to the
+    bucket of their shape (see :func:`bucket_shape`), and the outputs are cut back to the shape of the inputs.
+    That way length-sorted batches, which all have different shapes, share a handful of graphs. A graph is
+    compiled the first time its bucket is used. Calls without a bucket, and once there are `max_shapes` graphs,
+    calls of any other bucket, run eagerly.
+
+    Padding on the right is only correct for causal models, whose real positions never attend to later ones.
+    """
+
+    def __init__(
+        self,
+        module: torch.nn.Module,
+        *,
+        bucket_size: int = 64,
+        max_length: int,
+        max_shapes: int = MAX_COMPILED_SHAPES
+    ):
+        if bucket_size < 1:
+            raise ValueError(f"compile_bucket_size must be at least 1, got {bucket_size}")
+        self.module = module
+        self.bucket_size = bucket_size
+        self.max_length = max_length
+        self.max_shapes = max_shapes
+        self.compiled_module = torch.compile(module, dynamic=False)
+        # for every compiled shape, the seconds the first call took, and the calls, seconds and tokens after it
+        self.shape_stats: Dict[Tuple[int, int], Dict[str, float]] = {}
+        self.eager_stats = {"calls": 0, "seconds": 0.0, "tokens": 0}
+
+    def __call__(self, **inputs) -> Any:
+        batch_size, length = inputs["input_ids"].shape
+        shape = bucket_shape(batch_size, length, self.bucket_size, self.max_length)
+        if shape is None or (shape not in self.shape_stats and len(self.shape_stats) >= self.max_shapes):
+            start = time.perf_counter()
+            output = self.module(**inputs)
+            self.eager_stats["calls"] += 1
+            self.eager_stats["seconds"] += time.perf_counter() - start
+            self.eager_stats["tokens"] += batch_size * length
+            return output
+
+        padded_inputs = {}
+        for name, value in inputs.items():
+            if isinstance(value, torch.Tensor) and value.shape[:2] == (batch_size, length):
+                value = torch.nn.functional.pad(value, (0, shape[1] - length, 0, shape[0] - batch_size))
+                if name == "attention_mask":
+                    # the padding rows attend to their first position, so none of them is masked out entirely
+                    value[batch_size:, 0] = 1
+            padded_inputs[name] = value
+        start = time.perf_counter()
+        output = self.compiled_module(**padded_inputs, use_cache=False)
+        seconds = time.perf_counter() - start
+        if shape not in self.shape_stats:
+            self.shape_stats[shape] = {"compile_seconds": seconds, "calls": 0, "seconds": 0.0, "tokens": 0}
+            logger.info(
+                "Compiled shape %s in %.1fs, %d of %d shapes", list(shape), seconds, len(self.shape_stats),
+                self.max_shapes)
+        else:
+            self.shape_stats[shape]["calls"] += 1
+            self.shape_stats[shape]["seconds"] += seconds
+            self.shape_stats[shape]["tokens"] += batch_size * length
+
+        for name, value in list(output.items()):
+            if isinstance(value, torch.Tensor) and value.shape[:2] == shape:
+                output[name] = value[:batch_size, :length]
+        return output
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        The time spent compiling, and the throughput in (unpadded) tokens per second of the compiled shapes
+        after their first call, and of the calls that ran eagerly.
+        """
+        compiled_calls = sum(stats["calls"] for stats in self.shape_stats.values())
+        compiled_seconds = sum(stats["seconds"] for stats in self.shape_stats.values())
+        compiled_tokens = sum(stats["tokens"] for stats in self.shape_stats.values())
+        return {
+            "num_shapes": len(self.shape_stats),
+            "compile_seconds": sum(stats["compile_seconds"] for stats in self.shape_stats.values()),
+            "compiled_calls": compiled_calls,
+            "compiled_tokens_per_second": compiled_tokens / compiled_seconds if compiled_seconds > 0 else None,
+            "eager_calls": self.eager_stats["calls"],
+            "eager_tokens_per_second":
+                self.eager_stats["tokens"] / self.eager_stats["seconds"] if self.eager_stats["seconds"] > 0 else None,
+        }
+
+
+def compiled_base_model(model: torch.nn.Module, bucket_size: int, max_length: int) -> BucketedCompiledModule:
+    """
+    The :class:`BucketedCompiledModule` of the body of `model`, kept for as long as the model lives, so that its
+    graphs are compiled once and reused across calls.
+    """
+    max_positions = getattr(getattr(model, "config", None), "max_position_embeddings", None)
+    if max_positions is not None:
+        max_length = min(max_length, max_positions)
+    compiled_modules = _compiled_modules.setdefault(model, {})
+    key = (bucket_size, max_length)
+    if key not in compiled_modules:
+        compiled_modules[key] = BucketedCompiledModule(
+            model.base_model, bucket_size=bucket_size, max_length=max_length)
+    return compiled_modules[key]
@@ -0,0 +1,117 @@
+import logging
+import multiprocessing
+import os
+import queue as queue_module
+import traceback
+from typing import Any, Callable, List, Optional, Sequence
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def can_run_in_workers(model: Optional[torch.nn.Module] = None) -> bool:
+    """Workers are forked, so they need a platform that can fork, and a model that lives on the CPU."""
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return False
+    if model is not None and any(parameter.device.type != "cpu" for parameter in model.parameters()):
+        return False
+    return True
+
+
+def shard_by_length(lengths: Sequence[int], num_shards: int) -> List[List[int]]:
+    """
+    Splits the indices of `lengths` into `num_shards` shards with a similar number of requests and tokens,
+    by dealing them out longest first, in snake order. Every shard keeps its indices in ascending order.
+    """
+    shards: List[List[int]] = [[] for _ in range(num_shards)]
+    by_length = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    for position, index in enumerate(by_length):
+        lap, offset = divmod(position, num_shards)
+        shards[offset if lap % 2 == 0 else num_shards - 1 - offset].append(index)
+    return [sorted(shard) for shard in shards]
+
+
+def cpu_slices(num_workers: int) -> List[List[int]]:
+    """Splits the CPUs this process may run on into `num_workers` contiguous slices, sharing CPUs if too few."""
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+    if len(cpus) < num_workers:
+        return [[cpus[i % len(cpus)]] for i in range(num_workers)]
+    slice_size, remainder = divmod(len(cpus), num_workers)
+    slices = []
+    start = 0
+    for worker_index in range(num_workers):
+        end = start + slice_size + (1 if worker_index < remainder else 0)
+        slices.append(cpus[start:end])
+        start = end
+    return slices
+
+
+def _worker(queue, worker_index: int, run: Callable[[List[int]], Sequence[Any]], shard: List[int], cpus: List[int]):
+    try:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+        torch.set_num_threads(len(cpus))
+        queue.put((worker_index, list(run(shard)), None))
+    except BaseException:
+        queue.put((worker_index, None, traceback.format_exc()))
+
+
+def run_in_workers(
+    run: Callable[[List[int]], Sequence[Any]],
+    lengths: Sequence[int],
+    num_workers: int
+) -> List[Any]:
+    """
+    Runs `run` on shards of the request indices `range(len(lengths))` in `num_workers` forked processes, and
+    returns the results in the original order. Each worker gets its own slice of the CPUs, with as many
+    torch threads as CPUs in its slice. Forking shares the model weights with the workers, copy-on-write,
+    instead of loading one copy per worker.
+    """
+    num_workers = min(num_workers, len(lengths))
+    if num_workers <= 1:
+        return list(run(list(range(len(lengths)))))
+    shards = shard_by_length(lengths, num_workers)
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    processes = [
+        context.Process(target=_worker, args=(queue, worker_index, run, shard, cpus), daemon=True)
+        for worker_index, (shard, cpus) in enumerate(zip(shards, cpu_slices(num_workers)))
+    ]
+    logger.info("Running %d requests in %d worker processes", len(lengths), num_workers)
+    for process in processes:
+        process.start()
+    # read all results before joining, so no worker blocks on a full pipe
+    shard_results: List[Optional[List[Any]]] = [None] * num_workers
+    try:
+        num_received = 0
+        while num_received < num_workers:
+            try:
+                worker_index, worker_results, error = queue.get(timeout=5)
+            except queue_module.Empty:
+                # a worker that crashed outright never reports back
+                for worker_index, process in enumerate(processes):
+                    if shard_results[worker_index] is None and process.exitcode not in (None, 0):
+                        raise RuntimeError(f"Worker {worker_index} exited with code {process.exitcode}")
+                continue
+            if error is not None:
+                raise RuntimeError(f"Worker {worker_index} failed:\n{error}")
+            shard_results[worker_index] = worker_results
+            num_received += 1
+    except BaseException:
+        for process in processes:
+            process.terminate()
+        raise
+    finally:
+        for process in processes:
+            process.join()
+
+    results: List[Any] = [None] * len(lengths)
+    for shard, worker_results in zip(shards, shard_results):
+        assert worker_results is not None and len(worker_results) == len(shard)
+        for index, result in zip(shard, worker_results):
+            results[index] = result
+    return results
@@ -1,5 +1,7 @@
 import collections
-from typing import Sequence, Dict, Any, Iterator, Callable, Mapping, List, Tuple, Protocol
+import functools
+import logging
+from typing import Sequence, Dict, Any, Iterable, Iterator, Callable, Mapping, List, Tuple, Protocol, Optional
 
 import more_itertools
 import torch
@@ -14,8 +16,13 @@ from transformers import AutoModelForCausalLM, AutoTokenizer, GPT2Tokenizer, GPT
 from catwalk import cached_transformers
 from catwalk.task import Task, InstanceFormat
 from catwalk.model import Model
+from catwalk.models.batching import make_batches, logits_bytes_per_token
+from catwalk.models.generation import greedy_until
+from catwalk.models.streaming import InstanceRequests, request_progress, stream_predictions
 from catwalk.tasks.eleuther import EleutherTask
 
+logger = logging.getLogger(__name__)
+
 
 @Model.register("eai::gpt")
 class EAIGPT(Model):
@@ -36,9 +43,11 @@ class EAIGPT(Model):
         instances: Sequence[Dict[str, Any]],
         *,
         batch_size: int = 32,
-        max_instances_in_memory: int = 16 * 1024,
+        max_buffered_requests: int = 16 * 1024,
+        max_instances_in_memory: Optional[int] = None,
         max_gen_toks: int = 256,
         num_shots: int = 0,
+        instance_indices: Optional[Sequence[int]] = None,  # Not needed, the few-shot examples have a fixed seed
         **kwargs
     ) -> Iterator[Dict[str, Any]]:
         model = cached_transformers.get(
@@ -50,46 +59,34 @@ class EAIGPT(Model):
         ).eval()
         tokenizer = cached_transformers.get_tokenizer(AutoTokenizer, self.pretrained_model_name_or_path)
 
-        for instance_chunk in more_itertools.chunked(instances, max_instances_in_memory):
-            yield from self.predict_chunk(
-                task,
-                instance_chunk,
-                model,
-                tokenizer,
-                batch_size=batch_size,
-                max_gen_toks=max_gen_toks,
-                num_shots=num_shots,
-                **kwargs)
+        if max_instances_in_memory is not None:
+            logger.warning("max_instances_in_memory is deprecated and ignored, use max_buffered_requests instead")
+        yield from self.predict_chunk(
+            task,
+            instances,
+            model,
+            tokenizer,
+            batch_size=batch_size,
+            max_buffered_requests=max_buffered_requests,
+            max_gen_toks=max_gen_toks,
+            num_shots=num_shots,
+            num_instances=len(instances),
+            **kwargs)
 
     def predict_chunk(
         self,
         task: Task,
-        instances: Sequence[Dict[str, Any]],
+        instances: Iterable[Dict[str, Any]],
         model: GPT2LMHeadModel,
         tokenizer: GPT2Tokenizer,
         *,
         num_shots: int = 0,
+        max_buffered_requests: Optional[int] = None,
+        num_instances: Optional[int] = None,
         **kwargs
     ) -> Iterator[Dict[str, Any]]:
-        instance_index_to_request_indices: Mapping[int, Mapping[str, List[int]]] = \
-            collections.defaultdict(lambda: collections.defaultdict(list))
-        requests: Mapping[str, List[Request]] = collections.defaultdict(list)
-
-        # get all the requests
-        for instance_index, instance in enumerate(instances):
-            instance_requests = task.convert_instance(
-                instance,
-                InstanceFormat.ELEUTHER_REQUESTS,
-                num_fewshot=num_shots)
-            if not isinstance(instance_requests, (list, tuple)):
-                instance_requests = [instance_requests]
-            for instance_request in instance_requests:
-                request_type = instance_request.request_type
-                instance_index_to_request_indices[instance_index][request_type].append(len(requests[request_type]))
-                requests[request_type].append(instance_request)
+        assert isinstance(task, EleutherTask), "We can only calculate metrics for EleutherTasks."
 
-        # run the requests
-        results: Dict[str, Sequence] = {}
         class InferenceFunc(Protocol):
             def __call__(self, requests: Sequence[Request], model: GPT2LMHeadModel, tokenizer: GPT2Tokenizer, **kwargs) -> Sequence: ...
         request_type_to_fn: Mapping[str, InferenceFunc] = {
@@ -97,22 +94,37 @@ class EAIGPT(Model):
             "loglikelihood_rolling": self._run_loglikelihood_rolling,
             "greedy_until": self._run_greedy_until
         }
-        for request_type, requests_per_type in requests.items():
-            results[request_type] = request_type_to_fn[request_type](
-                requests_per_type,
-                model,
-                tokenizer,
-                **kwargs
-            )
-        assert isinstance(task, EleutherTask), "We can only calculate metrics for EleutherTasks."
-        for instance_index, instance in enumerate(instances):
-            doc = task.convert_instance(instance, InstanceFormat.ELEUTHER_DOC)
 
-            results_for_instance: List = []
-            for request_type, request_indices in instance_index_to_request_indices[instance_index].items():
-                results_for_instance.extend(results[request_type][i] for i in request_indices)
-
-            yield task.inner_task.process_results(doc, results_for_instance)
+        def instance_requests() -> Iterator[InstanceRequests]:
+            for instance in instances:
+                eleuther_requests = task.convert_instance(
+                    instance,
+                    InstanceFormat.ELEUTHER_REQUESTS,
+                    num_fewshot=num_shots)
+                if not isinstance(eleuther_requests, (list, tuple)):
+                    eleuther_requests = [eleuther_requests]
+                # the results of an instance are grouped by request type
+                requests_by_type: Mapping[str, List[Request]] = collections.defaultdict(list)
+                for eleuther_request in eleuther_requests:
+                    requests_by_type[eleuther_request.request_type].append(eleuther_request)
+                doc = task.convert_instance(instance, InstanceFormat.ELEUTHER_DOC)
+                yield InstanceRequests(
+                    [
+                        (request_type, r, sum(len(arg) for arg in r.args if isinstance(arg, str)))
+                        for request_type, requests in requests_by_type.items()
+                        for r in requests
+                    ],
+                    functools.partial(task.inner_task.process_results, doc))
+
+        yield from stream_predictions(
+            instance_requests(),
+            {
+                request_type: functools.partial(fn, model=model, tokenizer=tokenizer, **kwargs)
+                for request_type, fn in request_type_to_fn.items()
+            },
+            max_buffered_requests=max_buffered_requests,
+            round_multiple=kwargs.get("batch_size", 32),
+            num_instances=num_instances)
 
     def _run_loglikelihood(
         self,
@@ -120,6 +132,8 @@ class EAIGPT(Model):
         model: GPT2LMHeadModel,
         tokenizer: GPT2Tokenizer,
         batch_size: int = 32,
+        max_batch_tokens: Optional[int] = None,
+        max_batch_memory: Optional[int] = None,
         **kwargs
     ) -> Sequence:
         tokenized_contexts = tokenizer([r.args[0] for r in requests])
@@ -143,19 +157,24 @@ class EAIGPT(Model):
                 )
 
         # find out the order to process sequences in
-        lengths = torch.tensor([
-            len(cc_pair["input_ids"][0]) + len(cc_pair["input_ids"][1])
-            for cc_pair in cc_pairs
-        ], dtype=torch.int)
-        ordered_indices = torch.argsort(lengths, descending=True)
-        del lengths
+        # Use model_max_length+1 since the last token is not in the input
+        batches = make_batches(
+            [
+                min(len(cc_pair["input_ids"][0]) + len(cc_pair["input_ids"][1]), tokenizer.model_max_length + 1) - 1
+                for cc_pair in cc_pairs
+            ],
+            batch_size=batch_size,
+            max_batch_tokens=max_batch_tokens,
+            max_batch_memory=max_batch_memory,
+            bytes_per_token=logits_bytes_per_token(model))
 
         # actually do the processing
-        results = [None] * len(ordered_indices)
+        results: List[Any] = [None] * len(cc_pairs)
         with torch.inference_mode():
-            with Tqdm.tqdm(ordered_indices, desc="Running log-likelihood queries") as batches_of_indices_tqdm:
-                batches_of_indices = more_itertools.chunked(batches_of_indices_tqdm, batch_size)
-                for batch_of_indices in batches_of_indices:
+            with request_progress(total=len(cc_pairs), desc="Running log-likelihood queries") as requests_tqdm:
+                for batch in batches:
+                    requests_tqdm.update(len(batch))
+                    batch_of_indices = batch.indices
                     unpadded_batch = collections.defaultdict(list)
                     input_lengths = []
                     batch_contexts = []
@@ -231,45 +250,17 @@ class EAIGPT(Model):
             model_max_length = 2048
         model_max_length = kwargs.get("model_max_length", model_max_length)
 
-        results = []
-        for tokenized_context, untils in Tqdm.tqdm(
-            zip(tokenized_contexts, untils_per_instance),
-            desc="Running greedy_until queries",
-            total=len(tokenized_contexts),
-        ):
-            # there can be multiple stop phrases with multiple tokens
-            if isinstance(untils, str):
-                untils = [untils]
-            # if any of the stop phrases are single tokens we can use that for early termination
-            primary_until = None
-            for tokenized_until in tokenizer(untils)["input_ids"]:
-                if len(tokenized_until) == 1:
-                    primary_until = tokenized_until[0]
-
-            # truncate from left if no room for generation
-            context_tensor = torch.tensor(
-                [
-                    tokenized_context[max_gen_toks - model_max_length :]
-                ]
-            ).to(model.device)
-
-            full_text_tensor = model.generate(
-                context_tensor,
-                max_length=context_tensor.shape[1] + max_gen_toks,
-                eos_token_id=primary_until,
-                do_sample=False,
-                pad_token_id=primary_until, # temporary hack to suppress irrelevant warning until batch processing is added
-            )
-
-            continuation_tensor = full_text_tensor[0, context_tensor.shape[1] :]
-
-            continuation = tokenizer.decode(continuation_tensor.tolist())
-
-            # truncate by all the additional until phrases
-            for term in untils:
-                continuation = continuation.split(term)[0]
-
-            results.append(continuation)
+        # truncate from left if no room for generation
+        tokenized_contexts = [context[max_gen_toks - model_max_length:] for context in tokenized_contexts]
+        results = greedy_until(
+            model,
+            tokenizer,
+            tokenized_contexts,
+            untils_per_instance,
+            max_gen_toks=max_gen_toks,
+            batch_size=kwargs.get("batch_size", 32),
+            max_batch_tokens=kwargs.get("max_batch_tokens"))
+        results = [result["text"] for result in results]
         return results
 
     def calculate_metrics(self, task: Task, predictions: Sequence[Dict[str, Any]]) -> Dict[str, float]:
@@ -301,7 +292,8 @@ class EAIT5(Model):
         *,
         batch_size: int = 32,
         max_instances_in_memory: int = 16 * 1024,
-        num_shots: int = 0
+        num_shots: int = 0,
+        instance_indices: Optional[Sequence[int]] = None  # Not needed, the few-shot examples have a fixed seed
     ) -> Iterator[Dict[str, Any]]:
         device = resolve_device()
         model = cached_transformers.get(AutoModelForSeq2SeqLM, self.pretrained_model_name_or_path, False).eval().to(device)
@@ -0,0 +1,158 @@
+from typing import Any, Dict, List, Optional, Sequence, Set, Union
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+from catwalk.models.batching import make_batches
+from catwalk.models.streaming import request_progress
+
+
+class _StopOnUntils(StoppingCriteria):
+    """
+    Stops each row of a batched generation on its own, either when it produces one of its stop tokens, or
+    when its decoded continuation contains one of its stop strings. Records how many tokens every row
+    generated before it stopped.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        input_length: int,
+        stop_token_ids: Sequence[Set[int]],
+        untils: Sequence[Sequence[str]],
+    ):
+        self.tokenizer = tokenizer
+        self.input_length = input_length
+        self.stop_token_ids = stop_token_ids
+        self.untils = untils
+        self.num_generated: List[Optional[int]] = [None] * len(untils)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        num_generated = input_ids.shape[1] - self.input_length
+        for row, untils in enumerate(self.untils):
+            if self.num_generated[row] is not None:
+                continue
+            generated = input_ids[row, self.input_length:]
+            if int(generated[-1]) in self.stop_token_ids[row] or \
+                    _is_stopped(self.tokenizer.decode(generated.tolist()), untils):
+                self.num_generated[row] = num_generated
+        return torch.tensor([n is not None for n in self.num_generated], device=input_ids.device)
+
+
+def _is_stopped(text: str, untils: Sequence[str]) -> bool:
+    """
+    Whether `text` already contains a stop string, and cutting it at its stop strings cannot change any
+    more as generation goes on. Cutting can only still change if the text ends in the beginning of a stop
+    string that starts close enough to the first match to overlap it.
+    """
+    matches = [text.find(until) for until in untils if until in text]
+    if len(matches) == 0:
+        return False
+    horizon = min(matches) + max(len(until) for until in untils)
+    for until in untils:
+        for start in range(max(0, len(text) - len(until) + 1), min(len(text), horizon)):
+            if until.startswith(text[start:]):
+                return False
+    return True
+
+
+def greedy_until(
+    model,
+    tokenizer,
+    contexts: Sequence[List[int]],
+    untils: Sequence[Union[str, Sequence[str]]],
+    *,
+    max_gen_toks: int,
+    batch_size: int = 32,
+    max_batch_tokens: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Greedily generates a continuation for every context, in left-padded batches sorted by context length.
+
+    Each request stops as soon as it produces its single-token stop phrase (or, if it has none, the model's
+    end-of-sequence token), or as soon as its decoded continuation contains one of its stop phrases. The
+    batch runs until all of its rows have stopped or `max_gen_toks` tokens have been generated.
+
+    # Parameters
+
+    contexts : `Sequence[List[int]]`
+        The token ids of the contexts, already truncated to leave room for generation.
+    untils : `Sequence[Union[str, Sequence[str]]]`
+        The stop phrases for every context.
+    max_gen_toks : `int`
+        The maximum number of tokens to generate.
+    batch_size : `int`, optional (default = `32`)
+        The number of requests per batch when `max_batch_tokens` is not given.
+    max_batch_tokens : `int`, optional
+        The maximum number of tokens in a batch, counting the generated tokens.
+
+    Returns a dict per request with the generated `text` cut at the stop phrases, the `raw_text` as
+    generated, `num_input_tokens` and `num_generated_tokens`.
+    """
+    untils = [[u] if isinstance(u, str) else list(u) for u in untils]
+    default_stop_token_ids = getattr(getattr(model, "generation_config", None), "eos_token_id", None)
+    if default_stop_token_ids is None:
+        default_stop_token_ids = set()
+    elif isinstance(default_stop_token_ids, int):
+        default_stop_token_ids = {default_stop_token_ids}
+    else:
+        default_stop_token_ids = set(default_stop_token_ids)
+    stop_token_ids = []
+    for request_untils in untils:
+        # if any of the stop phrases are single tokens we can use that for early termination
+        primary_until = None
+        for tokenized_until in tokenizer(request_untils)["input_ids"]:
+            if len(tokenized_until) == 1:
+                primary_until = tokenized_until[0]
+        stop_token_ids.append(default_stop_token_ids if primary_until is None else {primary_until})
+    pad_token_id = tokenizer.pad_token_id
+    if pad_token_id is None:
+        pad_token_id = tokenizer.eos_token_id if tokenizer.eos_token_id is not None else 0
+
+    batches = make_batches(
+        [len(context) + max_gen_toks for context in contexts],
+        batch_size=batch_size,
+        max_batch_tokens=max_batch_tokens)
+    results: List[Optional[Dict[str, Any]]] = [None] * len(contexts)
+    with torch.inference_mode():
+        with request_progress(total=len(contexts), desc="Running greedy_until queries") as requests_tqdm:
+            for batch in batches:
+                input_length = max(len(contexts[i]) for i in batch.indices)
+                input_ids = torch.full((len(batch), input_length), pad_token_id, dtype=torch.long)
+                attention_mask = torch.zeros((len(batch), input_length), dtype=torch.long)
+                for row, i in enumerate(batch.indices):
+                    context = contexts[i]
+                    if len(context) > 0:
+                        input_ids[row, -len(context):] = torch.tensor(context, dtype=torch.long)
+                        attention_mask[row, -len(context):] = 1
+
+                stopping_criteria = _StopOnUntils(
+                    tokenizer,
+                    input_length,
+                    [stop_token_ids[i] for i in batch.indices],
+                    [untils[i] for i in batch.indices])
+                output = model.generate(
+                    input_ids.to(model.device),
+                    attention_mask=attention_mask.to(model.device),
+                    max_new_tokens=max_gen_toks,
+                    do_sample=False,
+                    eos_token_id=None,
+                    pad_token_id=pad_token_id,
+                    stopping_criteria=StoppingCriteriaList([stopping_criteria]),
+                )
+                for row, i in enumerate(batch.indices):
+                    num_generated = stopping_criteria.num_generated[row]
+                    if num_generated is None:
+                        num_generated = output.shape[1] - input_length
+                    continuation_tensor = output[row, input_length:input_length + num_generated]
+                    continuation = tokenizer.decode(continuation_tensor.tolist())
+                    raw_continuation = continuation
+                    # truncate by all the additional until phrases
+                    for term in untils[i]:
+                        continuation = continuation.split(term)[0]
+                    results[i] = {"text": continuation, "raw_text": raw_continuation,
+                                  "num_input_tokens": len(contexts[i]),
+                                  "num_generated_tokens": len(continuation_tensor)}
+                requests_tqdm.update(len(batch))
+    assert None not in results
+    return results
@@ -24,9 +24,19 @@ from catwalk.tasks.huggingface import HFQAInstance, HFMCInstance, HFClassificati
 class HFAutoModel(Model):
     VERSION = "005met"
 
-    def __init__(self, pretrained_model_name_or_path: str):
+    def __init__(self, pretrained_model_name_or_path: str, *, quantize: Optional[str] = None):
+        """
+        # Parameters
+
+        pretrained_model_name_or_path : `str`
+            The name of the transformer, for example `"roberta-large"`
+        quantize : `str`, optional (default = `None`)
+            Set to `"int8-dynamic"` to quantize the model for CPU inference, see
+            :func:`catwalk.cached_transformers.quantize_model`.
+        """
         self.pretrained_model_name_or_path = pretrained_model_name_or_path
-        
+        self.quantize = quantize
+
     def predict(  # type: ignore
         self,
         task: Task,
@@ -34,16 +44,17 @@ class HFAutoModel(Model):
         *,
         batch_size: int = 32
     ) -> Iterator[Dict[str, Any]]:
-        device = resolve_device()
+        # quantized models only run on the CPU
+        device = resolve_device() if self.quantize is None else torch.device("cpu")
 
         if task.has_instance_conversion(InstanceFormat.HF_MC):
             mc_instances = cast(Sequence[HFMCInstance], self._convert_instances(instances, InstanceFormat.HF_MC, task))
-            model = cached_transformers.get(AutoModelForMultipleChoice, self.pretrained_model_name_or_path, False).to(device)
+            model = cached_transformers.get(AutoModelForMultipleChoice, self.pretrained_model_name_or_path, False, quantize=self.quantize).to(device)
             tokenizer = cached_transformers.get_tokenizer(AutoTokenizer, self.pretrained_model_name_or_path)
             return self._predict_mc(mc_instances, model, tokenizer, batch_size=batch_size)
         elif task.has_instance_conversion(InstanceFormat.HF_QA):
             qa_instances = cast(Sequence[HFQAInstance], self._convert_instances(instances, InstanceFormat.HF_QA, task))
-            model = cached_transformers.get(AutoModelForQuestionAnswering, self.pretrained_model_name_or_path, False).to(device)
+            model = cached_transformers.get(AutoModelForQuestionAnswering, self.pretrained_model_name_or_path, False, quantize=self.quantize).to(device)
             tokenizer = cached_transformers.get_tokenizer(AutoTokenizer, self.pretrained_model_name_or_path)
             return self._predict_qa(qa_instances, model, tokenizer, batch_size=batch_size)
         elif task.has_instance_conversion(InstanceFormat.HF_CLASSIFICATION):
@@ -52,7 +63,7 @@ class HFAutoModel(Model):
                 self._convert_instances(instances, InstanceFormat.HF_CLASSIFICATION, task))
             model = cached_transformers.get(
                 AutoModelForSequenceClassification,
-                self.pretrained_model_name_or_path, False
+                self.pretrained_model_name_or_path, False, quantize=self.quantize
             ).to(device)
 
             assert isinstance(task, WithAnswerOptionsMixin)
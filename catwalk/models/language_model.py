@@ -1,10 +1,13 @@
 import collections
+import functools
+import json
+import logging
 import re
-from typing import Dict, Any, List, Tuple, Sequence, Iterator, Union, Mapping, Optional
+from typing import Dict, Any, Iterable, List, Tuple, Sequence, Iterator, Union, Mapping, Optional
 
 import more_itertools
+import numpy as np
 import torch
-from tango.common import Tqdm
 from torch import log_softmax
 from torch.nn.utils.rnn import pad_sequence
 from transformers import AutoModelForCausalLM, T5ForConditionalGeneration, GPT2LMHeadModel, \
@@ -12,15 +15,30 @@ from transformers import AutoModelForCausalLM, T5ForConditionalGeneration, GPT2L
 
 from catwalk import cached_transformers
 from catwalk.model import Model
+from catwalk.models.batching import make_batches, make_packed_rows, logits_bytes_per_token
+from catwalk.models.compiled import BucketedCompiledModule, compiled_base_model
+from catwalk.models.data_parallel import can_run_in_workers, run_in_workers
+from catwalk.models.generation import greedy_until
+from catwalk.models.pipeline import log_pipeline_stats, run_pipelined
+from catwalk.models.prefix_cache import PrefixCache
+from catwalk.models.request_store import RequestStore, instances_fingerprint, task_identity
+from catwalk.models.result_cache import RequestCache, model_identity
+from catwalk.models.streaming import INSTANCE_BLOCK_SIZE, InstanceRequests, combine_instance_requests, \
+    request_progress, stream_predictions
 from catwalk.task import Task, InstanceFormat, RankClassificationInstance
-from catwalk.dependencies.lm_eval.utils import get_rolling_token_windows, make_disjoint_window
+from catwalk.dependencies.lm_eval.base import Request
+from catwalk.dependencies.lm_eval.utils import rolling_token_window_ends
+from catwalk.tasks.perplexity_tokens import TokenizedDocument
+from catwalk.utils import tokenizer_fingerprint
 
 _Model = Union[T5ForConditionalGeneration, GPT2LMHeadModel]
 _Tokenizer = Union[T5TokenizerFast, GPT2Tokenizer]
 
+logger = logging.getLogger(__name__)
+
 
 class LanguageModel(Model):
-    VERSION = "002met"
+    VERSION = "003met"
 
     def __init__(
         self,
@@ -39,7 +57,8 @@ class LanguageModel(Model):
             The method for averaging the sum likelihood of the continuation. 'char' averages by 
             character length, 'token' averages by token length.
         model_kwargs:
-            Additional kwargs passed to the `_make_model` method.
+            Additional kwargs passed to the `_make_model` method, for example `quantize="int8-dynamic"` to
+            quantize the model for CPU inference (see :func:`catwalk.cached_transformers.quantize_model`).
         """
         assert likelihood_averaging in {'char', 'token'}
         self.pretrained_model_name_or_path = pretrained_model_name_or_path
@@ -57,6 +76,16 @@ class LanguageModel(Model):
     def _make_tokenizer(self) -> AutoTokenizer:
         return cached_transformers.get_tokenizer(AutoTokenizer, self.pretrained_tokenizer_name_or_path)
 
+    def model_kwargs_for(self, compute_dtype: Optional[str] = None) -> Dict[str, Any]:
+        """The kwargs for `_make_model`, loading the weights in `compute_dtype` if it is set."""
+        if compute_dtype is None:
+            return self.model_kwargs
+        if not isinstance(getattr(torch, compute_dtype, None), torch.dtype):
+            raise ValueError(f"Unknown compute_dtype {compute_dtype}")
+        if self.model_kwargs.get("quantize") is not None:
+            raise ValueError("compute_dtype cannot be combined with quantize")
+        return dict(self.model_kwargs, torch_dtype=getattr(torch, compute_dtype))
+
     def predict(  # type: ignore
         self,
         task: Task,
@@ -64,179 +93,477 @@ class LanguageModel(Model):
         *,
         batch_size: int = 32,
         max_batch_tokens: int = None, # If set, max number of tokens in a batch
-        max_instances_in_memory: int = 32 * 1024,
+        max_batch_memory: Optional[int] = None, # If set, max bytes of logits in a batch
+        max_buffered_requests: int = 32 * 1024, # Max requests waiting to be batched, bounds the memory of a task
+        max_instances_in_memory: Optional[int] = None, # Deprecated, instances are streamed, see max_buffered_requests
         num_shots: int = 0,
         fewshot_seed: Optional[int] = None,
+        nested_fewshot: bool = False, # The few-shot examples for k shots are the first k of those for more shots
+        num_shots_sweep: Optional[Sequence[int]] = None, # Score all these numbers of shots in one pass, with nested few-shot examples, predictions become {num_shots: prediction}
+        instance_indices: Optional[Sequence[int]] = None, # Index of every instance in the whole task, which seeds its few-shot examples without a fewshot_seed, e.g. for a shard
         model_max_length: Optional[int] = None, # Max input length model should support
         num_recorded_inputs: Optional[int] = 0,  # Number of instances to log in detail
         unconditioned_prompt: Optional[str] = None, # Optional unconditioned prompt, e.g., "Answer:"
+        share_context_kv: bool = False, # Run each distinct context once and score all its continuations from its KV cache
+        continuation_trie: bool = False, # Score the continuations of a context as a token trie, running their shared leading tokens once
+        pack_requests: bool = False, # Pack several short requests into one row instead of padding them
+        single_token_scoring: bool = True, # Score the single-token continuations of a context from one pass over it
+        full_logits: bool = False, # Compute logits at every position instead of only for the continuation
+        request_cache: Optional[RequestCache] = None, # On-disk cache of the results of individual requests
+        prefix_cache: Optional[PrefixCache] = None, # Past key values of long prefixes shared by many requests, e.g. fixed few-shot examples
+        request_store: Optional[RequestStore] = None, # On-disk store of tokenized requests, reused across runs
+        perplexity_stride: Optional[int] = None, # Tokens scored per perplexity window, the rest is left context
+        num_workers: int = 1, # Forked CPU worker processes to split the requests across
+        compile_bucket_size: Optional[int] = None, # Run padded batches through torch.compile, lengths rounded up to multiples of this
+        pipeline_depth: int = 0, # Batches to prepare ahead and finish behind the model in background threads
+        compute_dtype: Optional[str] = None, # Load the weights in this dtype, e.g. "bfloat16", log-probabilities stay float32
     ) -> Iterator[Dict[str, Any]]:
         model = self._make_model(
             self.pretrained_model_name_or_path,
             device_map="auto" if torch.cuda.device_count() > 0 else None,
-            **self.model_kwargs).eval()
+            **self.model_kwargs_for(compute_dtype)).eval()
         if hasattr(model, "tokenizer"):
             tokenizer = model.tokenizer
         else:
             tokenizer = self._make_tokenizer()
 
+        if max_instances_in_memory is not None:
+            logger.warning("max_instances_in_memory is deprecated and ignored, use max_buffered_requests instead")
+
         if "eleuther_metrics" in task.metrics:
             predictor = self.predict_chunk_eleuther
         elif task.has_instance_conversion(InstanceFormat.RANK_CLASSIFICATION):
             predictor = self.predict_chunk_rank_classification
+        elif task.has_instance_conversion(InstanceFormat.TOKENS):
+            predictor = self.predict_chunk_perplexity_tokens
         elif task.has_instance_conversion(InstanceFormat.ELEUTHER_DOC):
             # Assume perplexity tasks here, only for Eleuther tasks for now, but easy to add others
             predictor = self.predict_chunk_perplexity
         else:
             raise ValueError("Unknown task type for LM model")
+        predictor_kwargs = {}
+        if predictor in (self.predict_chunk_perplexity, self.predict_chunk_perplexity_tokens, self.predict_chunk_eleuther):
+            predictor_kwargs["perplexity_stride"] = perplexity_stride
+        if predictor == self.predict_chunk_rank_classification:
+            predictor_kwargs["request_store"] = request_store
+        if predictor in (self.predict_chunk_rank_classification, self.predict_chunk_eleuther):
+            predictor_kwargs["nested_fewshot"] = nested_fewshot
+            predictor_kwargs["num_shots_sweep"] = num_shots_sweep
+            predictor_kwargs["instance_indices"] = instance_indices
+        elif num_shots_sweep is not None:
+            raise ValueError(f"num_shots_sweep is not supported for task {task}, which has no few-shot examples")
 
-        for instance_chunk in more_itertools.chunked(instances, max_instances_in_memory):
-            yield from predictor(
-                task,
-                instance_chunk,
-                model,
-                tokenizer,
-                batch_size=batch_size,
-                max_batch_tokens=max_batch_tokens,
-                num_shots=num_shots,
-                fewshot_seed=fewshot_seed,
-                model_max_length=model_max_length,
-                num_recorded_inputs=num_recorded_inputs,
-                unconditioned_prompt=unconditioned_prompt
-            )
+        yield from predictor(
+            task,
+            instances,
+            model,
+            tokenizer,
+            batch_size=batch_size,
+            max_batch_tokens=max_batch_tokens,
+            max_batch_memory=max_batch_memory,
+            num_shots=num_shots,
+            fewshot_seed=fewshot_seed,
+            model_max_length=model_max_length,
+            num_recorded_inputs=num_recorded_inputs,
+            unconditioned_prompt=unconditioned_prompt,
+            share_context_kv=share_context_kv,
+            continuation_trie=continuation_trie,
+            pack_requests=pack_requests,
+            single_token_scoring=single_token_scoring,
+            full_logits=full_logits,
+            num_workers=num_workers,
+            compile_bucket_size=compile_bucket_size,
+            pipeline_depth=pipeline_depth,
+            request_cache=request_cache,
+            prefix_cache=prefix_cache,
+            max_buffered_requests=max_buffered_requests,
+            num_instances=len(instances),
+            **predictor_kwargs
+        )
 
     def predict_chunk_rank_classification(
         self,
         task: Task,
-        instances: Sequence[Dict[str, Any]],
+        instances: Iterable[Dict[str, Any]],
         model: _Model,
         tokenizer: _Tokenizer,
         batch_size: int = 32,
         max_batch_tokens: int = None,
+        max_batch_memory: Optional[int] = None,
         num_shots: int = 0,
         fewshot_seed: Optional[int] = None,
         model_max_length: Optional[int] = None,
         num_recorded_inputs: Optional[int] = 0,
         unconditioned_prompt: Optional[str] = None,
+        share_context_kv: bool = False,
+        continuation_trie: bool = False,
+        pack_requests: bool = False,
+        single_token_scoring: bool = True,
+        full_logits: bool = False,
+        num_workers: int = 1,
+        compile_bucket_size: Optional[int] = None,
+        pipeline_depth: int = 0,
+        request_cache: Optional[RequestCache] = None,
+        prefix_cache: Optional[PrefixCache] = None,
+        request_store: Optional[RequestStore] = None,
+        max_buffered_requests: Optional[int] = None,
+        nested_fewshot: bool = False,
+        num_shots_sweep: Optional[Sequence[int]] = None,
+        instance_indices: Optional[Sequence[int]] = None,
+        num_instances: Optional[int] = None,
     ) -> Iterator[Dict[str, Any]]:
-        instance_index_to_tuple_indices: Mapping[int, List[int]] = collections.defaultdict(list)
-        tuples: List[Tuple[str, str]] = []
+        def instance_requests() -> Iterator[InstanceRequests]:
+            for block_index, block in enumerate(more_itertools.chunked(instances, INSTANCE_BLOCK_SIZE)):
+                start_index = block_index * INSTANCE_BLOCK_SIZE
+                block_indices = None
+                if instance_indices is not None:
+                    block_indices = instance_indices[start_index:start_index + len(block)]
+                if num_shots_sweep is None:
+                    yield from self._rank_classification_requests(
+                        task, block, start_index, tokenizer, num_shots, fewshot_seed, num_recorded_inputs,
+                        unconditioned_prompt, request_store, nested_fewshot, block_indices)
+                    continue
+                # the same instance with every number of shots, so their shared prompts run together
+                sweep = {
+                    sweep_num_shots: self._rank_classification_requests(
+                        task, block, start_index, tokenizer, sweep_num_shots, fewshot_seed, num_recorded_inputs,
+                        unconditioned_prompt, request_store, nested_fewshot=True, instance_indices=block_indices)
+                    for sweep_num_shots in num_shots_sweep
+                }
+                for variants in zip(*sweep.values()):
+                    yield combine_instance_requests(dict(zip(sweep.keys(), variants)))
+
+        def run(cc_pairs: List[Dict[str, Tuple[torch.Tensor, torch.Tensor]]]) -> Sequence[Dict]:
+            return self._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size,
+                                                  max_batch_tokens=max_batch_tokens,
+                                                  model_max_length=model_max_length,
+                                                  max_batch_memory=max_batch_memory,
+                                                  share_context_kv=share_context_kv,
+                                                  continuation_trie=continuation_trie,
+                                                  pack_requests=pack_requests,
+                                                  single_token_scoring=single_token_scoring,
+                                                  full_logits=full_logits,
+                                                  num_workers=num_workers,
+                                                  compile_bucket_size=compile_bucket_size,
+                                                  pipeline_depth=pipeline_depth,
+                                                  request_cache=request_cache,
+                                                  prefix_cache=prefix_cache)
+
+        yield from stream_predictions(
+            instance_requests(),
+            {"loglikelihood": run},
+            max_buffered_requests=max_buffered_requests,
+            round_multiple=batch_size,
+            num_instances=num_instances)
+
+    def _rank_classification_requests(
+        self,
+        task: Task,
+        instances: Sequence[Dict[str, Any]],
+        start_index: int,
+        tokenizer: _Tokenizer,
+        num_shots: int = 0,
+        fewshot_seed: Optional[int] = None,
+        num_recorded_inputs: Optional[int] = 0,
+        unconditioned_prompt: Optional[str] = None,
+        request_store: Optional[RequestStore] = None,
+        nested_fewshot: bool = False,
+        instance_indices: Optional[Sequence[int]] = None
+    ) -> Iterator[InstanceRequests]:
+        """
+        The requests of a block of instances, the first of which is number `start_index` of the instances being
+        predicted, tokenized all at once, or read from the `request_store`. `instance_indices` are the indices
+        of the instances in the whole task, which seed their few-shot examples, by default the same numbers.
+        """
+        num_recorded_inputs = max(0, (num_recorded_inputs or 0) - start_index)
+        if instance_indices is None:
+            instance_indices = range(start_index, start_index + len(instances))
+        if request_store is None:
+            tuples, instance_tuple_indices, correct_choices = self._rank_classification_tuples(
+                task, instances, num_shots, fewshot_seed, unconditioned_prompt, instance_indices, nested_fewshot)
+            cc_pairs = self._tokenize_loglikelihood(tuples, tokenizer)
+            num_chars = [len(t[1]) for t in tuples]
+        else:
+            description = {
+                "kind": "rank_classification",
+                "task": task_identity(task),
+                "instances": instances_fingerprint(instances),
+                "instance_indices": list(instance_indices),
+                "num_shots": num_shots,
+                "fewshot_seed": fewshot_seed,
+                "unconditioned_prompt": unconditioned_prompt,
+                "tokenizer": tokenizer_fingerprint(tokenizer),
+            }
+            if nested_fewshot:
+                description["nested_fewshot"] = True
+            stored = request_store.get_or_build(description, lambda: self._compile_rank_classification(
+                task, instances, tokenizer, num_shots, fewshot_seed, unconditioned_prompt, instance_indices,
+                nested_fewshot))
+            instance_tuple_indices = stored.index["instance_tuple_indices"]
+            correct_choices = stored.index["correct_choices"]
+            num_chars = stored.index["num_chars"]
+            cc_pairs = []
+            for i in range(len(num_chars)):
+                input_ids = (stored.sequence(2 * i), stored.sequence(2 * i + 1))
+                cc_pair = {"input_ids": input_ids}
+                if "attention_mask" in stored.index["fields"]:
+                    cc_pair["attention_mask"] = (torch.ones_like(input_ids[0]), torch.ones_like(input_ids[1]))
+                cc_pairs.append(cc_pair)
+            # only the recorded instances need their text
+            tuples, _, _ = self._rank_classification_tuples(
+                task, instances[:num_recorded_inputs], num_shots, fewshot_seed, unconditioned_prompt,
+                instance_indices, nested_fewshot)
+        unconditioned_offset = sum(len(tuple_indices) for tuple_indices in instance_tuple_indices)
+        # where the unconditioned tuples start in `tuples`
+        if request_store is None:
+            tuples_unconditioned_offset = unconditioned_offset
+        else:
+            tuples_unconditioned_offset = len(tuples) // 2
 
+        for instance_index, tuple_indices in enumerate(instance_tuple_indices):
+            request_indices = list(tuple_indices)
+            if unconditioned_prompt:
+                request_indices.extend(i + unconditioned_offset for i in tuple_indices)
+            model_input = None
+            unconditioned_input = None
+            if instance_index < num_recorded_inputs:
+                model_input = [tuples[i] for i in tuple_indices]
+                if unconditioned_prompt:
+                    unconditioned_input = [tuples[i + tuples_unconditioned_offset] for i in tuple_indices]
+            yield InstanceRequests(
+                [
+                    ("loglikelihood", cc_pairs[i], sum(len(ids) for ids in cc_pairs[i]["input_ids"]))
+                    for i in request_indices
+                ],
+                functools.partial(
+                    _rank_classification_prediction,
+                    num_chars=[num_chars[i] for i in request_indices],
+                    correct_choice=correct_choices[instance_index],
+                    has_unconditioned=bool(unconditioned_prompt),
+                    model_input=model_input,
+                    unconditioned_input=unconditioned_input))
+
+    @staticmethod
+    def _rank_classification_tuples(
+        task: Task,
+        instances: Sequence[Dict[str, Any]],
+        num_shots: int = 0,
+        fewshot_seed: Optional[int] = None,
+        unconditioned_prompt: Optional[str] = None,
+        instance_indices: Optional[Sequence[int]] = None,
+        nested_fewshot: bool = False
+    ) -> Tuple[List[Tuple[str, str]], List[List[int]], List[Any]]:
+        """
+        Converts the instances into (context, continuation) tuples. Returns the tuples, the indices of the
+        tuples of every instance, and the correct choice of every instance. With an `unconditioned_prompt`,
+        the tuples of all instances are followed by the same tuples again with the unconditioned prompt.
+        Without a `fewshot_seed`, the few-shot examples of every instance are seeded by its index in the task,
+        from `instance_indices`, by default its position in `instances`. With `nested_fewshot`, they are sampled
+        such that the examples for fewer shots are the first ones of the examples for more shots.
+        """
         rc_instances: List[RankClassificationInstance] = [
             task.convert_instance(
                 instance,
                 InstanceFormat.RANK_CLASSIFICATION,
                 fewshot_instances=task.get_fewshot_instances(
                     num_shots,
-                    random_seed=fewshot_seed if fewshot_seed is not None else i,
-                    exceptions=instance))
+                    random_seed=fewshot_seed if fewshot_seed is not None else
+                        (instance_indices[i] if instance_indices is not None else i),
+                    exceptions=instance,
+                    nested=nested_fewshot))
             for i, instance in enumerate(instances)
         ]
 
         # get all the tuples
-        for instance_index, instance in enumerate(rc_instances):
-            for instance_request in instance.choices:
-                instance_index_to_tuple_indices[instance_index].append(len(tuples))
-                tuples.append(instance_request)
-        unconditioned_offset = len(tuples)
+        tuples: List[Tuple[str, str]] = []
+        instance_tuple_indices: List[List[int]] = []
+        for instance in rc_instances:
+            instance_tuple_indices.append(list(range(len(tuples), len(tuples) + len(instance.choices))))
+            tuples.extend(instance.choices)
         if unconditioned_prompt:
-            for instance_index, instance in enumerate(rc_instances):
+            for instance in rc_instances:
                 for instance_request in instance.choices:
                     tuples.append((unconditioned_prompt, instance_request[1]))
+        return tuples, instance_tuple_indices, [instance.correct_choice for instance in rc_instances]
 
-        # run the requests
-        results = self._run_loglikelihood(tuples, model, tokenizer, batch_size,
-                                          max_batch_tokens=max_batch_tokens,
-                                          model_max_length=model_max_length)
-
-        # collect the results
-        for instance_index, instance in enumerate(rc_instances):
-            tuple_indices = instance_index_to_tuple_indices[instance_index]
-            results_for_instance = [results[i] for i in tuple_indices]
-            if unconditioned_prompt:
-                for idx, i in enumerate(tuple_indices):
-                    unconditioned_results = results[i + unconditioned_offset]
-                    results_for_instance[idx]['sum_logits_uncond'] = unconditioned_results['sum_logits']
-            res = {"model_output": results_for_instance, "correct_choice": instance.correct_choice}
-            if instance_index < num_recorded_inputs:
-                res["model_input"] = [tuples[i] for i in tuple_indices]
-                if unconditioned_prompt:
-                    res["unconditioned_input"] = [tuples[i + unconditioned_offset] for i in tuple_indices]
-            yield res
+    def _compile_rank_classification(
+        self,
+        task: Task,
+        instances: Sequence[Dict[str, Any]],
+        tokenizer: _Tokenizer,
+        num_shots: int = 0,
+        fewshot_seed: Optional[int] = None,
+        unconditioned_prompt: Optional[str] = None,
+        instance_indices: Optional[Sequence[int]] = None,
+        nested_fewshot: bool = False
+    ) -> Tuple[List[torch.Tensor], Dict[str, Any]]:
+        """The token ids and the index of the rank classification requests of a block, for a `RequestStore`."""
+        tuples, instance_tuple_indices, correct_choices = self._rank_classification_tuples(
+            task, instances, num_shots, fewshot_seed, unconditioned_prompt, instance_indices, nested_fewshot)
+        cc_pairs = self._tokenize_loglikelihood(tuples, tokenizer)
+        sequences = [ids for cc_pair in cc_pairs for ids in cc_pair["input_ids"]]
+        return sequences, {
+            "instance_tuple_indices": instance_tuple_indices,
+            "correct_choices": correct_choices,
+            "num_chars": [len(t[1]) for t in tuples],
+            "fields": sorted(cc_pairs[0].keys()) if cc_pairs else ["input_ids"],
+        }
 
     def predict_chunk_perplexity(
         self,
         task: Task,
-        instances: Sequence[Dict[str, Any]],
+        instances: Iterable[Dict[str, Any]],
+        model: _Model,
+        tokenizer: _Tokenizer,
+        **kwargs
+    ) -> Iterator[Dict[str, Any]]:
+        def documents() -> Iterator[Tuple[torch.Tensor, Dict[str, int]]]:
+            for instance in instances:
+                doc = task.convert_instance(instance, InstanceFormat.ELEUTHER_DOC)
+                token_ids = torch.tensor(tokenizer.encode(doc, add_special_tokens=False), dtype=torch.long)
+                yield token_ids, {
+                    "num_chars": len(doc), "num_words": len(re.split(r"\s+", doc)), "num_bytes": len(doc.encode("utf-8"))}
+        yield from self._predict_perplexity(documents(), model, tokenizer, **kwargs)
+
+    def predict_chunk_perplexity_tokens(
+        self,
+        task: Task,
+        instances: Iterable[Dict[str, Any]],
+        model: _Model,
+        tokenizer: _Tokenizer,
+        **kwargs
+    ) -> Iterator[Dict[str, Any]]:
+        fingerprint = tokenizer_fingerprint(tokenizer)
+
+        def documents() -> Iterator[Tuple[torch.Tensor, Dict[str, int]]]:
+            for instance in instances:
+                doc: TokenizedDocument = task.convert_instance(instance, InstanceFormat.TOKENS)
+                if doc.tokenizer_fingerprint != fingerprint:
+                    raise ValueError(
+                        f"Task {task} was tokenized with a different tokenizer than the one of {self.pretrained_model_name_or_path}")
+                # memory-mapped tokens are unsigned and read-only, so they are cast rather than shared
+                yield torch.from_numpy(doc.token_ids.astype(np.int64)), {
+                    "num_chars": doc.num_chars, "num_words": doc.num_words, "num_bytes": doc.num_bytes}
+        yield from self._predict_perplexity(documents(), model, tokenizer, **kwargs)
+
+    def _predict_perplexity(
+        self,
+        documents: Iterable[Tuple[torch.Tensor, Dict[str, int]]],
         model: _Model,
         tokenizer: _Tokenizer,
         batch_size: int = 32,
         max_batch_tokens: int = None,
-        num_shots: int = 0,
-        fewshot_seed: Optional[int] = None,
+        max_batch_memory: Optional[int] = None,
         model_max_length: Optional[int] = None,
         num_recorded_inputs: Optional[int] = 0,
-        unconditioned_prompt: Optional[str] = None,
+        pack_requests: bool = False,
+        single_token_scoring: bool = True,
+        full_logits: bool = False,
+        num_workers: int = 1,
+        compile_bucket_size: Optional[int] = None,
+        pipeline_depth: int = 0,
+        request_cache: Optional[RequestCache] = None,
+        prefix_cache: Optional[PrefixCache] = None,
+        perplexity_stride: Optional[int] = None,
+        max_buffered_requests: Optional[int] = None,
+        num_instances: Optional[int] = None,
+        **kwargs
     ) -> Iterator[Dict[str, Any]]:
+        """Scores the token ids of every document in rolling windows, and adds the stats of the document."""
+        truncation_length, stride = _rolling_window_sizes(tokenizer, model_max_length, perplexity_stride)
 
-        doc_instances: List[str] = [
-            task.convert_instance(instance, InstanceFormat.ELEUTHER_DOC)
-            for i, instance in enumerate(instances)
+        def instance_requests() -> Iterator[InstanceRequests]:
+            for instance_index, (token_ids, stats) in enumerate(documents):
+                windows = list(_rolling_windows(token_ids, tokenizer.eos_token_id, truncation_length, stride))
+                model_input = None
+                if instance_index < num_recorded_inputs:
+                    model_input = [[tokenizer.decode(x) for x in window] for window in windows]
+                yield InstanceRequests(
+                    [("loglikelihood", {"input_ids": window}, sum(len(x) for x in window)) for window in windows],
+                    functools.partial(_perplexity_prediction, stats=stats, model_input=model_input))
+
+        def run(cc_pairs: List[Dict[str, Tuple[torch.Tensor, torch.Tensor]]]) -> Sequence[Dict]:
+            return self._run_loglikelihood_tokens(
+                cc_pairs, model, tokenizer, batch_size,
+                max_batch_tokens=max_batch_tokens,
+                model_max_length=model_max_length,
+                max_batch_memory=max_batch_memory,
+                pack_requests=pack_requests,
+                single_token_scoring=single_token_scoring,
+                full_logits=full_logits,
+                num_workers=num_workers,
+                compile_bucket_size=compile_bucket_size,
+                pipeline_depth=pipeline_depth,
+                request_cache=request_cache,
+                prefix_cache=prefix_cache)
+
+        yield from stream_predictions(
+            instance_requests(),
+            {"loglikelihood": run},
+            max_buffered_requests=max_buffered_requests,
+            round_multiple=batch_size,
+            num_instances=num_instances)
+
+    def _run_rolling_windows(
+        self,
+        documents: Sequence[torch.Tensor],
+        model: _Model,
+        tokenizer: _Tokenizer,
+        batch_size: int = 32,
+        max_batch_tokens: int = None,
+        model_max_length: Optional[int] = None,
+        max_batch_memory: Optional[int] = None,
+        share_context_kv: bool = False,
+        continuation_trie: bool = False,
+        pack_requests: bool = False,
+        single_token_scoring: bool = True,
+        full_logits: bool = False,
+        num_workers: int = 1,
+        compile_bucket_size: Optional[int] = None,
+        pipeline_depth: int = 0,
+        request_cache: Optional[RequestCache] = None,
+        prefix_cache: Optional[PrefixCache] = None,
+        perplexity_stride: Optional[int] = None,
+    ) -> Tuple[List[Dict], List[List[Tuple[torch.Tensor, torch.Tensor]]]]:
+        """
+        Scores every token of every document in rolling windows (see `_rolling_windows`). The windows of all
+        documents are batched together, and their results are summed per document. Returns the summed results
+        and the windows of every document.
+        """
+        truncation_length, stride = _rolling_window_sizes(tokenizer, model_max_length, perplexity_stride)
+        windows = [
+            list(_rolling_windows(token_ids, tokenizer.eos_token_id, truncation_length, stride))
+            for token_ids in documents
         ]
-        truncation_length = tokenizer.model_max_length
-        if model_max_length:
-            truncation_length = min(truncation_length, model_max_length)
-        instance_index_to_cc_indices: Mapping[int, List[int]] = collections.defaultdict(list)
-        cc_pairs = []
-
-        for instance_index, doc_instance in enumerate(doc_instances):
-            rolling_token_windows = list(
-                map(
-                    make_disjoint_window,
-                    get_rolling_token_windows(
-                        token_list=tokenizer.encode(doc_instance, add_special_tokens=False),
-                        prefix_token=tokenizer.eos_token_id,
-                        max_seq_len=truncation_length,
-                        context_len=1,
-                    ),
-                )
-            )
-            for context, continuation in rolling_token_windows:
-                instance_index_to_cc_indices[instance_index].append(len(cc_pairs))
-                cc_pairs.append({"input_ids": (
-                    torch.tensor(context, dtype=torch.long),
-                    torch.tensor(continuation, dtype=torch.long))})
+        cc_pairs = [{"input_ids": window} for document_windows in windows for window in document_windows]
+        window_results = self._run_loglikelihood_tokens(
+            cc_pairs, model, tokenizer, batch_size,
+            max_batch_tokens=max_batch_tokens,
+            model_max_length=model_max_length,
+            max_batch_memory=max_batch_memory,
+            share_context_kv=share_context_kv,
+            continuation_trie=continuation_trie,
+            pack_requests=pack_requests,
+            single_token_scoring=single_token_scoring,
+            full_logits=full_logits,
+            num_workers=num_workers,
+            compile_bucket_size=compile_bucket_size,
+            pipeline_depth=pipeline_depth,
+            request_cache=request_cache,
+            prefix_cache=prefix_cache)
 
-        results = self._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size,
-                                                 max_batch_tokens=max_batch_tokens,
-                                                 model_max_length=model_max_length)
-
-        # collect the results
-        for instance_index, doc in enumerate(doc_instances):
-            cc_indices = instance_index_to_cc_indices[instance_index]
-            results_for_instance = [results[i] for i in cc_indices]
-            model_output = {"sum_logits": 0, "num_tokens": 0, "num_tokens_all": 0}
-            model_output["num_chars"] = len(doc)
-            model_output["num_words"] = len(re.split(r"\s+", doc))
-            model_output["num_bytes"] = len(doc.encode("utf-8"))
-            for result in results_for_instance:
-                model_output["sum_logits"] += result["sum_logits"]
-                model_output["num_tokens"] += result["num_tokens"]
-                model_output["num_tokens_all"] += result["num_tokens_all"]
-
-            res = {"model_output": model_output}
-            if instance_index < num_recorded_inputs:
-                res["model_input"] = []
-                for index in cc_indices:
-                    inp = [tokenizer.decode(x) for x in cc_pairs[index]['input_ids']]
-                    res["model_input"].append(inp)
-            yield res
+        results = []
+        offset = 0
+        for document_windows in windows:
+            results.append(_sum_window_results(window_results[offset:offset + len(document_windows)]))
+            offset += len(document_windows)
+        return results, windows
 
     # For tasks we're coopting directly from Eleuther
     def predict_chunk_eleuther(
         self,
         task: Task,
-        instances: Sequence[Dict[str, Any]],
+        instances: Iterable[Dict[str, Any]],
         model: GPT2LMHeadModel,
         tokenizer: GPT2Tokenizer,
         *,
@@ -245,28 +572,15 @@ class LanguageModel(Model):
         model_max_length: Optional[int] = None,
         num_recorded_inputs: Optional[int] = 0,
         unconditioned_prompt: Optional[str] = None,
+        perplexity_stride: Optional[int] = None,
+        max_buffered_requests: Optional[int] = None,
+        nested_fewshot: bool = False,
+        num_shots_sweep: Optional[Sequence[int]] = None,
+        instance_indices: Optional[Sequence[int]] = None,
+        num_instances: Optional[int] = None,
         **kwargs
     ) -> Iterator[Dict[str, Any]]:
-        instance_index_to_request_indices = collections.defaultdict(lambda: collections.defaultdict(list))
-        requests = collections.defaultdict(list)
-
-        # get all the requests
-        for instance_index, instance in enumerate(instances):
-            instance_requests = task.convert_instance(
-                instance,
-                InstanceFormat.ELEUTHER_REQUESTS,
-                num_fewshot=num_shots,
-                fewshot_seed=fewshot_seed if fewshot_seed is not None else instance_index)
-            if not isinstance(instance_requests, (list, tuple)):
-                instance_requests = [instance_requests]
-            for instance_request in instance_requests:
-                request_type = instance_request.request_type
-                instance_index_to_request_indices[instance_index][request_type].append(len(requests[request_type]))
-                requests[request_type].append(instance_request)
-
-        # run the requests
-        results: Dict[str, Sequence] = {}
-        request_type_to_fn= {
+        request_type_to_fn = {
             "loglikelihood": (self._run_loglikelihood, lambda x: (x["sum_logits"], x['is_greedy'])),
             "loglikelihood_rolling": (self._run_loglikelihood_rolling, lambda x: [x["sum_logits"]]),
             "greedy_until": (self._run_greedy_until, lambda x: x["text"])
@@ -274,39 +588,100 @@ class LanguageModel(Model):
         extra_kw_args = {}
         if hasattr(task, "model_args"):
             extra_kw_args = task.model_args
-        for request_type, requests_per_type in requests.items():
-            results[request_type] = request_type_to_fn[request_type][0](
-                [tuple(r.args) for r in requests_per_type],
+
+        def run(request_type: str, requests: List[Request]) -> Sequence:
+            request_kw_args = {}
+            if request_type == "loglikelihood_rolling":
+                request_kw_args["perplexity_stride"] = perplexity_stride
+            return request_type_to_fn[request_type][0](
+                [tuple(r.args) for r in requests],
                 model,
                 tokenizer,
                 model_max_length=model_max_length,
                 **extra_kw_args,
+                **request_kw_args,
                 **kwargs
             )
-        for instance_index, instance in enumerate(instances):
-            doc = task.convert_instance(instance, InstanceFormat.ELEUTHER_DOC)
+
+        def finish(
+            results: List[Any],
+            doc: Dict[str, Any],
+            requests_by_type: Mapping[str, List[Request]],
+            record_inputs: bool
+        ) -> Dict[str, Any]:
             results_for_instance: List = []
-            model_outputs_for_instance = []
             model_inputs = {}
-            for request_type, request_indices in instance_index_to_request_indices[instance_index].items():
-                for i in request_indices:
-                    result = results[request_type][i]
+            results_iter = iter(results)
+            for request_type, requests in requests_by_type.items():
+                for r in requests:
                     # Look up the appropriate key
-                    eleuther_result = request_type_to_fn[request_type][1](result)
-                    results_for_instance.append(eleuther_result)
-                    model_outputs_for_instance.append(result)
-                    if instance_index < num_recorded_inputs:
-                        if request_type not in model_inputs:
-                            model_inputs[request_type] = []
-                        model_inputs[request_type].append(requests[request_type][i].args)
+                    results_for_instance.append(request_type_to_fn[request_type][1](next(results_iter)))
+                if record_inputs:
+                    model_inputs[request_type] = [r.args for r in requests]
 
             metrics = task.inner_task.process_results(doc, results_for_instance)
-            res = {"model_output": model_outputs_for_instance, "metrics": metrics}
-            if instance_index < num_recorded_inputs:
+            res = {"model_output": list(results), "metrics": metrics}
+            if record_inputs:
                 res["model_input"] = model_inputs
+            return res
 
-            yield res
+        def requests_for(
+            instance_index: int,
+            instance: Dict[str, Any],
+            doc: Dict[str, Any],
+            num_shots: int,
+            nested_fewshot: bool
+        ) -> InstanceRequests:
+            eleuther_requests = task.convert_instance(
+                instance,
+                InstanceFormat.ELEUTHER_REQUESTS,
+                num_fewshot=num_shots,
+                fewshot_seed=fewshot_seed if fewshot_seed is not None else
+                    (instance_indices[instance_index] if instance_indices is not None else instance_index),
+                nested_fewshot=nested_fewshot)
+            if not isinstance(eleuther_requests, (list, tuple)):
+                eleuther_requests = [eleuther_requests]
+            # the results of an instance are grouped by request type
+            requests_by_type = collections.defaultdict(list)
+            for eleuther_request in eleuther_requests:
+                requests_by_type[eleuther_request.request_type].append(eleuther_request)
+            return InstanceRequests(
+                [
+                    (request_type, r, sum(len(arg) for arg in r.args if isinstance(arg, str)))
+                    for request_type, requests in requests_by_type.items()
+                    for r in requests
+                ],
+                functools.partial(
+                    finish,
+                    doc=doc,
+                    requests_by_type=requests_by_type,
+                    record_inputs=instance_index < num_recorded_inputs))
+
+        def instance_requests() -> Iterator[InstanceRequests]:
+            for instance_index, instance in enumerate(instances):
+                doc = task.convert_instance(instance, InstanceFormat.ELEUTHER_DOC)
+                if num_shots_sweep is None:
+                    yield requests_for(instance_index, instance, doc, num_shots, nested_fewshot)
+                else:
+                    yield combine_instance_requests({
+                        sweep_num_shots: requests_for(instance_index, instance, doc, sweep_num_shots, True)
+                        for sweep_num_shots in num_shots_sweep
+                    })
 
+        yield from stream_predictions(
+            instance_requests(),
+            {request_type: functools.partial(run, request_type) for request_type in request_type_to_fn},
+            max_buffered_requests=max_buffered_requests,
+            round_multiple=kwargs.get("batch_size", 32),
+            num_instances=num_instances)
+
+
+    def _tokenize_loglikelihood(
+        self,
+        tuples: Sequence[Tuple[str, str]],
+        tokenizer: _Tokenizer
+    ) -> List[Dict[str, Tuple[torch.Tensor, torch.Tensor]]]:
+        raise NotImplementedError
 
     def _run_loglikelihood(
         self,
@@ -315,19 +690,42 @@ class LanguageModel(Model):
         tokenizer: _Tokenizer,
         batch_size: int = 32,
         max_batch_tokens: int = None,
-        model_max_length: Optional[int] = None
+        model_max_length: Optional[int] = None,
+        max_batch_memory: Optional[int] = None,
+        share_context_kv: bool = False,
+        continuation_trie: bool = False,
+        pack_requests: bool = False,
+        single_token_scoring: bool = True,
+        full_logits: bool = False,
+        num_workers: int = 1,
+        compile_bucket_size: Optional[int] = None,
+        pipeline_depth: int = 0,
+        request_cache: Optional[RequestCache] = None,
+        prefix_cache: Optional[PrefixCache] = None
     ) -> Sequence[float]:
         raise NotImplementedError
 
     def _run_loglikelihood_rolling(
         self,
-        tuples: Sequence[Tuple[str, str]],
+        tuples: Sequence[Tuple[str]],
         model: _Model,
         tokenizer: _Tokenizer,
         batch_size: int = 32,
         max_batch_tokens: int = None,
-        model_max_length: Optional[int] = None
-    ) -> Sequence[float]:
+        model_max_length: Optional[int] = None,
+        max_batch_memory: Optional[int] = None,
+        share_context_kv: bool = False,
+        continuation_trie: bool = False,
+        pack_requests: bool = False,
+        single_token_scoring: bool = True,
+        full_logits: bool = False,
+        num_workers: int = 1,
+        compile_bucket_size: Optional[int] = None,
+        pipeline_depth: int = 0,
+        request_cache: Optional[RequestCache] = None,
+        prefix_cache: Optional[PrefixCache] = None,
+        perplexity_stride: Optional[int] = None
+    ) -> Sequence[Dict]:
         raise NotImplementedError
 
     def _run_greedy_until(
@@ -373,9 +771,45 @@ class DecoderOnlyLanguageModel(LanguageModel):
         tokenizer: _Tokenizer,
         batch_size: int = 32,
         max_batch_tokens: int = None,
-        model_max_length: Optional[int] = None
+        model_max_length: Optional[int] = None,
+        max_batch_memory: Optional[int] = None,
+        share_context_kv: bool = False,
+        continuation_trie: bool = False,
+        pack_requests: bool = False,
+        single_token_scoring: bool = True,
+        full_logits: bool = False,
+        num_workers: int = 1,
+        compile_bucket_size: Optional[int] = None,
+        pipeline_depth: int = 0,
+        request_cache: Optional[RequestCache] = None,
+        prefix_cache: Optional[PrefixCache] = None
     ) -> Sequence[Dict]:
 
+        cc_pairs = self._tokenize_loglikelihood(tuples, tokenizer)
+        results = self._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size,
+                                                 max_batch_tokens=max_batch_tokens,
+                                                 model_max_length=model_max_length,
+                                                 max_batch_memory=max_batch_memory,
+                                                 share_context_kv=share_context_kv,
+                                                 continuation_trie=continuation_trie,
+                                                 pack_requests=pack_requests,
+                                                 single_token_scoring=single_token_scoring,
+                                                 full_logits=full_logits,
+                                                 num_workers=num_workers,
+                                                 compile_bucket_size=compile_bucket_size,
+                                                 pipeline_depth=pipeline_depth,
+                                                 request_cache=request_cache,
+                                                 prefix_cache=prefix_cache)
+        for i, result in enumerate(results):
+            result['num_chars'] = len(tuples[i][1])
+
+        return results
+
+    def _tokenize_loglikelihood(
+        self,
+        tuples: Sequence[Tuple[str, str]],
+        tokenizer: _Tokenizer
+    ) -> List[Dict[str, Tuple[torch.Tensor, torch.Tensor]]]:
         tokenized_contexts = tokenizer([t[0] for t in tuples], add_special_tokens=False)
         tokenized_continuations = tokenizer([self._prefix_with_space(t[1]) for t in tuples], add_special_tokens=False)
 
@@ -399,12 +833,49 @@ class DecoderOnlyLanguageModel(LanguageModel):
                     torch.tensor(context, dtype=torch.long),
                     torch.tensor(continuation, dtype=torch.long)
                 )
-        results = self._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size,
-                                                 max_batch_tokens=max_batch_tokens,
-                                                 model_max_length=model_max_length)
-        for i, result in enumerate(results):
-            result['num_chars'] = len(tuples[i][1])
+        return cc_pairs
 
+    def _run_loglikelihood_rolling(
+        self,
+        tuples: Sequence[Tuple[str]],
+        model: _Model,
+        tokenizer: _Tokenizer,
+        batch_size: int = 32,
+        max_batch_tokens: int = None,
+        model_max_length: Optional[int] = None,
+        max_batch_memory: Optional[int] = None,
+        share_context_kv: bool = False,
+        continuation_trie: bool = False,
+        pack_requests: bool = False,
+        single_token_scoring: bool = True,
+        full_logits: bool = False,
+        num_workers: int = 1,
+        compile_bucket_size: Optional[int] = None,
+        pipeline_depth: int = 0,
+        request_cache: Optional[RequestCache] = None,
+        prefix_cache: Optional[PrefixCache] = None,
+        perplexity_stride: Optional[int] = None
+    ) -> Sequence[Dict]:
+        documents = [
+            torch.tensor(tokenizer.encode(t[0], add_special_tokens=False), dtype=torch.long)
+            for t in tuples
+        ]
+        results, _ = self._run_rolling_windows(
+            documents, model, tokenizer, batch_size,
+            max_batch_tokens=max_batch_tokens,
+            model_max_length=model_max_length,
+            max_batch_memory=max_batch_memory,
+            share_context_kv=share_context_kv,
+            continuation_trie=continuation_trie,
+            pack_requests=pack_requests,
+            single_token_scoring=single_token_scoring,
+            full_logits=full_logits,
+            num_workers=num_workers,
+            compile_bucket_size=compile_bucket_size,
+            pipeline_depth=pipeline_depth,
+            request_cache=request_cache,
+            prefix_cache=prefix_cache,
+            perplexity_stride=perplexity_stride)
         return results
 
     def _run_loglikelihood_tokens(
@@ -414,71 +885,635 @@ class DecoderOnlyLanguageModel(LanguageModel):
         tokenizer: _Tokenizer,
         batch_size: int = 32,
         max_batch_tokens: int = None,
-        model_max_length: Optional[int] = None
+        model_max_length: Optional[int] = None,
+        max_batch_memory: Optional[int] = None,
+        share_context_kv: bool = False,
+        continuation_trie: bool = False,
+        pack_requests: bool = False,
+        single_token_scoring: bool = True,
+        full_logits: bool = False,
+        num_workers: int = 1,
+        compile_bucket_size: Optional[int] = None,
+        pipeline_depth: int = 0,
+        request_cache: Optional[RequestCache] = None,
+        prefix_cache: Optional[PrefixCache] = None
     ) -> Sequence[Dict]:
 
         truncation_length = tokenizer.model_max_length
         if model_max_length:
             truncation_length = min(truncation_length, model_max_length)
 
-        # find out the order to process sequences in
-        lengths = torch.tensor([
-            len(cc_pair["input_ids"][0]) + len(cc_pair["input_ids"][1])
+        if request_cache is not None:
+            requests = [
+                ["loglikelihood", truncation_length, cc_pair["input_ids"][0].tolist(), cc_pair["input_ids"][1].tolist()]
+                for cc_pair in cc_pairs
+            ]
+            # only the options that change the results, the others just schedule the requests
+            options = {"model_max_length": model_max_length, "full_logits": full_logits}
+            return request_cache.get_or_compute(
+                model_identity(self, model, tokenizer),
+                requests,
+                cc_pairs,
+                lambda missing_pairs: self._run_loglikelihood_tokens(
+                    missing_pairs, model, tokenizer, batch_size,
+                    max_batch_tokens=max_batch_tokens,
+                    max_batch_memory=max_batch_memory,
+                    share_context_kv=share_context_kv,
+                    continuation_trie=continuation_trie,
+                    pack_requests=pack_requests,
+                    single_token_scoring=single_token_scoring,
+                    num_workers=num_workers,
+                    compile_bucket_size=compile_bucket_size,
+                    pipeline_depth=pipeline_depth,
+                    prefix_cache=prefix_cache,
+                    **options),
+                group=json.dumps(["loglikelihood", options], sort_keys=True),
+                sizes=[min(len(request[2]) + len(request[3]), truncation_length + 1) for request in requests],
+                placeholder={"sum_logits": 0.0, "num_tokens": 1, "num_tokens_all": 1, "is_greedy": False})
+
+        # identical requests, such as the unconditioned ones of instances with the same choices, run once
+        unique_index_by_key: Dict[Tuple[Tuple[int, ...], Tuple[int, ...]], int] = {}
+        unique_indices = [
+            unique_index_by_key.setdefault(
+                (tuple(cc_pair["input_ids"][0].tolist()), tuple(cc_pair["input_ids"][1].tolist())),
+                len(unique_index_by_key))
             for cc_pair in cc_pairs
-        ], dtype=torch.int)
-        ordered_indices = torch.argsort(lengths, descending=True)
+        ]
+        if len(unique_index_by_key) < len(cc_pairs):
+            unique_pairs: List[Optional[Dict]] = [None] * len(unique_index_by_key)
+            for cc_pair, unique_index in zip(cc_pairs, unique_indices):
+                unique_pairs[unique_index] = cc_pair
+            logger.info(f"Running {len(unique_pairs)} distinct of {len(cc_pairs)} log-likelihood requests, "
+                        f"saving {len(cc_pairs) - len(unique_pairs)} forward passes")
+            unique_results = self._run_loglikelihood_tokens(
+                unique_pairs, model, tokenizer, batch_size,
+                max_batch_tokens=max_batch_tokens,
+                model_max_length=model_max_length,
+                max_batch_memory=max_batch_memory,
+                share_context_kv=share_context_kv,
+                continuation_trie=continuation_trie,
+                pack_requests=pack_requests,
+                single_token_scoring=single_token_scoring,
+                full_logits=full_logits,
+                num_workers=num_workers,
+                compile_bucket_size=compile_bucket_size,
+                pipeline_depth=pipeline_depth,
+                prefix_cache=prefix_cache)
+            # callers add to the results, so every request gets its own
+            return [dict(unique_results[unique_index]) for unique_index in unique_indices]
+
+        if num_workers > 1 and len(cc_pairs) > 1:
+            if can_run_in_workers(model):
+                return run_in_workers(
+                    lambda indices: self._run_loglikelihood_tokens(
+                        [cc_pairs[i] for i in indices], model, tokenizer, batch_size,
+                        max_batch_tokens=max_batch_tokens,
+                        model_max_length=model_max_length,
+                        max_batch_memory=max_batch_memory,
+                        share_context_kv=share_context_kv,
+                        continuation_trie=continuation_trie,
+                        pack_requests=pack_requests,
+                        single_token_scoring=single_token_scoring,
+                        full_logits=full_logits,
+                        compile_bucket_size=compile_bucket_size,
+                        pipeline_depth=pipeline_depth,
+                        prefix_cache=prefix_cache),
+                    [len(cc_pair["input_ids"][0]) + len(cc_pair["input_ids"][1]) for cc_pair in cc_pairs],
+                    num_workers)
+            logger.warning("num_workers needs a model on the CPU and a platform that can fork, running in one process")
+
+        results: List[Optional[Dict]] = [None] * len(cc_pairs)
+        remaining_indices: Sequence[int] = range(len(cc_pairs))
+        if prefix_cache is not None:
+            # a long shared prefix saves more than a shared context, so it goes first
+            prefix_groups, remaining_indices = _group_by_prefix(
+                cc_pairs, remaining_indices, truncation_length, prefix_cache)
+            self._run_loglikelihood_tokens_shared_prefix(
+                prefix_groups, cc_pairs, results, model, prefix_cache, batch_size,
+                max_batch_tokens=max_batch_tokens,
+                max_batch_memory=max_batch_memory,
+                full_logits=full_logits)
+        # the next-token distribution at the end of a context scores all of its single-token continuations at once,
+        # such as "yes" and "no", or answer letters
+        single_token_groups = []
+        if single_token_scoring:
+            single_token_groups, remaining_indices = _group_by_context(
+                cc_pairs, truncation_length, remaining_indices, single_token=True)
+        if len(single_token_groups) > 0:
+            # this path runs eagerly, one batch after the other, so the stats of the other paths leave it out.
+            # single_token_scoring=False sends these requests to the paths below instead
+            eager_options = [
+                name for name, value in [("compile_bucket_size", compile_bucket_size),
+                                         ("pipeline_depth", pipeline_depth),
+                                         ("pack_requests", pack_requests)]
+                if value
+            ]
+            logger.info(
+                f"Scoring {sum(len(indices) for _, indices in single_token_groups)} single-token continuations "
+                f"of {len(single_token_groups)} contexts from one pass over each context"
+                + (f", without {', '.join(eager_options)} (turn off single_token_scoring to use them)"
+                   if eager_options else ""))
+            self._run_loglikelihood_tokens_shared_context(
+                single_token_groups, cc_pairs, results, model, batch_size,
+                max_batch_tokens=max_batch_tokens,
+                max_batch_memory=max_batch_memory,
+                full_logits=full_logits)
+        if continuation_trie:
+            # this runs each context once too, and the leading tokens its continuations share, so it goes first
+            context_groups, remaining_indices = _group_by_context(cc_pairs, truncation_length, remaining_indices)
+            self._run_loglikelihood_tokens_trie(
+                context_groups, cc_pairs, results, model, batch_size,
+                max_batch_tokens=max_batch_tokens,
+                max_batch_memory=max_batch_memory,
+                full_logits=full_logits)
+        if share_context_kv:
+            context_groups, remaining_indices = _group_by_context(cc_pairs, truncation_length, remaining_indices)
+            self._run_loglikelihood_tokens_shared_context(
+                context_groups, cc_pairs, results, model, batch_size,
+                max_batch_tokens=max_batch_tokens,
+                max_batch_memory=max_batch_memory,
+                full_logits=full_logits)
+        if pack_requests:
+            self._run_loglikelihood_tokens_packed(
+                remaining_indices, cc_pairs, results, model, truncation_length, batch_size,
+                max_batch_tokens=max_batch_tokens,
+                max_batch_memory=max_batch_memory,
+                full_logits=full_logits)
+            remaining_indices = []
+
+        # find out the order to process sequences in
+        # Use truncation_length+1 since the last token is not in the input
+        input_lengths_by_index = {
+            index: min(len(cc_pairs[index]["input_ids"][0]) + len(cc_pairs[index]["input_ids"][1]),
+                       truncation_length + 1) - 1
+            for index in remaining_indices
+        }
+        batches = make_batches(
+            list(input_lengths_by_index.values()),
+            indices=list(input_lengths_by_index.keys()),
+            batch_size=batch_size,
+            max_batch_tokens=max_batch_tokens,
+            max_batch_memory=max_batch_memory,
+            bytes_per_token=logits_bytes_per_token(model),
+            logit_lengths=None if full_logits else [
+                min(len(cc_pairs[index]["input_ids"][1]), input_length)
+                for index, input_length in input_lengths_by_index.items()
+            ])
+
+        compiled_body = None
+        if compile_bucket_size is not None and len(batches) > 0:
+            if full_logits or not _projects_hidden_states_only(model):
+                logger.warning("compile_bucket_size needs a model that projects its last hidden states, running eagerly")
+            else:
+                compiled_body = compiled_base_model(model, compile_bucket_size, truncation_length)
+
+        def prepare(batch):
+            unpadded_batch = collections.defaultdict(list)
+            input_lengths = []
+            batch_continuations = []
+            for index in batch.indices:
+                for field_name, (context_ids, continuation_ids) in cc_pairs[index].items():
+                    ids = torch.cat([context_ids, continuation_ids])
+                    # Use truncation_length+1 since the last token is not in the input
+                    if len(ids) > (truncation_length+1):
+                        ids = ids[-(truncation_length+1):]
+                    ids = ids[:-1]
+                    unpadded_batch[field_name].append(ids)
+
+                input_lengths.append(len(unpadded_batch["input_ids"][-1]))
+                batch_continuations.append(cc_pairs[index]["input_ids"][1])
+
+            padded_batch = {
+                field_name: pad_sequence(tensors, batch_first=True).to(model.device)
+                for field_name, tensors in unpadded_batch.items()
+            }
+
+            # only the positions that predict a continuation token are needed
+            rows = []
+            positions = []
+            for row, (input_length, continuation) in enumerate(zip(input_lengths, batch_continuations)):
+                rows.extend([row] * len(continuation))
+                positions.extend(range(input_length - len(continuation), input_length))
+            return batch.indices, padded_batch, rows, positions, input_lengths, batch_continuations
+
+        def run(prepared):
+            batch_of_indices, padded_batch, rows, positions, _, _ = prepared
+            requests_tqdm.update(len(batch_of_indices))
+            batch_logits, _ = _selected_log_probs(
+                model, rows, positions, full_logits, compiled_body=compiled_body, **padded_batch)
+            return batch_logits
+
+        def finish(prepared, batch_logits):
+            batch_of_indices, _, _, _, input_lengths, batch_continuations = prepared
+            batch_logits = batch_logits.split([len(c) for c in batch_continuations])
+            z = zip(batch_of_indices, batch_logits, input_lengths, batch_continuations)
+            for i, instance_logits, input_length, instance_continuation in z:
+                results[i] = _continuation_result(instance_logits, instance_continuation, input_length + 1)
 
         # actually do the processing
-        results: List[Optional[float]] = [None] * len(ordered_indices)
-        last_index = 0
         with torch.inference_mode():
-            with Tqdm.tqdm(ordered_indices, desc="Running log-likelihood queries") as ordered_indices_tqdm:
-                while last_index < len(ordered_indices):
-                    next_batch_size = batch_size
-                    if max_batch_tokens:
-                        current_length = min(lengths[ordered_indices[last_index]].item(), truncation_length)
-                        next_batch_size = min(next_batch_size, max_batch_tokens // current_length)
-                        if next_batch_size < 1:
-                            next_batch_size = 1
-                    first_index = last_index
-                    last_index = min(first_index + next_batch_size, len(ordered_indices))
-                    ordered_indices_tqdm.update(last_index - first_index)
-                    unpadded_batch = collections.defaultdict(list)
-                    input_lengths = []
-                    batch_contexts = []
-                    batch_continuations = []
-                    batch_of_indices = ordered_indices[first_index:last_index]
-                    for index in batch_of_indices:
-                        for field_name, (context_ids, continuation_ids) in cc_pairs[index].items():
-                            ids = torch.cat([context_ids, continuation_ids])
-                            # Use truncation_length+1 since the last token is not in the input
-                            if len(ids) > (truncation_length+1):
-                                ids = ids[-(truncation_length+1):]
-                            ids = ids[:-1]
-                            unpadded_batch[field_name].append(ids)
-
-                        input_lengths.append(len(unpadded_batch["input_ids"][-1]))
-                        batch_contexts.append(cc_pairs[index]["input_ids"][0])
-                        batch_continuations.append(cc_pairs[index]["input_ids"][1])
-
-                    padded_batch = {
-                        field_name: pad_sequence(tensors, batch_first=True).to(model.device)
-                        for field_name, tensors in unpadded_batch.items()
-                    }
-
-                    batch_logits = log_softmax(model(**padded_batch)[0], dim=-1)
-                    z = zip(batch_of_indices, batch_logits, input_lengths, batch_contexts, batch_continuations)
-                    for i, instance_logits, input_length, instance_context, instance_continuation in z:
-                        instance_logits = instance_logits[input_length-len(instance_continuation):input_length]
-                        instance_logits = torch.gather(instance_logits, 1, instance_continuation.unsqueeze(-1).to(model.device))
-                        greedy_tokens = instance_logits.argmax(dim=-1)
-                        is_greedy = bool((greedy_tokens == instance_continuation.unsqueeze(0).to(model.device)).all())
-                        results[i] = {"sum_logits": float(instance_logits.sum()), "num_tokens": len(instance_continuation),
-                                     "num_tokens_all": input_length + 1, "is_greedy": is_greedy}
-        del lengths
+            with request_progress(total=len(input_lengths_by_index), desc="Running log-likelihood queries") as requests_tqdm:
+                pipeline_stats = run_pipelined(batches, prepare, run, finish, depth=pipeline_depth)
+        if len(batches) > 0:
+            log_pipeline_stats(pipeline_stats)
+        if compiled_body is not None:
+            stats = compiled_body.stats()
+            # over all calls so far, compiling is paid once per shape
+            logger.info(
+                f"torch.compile: {stats['num_shapes']} shapes compiled in {stats['compile_seconds']:.1f}s, then "
+                f"{stats['compiled_calls']} compiled batches at {stats['compiled_tokens_per_second'] or 0:.0f} tokens/s, "
+                f"{stats['eager_calls']} eager batches at {stats['eager_tokens_per_second'] or 0:.0f} tokens/s")
         assert None not in results
         return results
 
+    def _run_loglikelihood_tokens_shared_context(
+        self,
+        context_groups: Sequence[Tuple[torch.Tensor, List[int]]],
+        cc_pairs: Sequence[Dict[str, Tuple[torch.Tensor, torch.Tensor]]],
+        results: List[Optional[Dict]],
+        model: _Model,
+        batch_size: int = 32,
+        max_batch_tokens: int = None,
+        max_batch_memory: Optional[int] = None,
+        full_logits: bool = False,
+    ) -> None:
+        """
+        Scores groups of requests that share the same context. Every distinct context is run through the
+        model once, and all of its continuations are then scored in a batch against the cached
+        `past_key_values` of that context. Continuations of a single token are scored by the context alone,
+        so batches of contexts that only have those keep no cache. Results are written into `results` in place.
+        """
+        bytes_per_token = logits_bytes_per_token(model)
+        context_batches = make_batches(
+            [len(context) for context, _ in context_groups],
+            batch_size=batch_size,
+            max_batch_tokens=max_batch_tokens,
+            max_batch_memory=max_batch_memory,
+            bytes_per_token=bytes_per_token,
+            logit_lengths=None if full_logits else [1] * len(context_groups))
+        with torch.inference_mode():
+            with request_progress(
+                total=sum(len(indices) for _, indices in context_groups),
+                desc="Running shared-context log-likelihood queries"
+            ) as requests_tqdm:
+                for context_batch in context_batches:
+                    batch_of_groups = [context_groups[i] for i in context_batch.indices]
+
+                    # run the contexts once, keeping their caches
+                    contexts = [context for context, _ in batch_of_groups]
+                    context_lengths = torch.tensor(context_batch.lengths, dtype=torch.long)
+                    context_ids = pad_sequence(contexts, batch_first=True).to(model.device)
+                    context_mask = (torch.arange(context_ids.shape[1])[None, :] < context_lengths[:, None]).long()
+                    needs_cache = any(
+                        len(cc_pairs[index]["input_ids"][1]) > 1 for _, indices in batch_of_groups for index in indices)
+                    # the distribution over the first token of every continuation
+                    first_token_logits, context_output = _selected_log_probs(
+                        model, range(len(contexts)), context_lengths - 1, full_logits,
+                        input_ids=context_ids,
+                        attention_mask=context_mask.to(model.device),
+                        use_cache=needs_cache)
+                    past_key_values = context_output.past_key_values if needs_cache else None
+                    del context_output
+
+                    # score the continuations against the cache, longest first
+                    continuation_rows = [
+                        (row, index)
+                        for row, (_, indices) in enumerate(batch_of_groups)
+                        for index in indices
+                    ]
+                    max_context_length = context_batch.max_length
+                    continuation_batches = make_batches(
+                        [max_context_length + len(cc_pairs[index]["input_ids"][1]) - 1 for _, index in continuation_rows],
+                        batch_size=batch_size,
+                        max_batch_tokens=max_batch_tokens,
+                        max_batch_memory=max_batch_memory,
+                        bytes_per_token=bytes_per_token,
+                        logit_lengths=None if full_logits else [
+                            len(cc_pairs[index]["input_ids"][1]) - 1 for _, index in continuation_rows])
+                    for continuation_batch in continuation_batches:
+                        batch_rows = [continuation_rows[i] for i in continuation_batch.indices]
+                        requests_tqdm.update(len(batch_rows))
+
+                        rows = torch.tensor([row for row, _ in batch_rows], dtype=torch.long)
+                        continuations = [cc_pairs[index]["input_ids"][1] for _, index in batch_rows]
+                        # the last token of a continuation is only ever predicted, never an input
+                        continuation_inputs = [continuation[:-1] for continuation in continuations]
+                        max_input_length = max(len(c) for c in continuation_inputs)
+                        if max_input_length > 0:
+                            input_lengths = torch.tensor([len(c) for c in continuation_inputs], dtype=torch.long)
+                            input_ids = pad_sequence(continuation_inputs, batch_first=True)
+                            input_mask = (torch.arange(max_input_length)[None, :] < input_lengths[:, None]).long()
+                            position_ids = context_lengths[rows][:, None] + torch.arange(max_input_length)[None, :]
+                            continuation_logits, _ = _selected_log_probs(
+                                model,
+                                [row_index for row_index, c in enumerate(continuation_inputs) for _ in range(len(c))],
+                                [position for c in continuation_inputs for position in range(len(c))],
+                                full_logits,
+                                input_ids=input_ids.to(model.device),
+                                attention_mask=torch.cat([context_mask[rows], input_mask], dim=1).to(model.device),
+                                position_ids=position_ids.to(model.device),
+                                past_key_values=_select_past_key_values(past_key_values, rows),
+                                # newer versions of transformers ignore a legacy tuple cache unless use_cache is set
+                                use_cache=True)
+                            continuation_logits = continuation_logits.split([len(c) for c in continuation_inputs])
+                        for row_index, ((row, index), continuation) in enumerate(zip(batch_rows, continuations)):
+                            instance_logits = first_token_logits[row].unsqueeze(0)
+                            if len(continuation) > 1:
+                                instance_logits = torch.cat([instance_logits, continuation_logits[row_index]])
+                            results[index] = _continuation_result(
+                                instance_logits, continuation, int(context_lengths[row]) + len(continuation))
+                    del past_key_values
+
+    def _run_loglikelihood_tokens_trie(
+        self,
+        context_groups: Sequence[Tuple[torch.Tensor, List[int]]],
+        cc_pairs: Sequence[Dict[str, Tuple[torch.Tensor, torch.Tensor]]],
+        results: List[Optional[Dict]],
+        model: _Model,
+        batch_size: int = 32,
+        max_batch_tokens: int = None,
+        max_batch_memory: Optional[int] = None,
+        full_logits: bool = False,
+    ) -> None:
+        """
+        Scores groups of requests that share the same context, each group in one row: the context, followed by
+        a token trie of its continuations, so that the context and the leading tokens that continuations have in
+        common, such as "the cat" in "the cat sat" and "the cat ran", are run once. A tree attention mask lets
+        every trie node attend to the context and to the nodes on its own path, and its position is the context
+        length plus its depth. This needs a model that accepts a 4D attention mask (for GPT-2, transformers 4.52
+        or newer). `batch_size` and the budgets count rows, not requests. Results are written into `results`
+        in place.
+        """
+        tries = [
+            _continuation_trie([cc_pairs[index]["input_ids"][1] for index in indices])
+            for _, indices in context_groups
+        ]
+        row_batches = make_batches(
+            [len(context) + len(trie[0]) for (context, _), trie in zip(context_groups, tries)],
+            batch_size=batch_size,
+            max_batch_tokens=max_batch_tokens,
+            max_batch_memory=max_batch_memory,
+            bytes_per_token=logits_bytes_per_token(model),
+            # the last context position and the trie nodes
+            logit_lengths=None if full_logits else [len(trie[0]) + 1 for trie in tries])
+
+        with torch.inference_mode():
+            with request_progress(
+                total=sum(len(indices) for _, indices in context_groups),
+                desc="Running continuation trie log-likelihood queries"
+            ) as requests_tqdm:
+                for row_batch in row_batches:
+                    row_length = row_batch.max_length
+                    input_ids = torch.zeros(len(row_batch), row_length, dtype=torch.long)
+                    position_ids = torch.zeros(len(row_batch), row_length, dtype=torch.long)
+                    # padding only attends to itself
+                    allowed = torch.eye(row_length, dtype=torch.bool).repeat(len(row_batch), 1, 1)
+                    selected_rows = []
+                    selected_positions = []
+                    for row_number, group_index in enumerate(row_batch.indices):
+                        context, indices = context_groups[group_index]
+                        token_ids, parents, depths, paths = tries[group_index]
+                        context_length = len(context)
+                        row_end = context_length + len(token_ids)
+                        input_ids[row_number, :context_length] = context
+                        input_ids[row_number, context_length:row_end] = torch.tensor(token_ids, dtype=torch.long)
+                        position_ids[row_number, :context_length] = torch.arange(context_length)
+                        position_ids[row_number, context_length:row_end] = \
+                            context_length + torch.tensor(depths, dtype=torch.long)
+                        allowed[row_number, :context_length, :context_length] = \
+                            torch.ones(context_length, context_length, dtype=torch.bool).tril()
+                        allowed[row_number, context_length:row_end, :context_length] = True
+                        # parents come before their children, so a node sees its parent's path and itself
+                        for node, parent in enumerate(parents):
+                            if parent >= 0:
+                                allowed[row_number, context_length + node, context_length:row_end] = \
+                                    allowed[row_number, context_length + parent, context_length:row_end]
+                            allowed[row_number, context_length + node, context_length + node] = True
+                        # the first token is predicted by the context, every other one by the node before it
+                        for path in paths:
+                            selected_rows.extend([row_number] * (len(path) + 1))
+                            selected_positions.append(context_length - 1)
+                            selected_positions.extend(context_length + node for node in path)
+                    requests_tqdm.update(sum(len(context_groups[i][1]) for i in row_batch.indices))
+
+                    batch_logits, _ = _selected_log_probs(
+                        model, selected_rows, selected_positions, full_logits,
+                        input_ids=input_ids.to(model.device),
+                        attention_mask=_additive_attention_mask(allowed, model.dtype).to(model.device),
+                        position_ids=position_ids.to(model.device))
+                    continuations = [
+                        cc_pairs[index]["input_ids"][1]
+                        for group_index in row_batch.indices
+                        for index in context_groups[group_index][1]
+                    ]
+                    batch_logits = iter(batch_logits.split([len(continuation) for continuation in continuations]))
+                    for group_index in row_batch.indices:
+                        context, indices = context_groups[group_index]
+                        for index in indices:
+                            continuation = cc_pairs[index]["input_ids"][1]
+                            results[index] = _continuation_result(
+                                next(batch_logits), continuation, len(context) + len(continuation))
+
+    def _run_loglikelihood_tokens_shared_prefix(
+        self,
+        prefix_groups: Sequence[Tuple[Tuple[int, ...], List[int]]],
+        cc_pairs: Sequence[Dict[str, Tuple[torch.Tensor, torch.Tensor]]],
+        results: List[Optional[Dict]],
+        model: _Model,
+        prefix_cache: PrefixCache,
+        batch_size: int = 32,
+        max_batch_tokens: int = None,
+        max_batch_memory: Optional[int] = None,
+        full_logits: bool = False,
+    ) -> None:
+        """
+        Scores groups of requests whose contexts start with the same prefix. The `past_key_values` of every
+        prefix come from `prefix_cache`, or are computed once and put there, and the rest of every request is
+        run in batches on top of them. Inside a group, requests that share a much longer context than the prefix,
+        such as the choices of one instance, or the same instance with more and more nested few-shot examples,
+        run on top of that context, which is computed from the context before it, in order, so that every token
+        they have in common is run once. Results are written into `results` in place.
+        """
+        with torch.inference_mode():
+            with request_progress(
+                total=sum(len(indices) for _, indices in prefix_groups),
+                desc="Running shared-prefix log-likelihood queries"
+            ) as requests_tqdm:
+                for prefix, indices in prefix_groups:
+                    prefix_length = len(prefix)
+                    past_key_values = prefix_cache.get(prefix)
+                    prefix_cache.record(prefix_length, len(indices), hit=past_key_values is not None)
+                    if past_key_values is None:
+                        past_key_values = _extend_past_key_values(model, None, prefix, 0, full_logits)
+                        prefix_cache.put(prefix, past_key_values)
+
+                    direct_indices, context_groups = _group_by_longer_context(
+                        cc_pairs, indices, prefix_length, prefix_cache.min_prefix_tokens)
+                    self._run_loglikelihood_tokens_on_prefix(
+                        direct_indices, cc_pairs, results, model, past_key_values, prefix_length, requests_tqdm,
+                        batch_size, max_batch_tokens, max_batch_memory, full_logits)
+                    previous_context, previous_past_key_values = prefix, past_key_values
+                    for context, context_indices in context_groups:
+                        shared_length = _common_prefix_length(previous_context, context)
+                        context_past_key_values = _extend_past_key_values(
+                            model,
+                            _truncate_past_key_values(previous_past_key_values, shared_length),
+                            context,
+                            shared_length,
+                            full_logits)
+                        prefix_cache.record_extension(
+                            len(context) - prefix_length, len(context) - shared_length, len(context_indices))
+                        self._run_loglikelihood_tokens_on_prefix(
+                            context_indices, cc_pairs, results, model, context_past_key_values, len(context),
+                            requests_tqdm, batch_size, max_batch_tokens, max_batch_memory, full_logits)
+                        previous_context, previous_past_key_values = context, context_past_key_values
+                    del past_key_values, previous_past_key_values
+        logger.info(
+            "Prefix cache: scored %d requests on %d prefixes, totals so far %s",
+            sum(len(indices) for _, indices in prefix_groups), len(prefix_groups), prefix_cache.stats())
+
+    @staticmethod
+    def _run_loglikelihood_tokens_on_prefix(
+        indices: Sequence[int],
+        cc_pairs: Sequence[Dict[str, Tuple[torch.Tensor, torch.Tensor]]],
+        results: List[Optional[Dict]],
+        model: _Model,
+        past_key_values: Any,
+        prefix_length: int,
+        requests_tqdm: Any,
+        batch_size: int = 32,
+        max_batch_tokens: int = None,
+        max_batch_memory: Optional[int] = None,
+        full_logits: bool = False,
+    ) -> None:
+        """Runs the rest of the given requests, after their first `prefix_length` tokens, on `past_key_values`."""
+        # everything after the prefix, but the last token, which is only ever predicted
+        suffixes = [
+            torch.cat([cc_pairs[index]["input_ids"][0][prefix_length:], cc_pairs[index]["input_ids"][1][:-1]])
+            for index in indices
+        ]
+        suffix_batches = make_batches(
+            [prefix_length + len(suffix) for suffix in suffixes],
+            batch_size=batch_size,
+            max_batch_tokens=max_batch_tokens,
+            max_batch_memory=max_batch_memory,
+            bytes_per_token=logits_bytes_per_token(model),
+            logit_lengths=None if full_logits else [len(cc_pairs[index]["input_ids"][1]) for index in indices])
+        for suffix_batch in suffix_batches:
+            requests_tqdm.update(len(suffix_batch))
+            batch_suffixes = [suffixes[i] for i in suffix_batch.indices]
+            continuations = [cc_pairs[indices[i]]["input_ids"][1] for i in suffix_batch.indices]
+            input_lengths = torch.tensor([len(suffix) for suffix in batch_suffixes], dtype=torch.long)
+            input_ids = pad_sequence(batch_suffixes, batch_first=True)
+            max_input_length = input_ids.shape[1]
+            input_mask = (torch.arange(max_input_length)[None, :] < input_lengths[:, None]).long()
+            rows = torch.zeros(len(batch_suffixes), dtype=torch.long)
+            continuation_logits, _ = _selected_log_probs(
+                model,
+                [row for row, continuation in enumerate(continuations) for _ in range(len(continuation))],
+                [
+                    position
+                    for suffix, continuation in zip(batch_suffixes, continuations)
+                    for position in range(len(suffix) - len(continuation), len(suffix))
+                ],
+                full_logits,
+                input_ids=input_ids.to(model.device),
+                attention_mask=torch.cat(
+                    [torch.ones(len(batch_suffixes), prefix_length, dtype=torch.long), input_mask],
+                    dim=1).to(model.device),
+                position_ids=(prefix_length + torch.arange(max_input_length)).expand(
+                    len(batch_suffixes), -1).to(model.device),
+                past_key_values=_select_past_key_values(past_key_values, rows),
+                use_cache=True)
+            continuation_logits = continuation_logits.split([len(c) for c in continuations])
+            for i, instance_logits, continuation in zip(suffix_batch.indices, continuation_logits, continuations):
+                results[indices[i]] = _continuation_result(
+                    instance_logits, continuation, len(cc_pairs[indices[i]]["input_ids"][0]) + len(continuation))
+
+    def _run_loglikelihood_tokens_packed(
+        self,
+        indices: Sequence[int],
+        cc_pairs: Sequence[Dict[str, Tuple[torch.Tensor, torch.Tensor]]],
+        results: List[Optional[Dict]],
+        model: _Model,
+        truncation_length: int,
+        batch_size: int = 32,
+        max_batch_tokens: int = None,
+        max_batch_memory: Optional[int] = None,
+        full_logits: bool = False,
+    ) -> None:
+        """
+        Scores requests by packing several of them into each row. Rows are as long as the longest request, so
+        the quadratic cost of attention does not grow beyond that of the padded batches. This only helps when
+        the lengths are long-tailed, with many short requests that fill the rows next to the long ones; with
+        similar lengths, sorted padded batches waste little and packing has nothing to fill. Every request gets
+        its own `position_ids` starting at zero, and a block-diagonal causal attention mask keeps it from
+        attending to the other requests in the same row. This needs a model that accepts a 4D attention mask
+        (for GPT-2, transformers 4.52 or newer). `batch_size` and the budgets count rows, not requests. Results
+        are written into `results` in place.
+        """
+        # Use truncation_length+1 since the last token is not in the input
+        input_ids_by_index = {}
+        for index in indices:
+            ids = torch.cat(cc_pairs[index]["input_ids"])
+            input_ids_by_index[index] = ids[-(truncation_length + 1):][:-1]
+        lengths = [len(ids) for ids in input_ids_by_index.values()]
+        rows = make_packed_rows(
+            lengths,
+            indices=list(input_ids_by_index.keys()),
+            max_length=max(lengths, default=0))
+        row_batches = make_batches(
+            [row.num_tokens for row in rows],
+            batch_size=batch_size,
+            max_batch_tokens=max_batch_tokens,
+            max_batch_memory=max_batch_memory,
+            bytes_per_token=logits_bytes_per_token(model),
+            logit_lengths=None if full_logits else [
+                sum(min(len(cc_pairs[index]["input_ids"][1]), length)
+                    for index, length in zip(row.indices, row.lengths))
+                for row in rows
+            ])
+
+        with torch.inference_mode():
+            with request_progress(total=len(input_ids_by_index), desc="Running packed log-likelihood queries") as requests_tqdm:
+                for row_batch in row_batches:
+                    batch_rows = [rows[i] for i in row_batch.indices]
+                    requests_tqdm.update(sum(len(row) for row in batch_rows))
+                    row_length = row_batch.max_length
+                    input_ids = torch.zeros(len(batch_rows), row_length, dtype=torch.long)
+                    position_ids = torch.zeros(len(batch_rows), row_length, dtype=torch.long)
+                    # Padding gets segment -1, so it only attends to itself and nothing attends to it.
+                    segment_ids = torch.full((len(batch_rows), row_length), -1, dtype=torch.long)
+                    for row_number, row in enumerate(batch_rows):
+                        offset = 0
+                        for segment, (index, length) in enumerate(zip(row.indices, row.lengths)):
+                            input_ids[row_number, offset:offset + length] = input_ids_by_index[index]
+                            position_ids[row_number, offset:offset + length] = torch.arange(length)
+                            segment_ids[row_number, offset:offset + length] = segment
+                            offset += length
+                    attention_mask = _packed_attention_mask(segment_ids, model.dtype)
+
+                    selected_rows = []
+                    selected_positions = []
+                    for row_number, row in enumerate(batch_rows):
+                        offset = 0
+                        for index, length in zip(row.indices, row.lengths):
+                            offset += length
+                            continuation = cc_pairs[index]["input_ids"][1]
+                            selected_rows.extend([row_number] * len(continuation))
+                            selected_positions.extend(range(offset - len(continuation), offset))
+                    batch_logits, _ = _selected_log_probs(
+                        model, selected_rows, selected_positions, full_logits,
+                        input_ids=input_ids.to(model.device),
+                        attention_mask=attention_mask.to(model.device),
+                        position_ids=position_ids.to(model.device))
+                    batch_logits = iter(batch_logits.split(
+                        [len(cc_pairs[index]["input_ids"][1]) for row in batch_rows for index in row.indices]))
+                    for row in batch_rows:
+                        for index, length in zip(row.indices, row.lengths):
+                            results[index] = _continuation_result(
+                                next(batch_logits), cc_pairs[index]["input_ids"][1], length + 1)
+
     def _run_greedy_until(
         self,
         requests,
@@ -501,45 +1536,425 @@ class DecoderOnlyLanguageModel(LanguageModel):
         assert model_max_length is not None
         assert model_max_length > max_gen_toks
 
-        results = []
-        for tokenized_context, untils in Tqdm.tqdm(
-            zip(tokenized_contexts, untils_per_instance),
-            desc="Running greedy_until queries",
-            total=len(tokenized_contexts),
-        ):
-            # there can be multiple stop phrases with multiple tokens
-            if isinstance(untils, str):
-                untils = [untils]
-            # if any of the stop phrases are single tokens we can use that for early termination
-            primary_until = None
-            for tokenized_until in tokenizer(untils)["input_ids"]:
-                if len(tokenized_until) == 1:
-                    primary_until = tokenized_until[0]
-
-            # truncate from left if no room for generation
-            context_tensor = torch.tensor(
-                [
-                    tokenized_context[max_gen_toks - model_max_length :]
-                ]
-            ).to(model.device)
-
-            full_text_tensor = model.generate(
-                context_tensor,
-                max_length=context_tensor.shape[1] + max_gen_toks,
-                eos_token_id=primary_until,
-                do_sample=False,
-                pad_token_id=primary_until, # temporary hack to suppress irrelevant warning until batch processing is added
-            )
-            continuation_tensor = full_text_tensor[0, context_tensor.shape[1] :]
-            continuation = tokenizer.decode(continuation_tensor.tolist())
-            raw_continuation = continuation
-            # truncate by all the additional until phrases
-            for term in untils:
-                continuation = continuation.split(term)[0]
-            results.append({"text": continuation, "raw_text": raw_continuation,
-                            "num_input_tokens": context_tensor.shape[1],
-                            "num_generated_tokens": len(continuation_tensor)})
+        # truncate from left if no room for generation
+        tokenized_contexts = [context[max_gen_toks - model_max_length:] for context in tokenized_contexts]
 
-        return results
+        options = {
+            "max_gen_toks": max_gen_toks,
+            "batch_size": kwargs.get("batch_size", 32),
+            "max_batch_tokens": kwargs.get("max_batch_tokens"),
+        }
+
+        num_workers = kwargs.get("num_workers", 1)
+
+        def run_greedy_until(items: Sequence[Tuple[List[int], Any]]) -> List[Dict[str, Any]]:
+            def run_items(indices: Sequence[int]) -> List[Dict[str, Any]]:
+                return greedy_until(
+                    model,
+                    tokenizer,
+                    [items[i][0] for i in indices],
+                    [items[i][1] for i in indices],
+                    **options)
+
+            if num_workers > 1 and len(items) > 1 and can_run_in_workers(model):
+                return run_in_workers(run_items, [len(context) + max_gen_toks for context, _ in items], num_workers)
+            return run_items(range(len(items)))
+
+        items = list(zip(tokenized_contexts, untils_per_instance))
+        request_cache = kwargs.get("request_cache")
+        if request_cache is None:
+            return run_greedy_until(items)
+        requests = [
+            ["greedy_until", max_gen_toks, context, [untils] if isinstance(untils, str) else list(untils)]
+            for context, untils in items
+        ]
+        return request_cache.get_or_compute(
+            model_identity(self, model, tokenizer),
+            requests,
+            items,
+            run_greedy_until,
+            group=json.dumps(["greedy_until", {"max_gen_toks": max_gen_toks}], sort_keys=True),
+            sizes=[len(context) + max_gen_toks for context in tokenized_contexts],
+            placeholder={"text": "", "raw_text": "", "num_input_tokens": 0, "num_generated_tokens": 0})
+
+
+def _rolling_window_sizes(
+    tokenizer: _Tokenizer,
+    model_max_length: Optional[int] = None,
+    perplexity_stride: Optional[int] = None
+) -> Tuple[int, Optional[int]]:
+    """The length of the rolling windows, and the number of tokens every window scores."""
+    truncation_length = tokenizer.model_max_length
+    if model_max_length:
+        truncation_length = min(truncation_length, model_max_length)
+    if perplexity_stride is not None and perplexity_stride < 1:
+        raise ValueError(f"perplexity_stride must be at least 1, got {perplexity_stride}")
+    stride = None if perplexity_stride is None else min(perplexity_stride, truncation_length)
+    return truncation_length, stride
+
+
+def _rolling_windows(
+    token_ids: torch.Tensor,
+    prefix_token: int,
+    max_seq_len: int,
+    stride: Optional[int] = None
+) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+    """
+    The disjoint (context, continuation) windows that score every token of a document once, the same as
+    `make_disjoint_window` over `get_rolling_token_windows`, but sliced from the tensor instead of built
+    from Python lists.
+
+    Every window after the first scores the next `stride` tokens, with up to `max_seq_len - stride` tokens
+    before them as unscored context. Without a `stride` the windows do not overlap, so they only get a
+    single token of context.
+    """
+    context_len = 1 if stride is None else max_seq_len - stride + 1
+    window_ends, window_pred_lens = rolling_token_window_ends(len(token_ids), max_seq_len, context_len)
+    for i, (window_end, window_pred_len) in enumerate(zip(window_ends.tolist(), window_pred_lens.tolist())):
+        if i == 0:
+            yield torch.tensor([prefix_token], dtype=torch.long), token_ids[:window_end]
+        else:
+            yield token_ids[window_end - max_seq_len - 1:window_end - window_pred_len], \
+                token_ids[window_end - window_pred_len:window_end]
+
+
+def _continuation_result(
+    instance_logits: torch.Tensor,
+    continuation: torch.Tensor,
+    num_tokens_all: int
+) -> Dict[str, Any]:
+    """
+    Turns the log-probabilities at the positions that predict a continuation into the result dict
+    used by the loglikelihood requests.
+    """
+    continuation = continuation.to(instance_logits.device)
+    greedy_tokens = instance_logits.argmax(dim=-1)
+    is_greedy = bool((greedy_tokens == continuation).all())
+    instance_logits = torch.gather(instance_logits, 1, continuation.unsqueeze(-1))
+    return {"sum_logits": float(instance_logits.sum()), "num_tokens": len(continuation),
+            "num_tokens_all": num_tokens_all, "is_greedy": is_greedy}
+
+
+def _rank_classification_prediction(
+    results: Sequence[Dict[str, Any]],
+    num_chars: Sequence[int],
+    correct_choice: Any,
+    has_unconditioned: bool = False,
+    model_input: Optional[List[Tuple[str, str]]] = None,
+    unconditioned_input: Optional[List[Tuple[str, str]]] = None
+) -> Dict[str, Any]:
+    """
+    Puts the results of the requests of a rank classification instance, its choices followed by the same
+    choices with the unconditioned prompt if it has them, together into its prediction.
+    """
+    results = [dict(result, num_chars=result_num_chars) for result, result_num_chars in zip(results, num_chars)]
+    num_choices = len(results) // 2 if has_unconditioned else len(results)
+    model_output = results[:num_choices]
+    for result, unconditioned_result in zip(model_output, results[num_choices:]):
+        result['sum_logits_uncond'] = unconditioned_result['sum_logits']
+    res = {"model_output": model_output, "correct_choice": correct_choice}
+    if model_input is not None:
+        res["model_input"] = model_input
+    if unconditioned_input is not None:
+        res["unconditioned_input"] = unconditioned_input
+    return res
+
+
+def _sum_window_results(window_results: Sequence[Dict[str, Any]]) -> Dict[str, Any]:
+    """Sums the results of the rolling windows of a document into the result of the document."""
+    result = {"sum_logits": 0, "num_tokens": 0, "num_tokens_all": 0, "is_greedy": True}
+    for window_result in window_results:
+        result["sum_logits"] += window_result["sum_logits"]
+        result["num_tokens"] += window_result["num_tokens"]
+        result["num_tokens_all"] += window_result["num_tokens_all"]
+        result["is_greedy"] = result["is_greedy"] and window_result["is_greedy"]
+    return result
+
+
+def _perplexity_prediction(
+    window_results: Sequence[Dict[str, Any]],
+    stats: Dict[str, int],
+    model_input: Optional[List[List[str]]] = None
+) -> Dict[str, Any]:
+    result = _sum_window_results(window_results)
+    model_output = {key: result[key] for key in ["sum_logits", "num_tokens", "num_tokens_all"]}
+    model_output.update(stats)
+    res = {"model_output": model_output}
+    if model_input is not None:
+        res["model_input"] = model_input
+    return res
+
+
+def _group_by_context(
+    cc_pairs: Sequence[Dict[str, Tuple[torch.Tensor, torch.Tensor]]],
+    truncation_length: int,
+    indices: Optional[Sequence[int]] = None,
+    single_token: bool = False
+) -> Tuple[List[Tuple[torch.Tensor, List[int]]], List[int]]:
+    """
+    Groups the requests, or the ones at `indices`, by identical context token ids. Returns the groups that can
+    share a context cache, and the indices of all the other requests. Requests that would need truncation,
+    and contexts that only appear once, are not worth sharing. With `single_token`, only the requests whose
+    continuation is a single token are grouped, the others are left for another path.
+    """
+    groups: Dict[Tuple[int, ...], List[int]] = collections.defaultdict(list)
+    remaining_indices = []
+    for index in range(len(cc_pairs)) if indices is None else indices:
+        context_ids, continuation_ids = cc_pairs[index]["input_ids"]
+        if len(context_ids) + len(continuation_ids) - 1 > truncation_length or len(continuation_ids) == 0 or \
+                (single_token and len(continuation_ids) != 1):
+            remaining_indices.append(index)
+        else:
+            groups[tuple(context_ids.tolist())].append(index)
+    context_groups = []
+    for context, indices in groups.items():
+        if len(indices) > 1:
+            context_groups.append((torch.tensor(context, dtype=torch.long), indices))
+        else:
+            remaining_indices.extend(indices)
+    return context_groups, sorted(remaining_indices)
+
+
+def _group_by_prefix(
+    cc_pairs: Sequence[Dict[str, Tuple[torch.Tensor, torch.Tensor]]],
+    indices: Sequence[int],
+    truncation_length: int,
+    prefix_cache: PrefixCache
+) -> Tuple[List[Tuple[Tuple[int, ...], List[int]]], List[int]]:
+    """
+    Groups the requests whose contexts start with the same prefix of at least `prefix_cache.min_prefix_tokens`
+    tokens, which ends before the position that predicts the first continuation token. A request joins the
+    longest prefix in `prefix_cache` that it starts with, if there is one. The others are sorted by their
+    contexts, and runs of neighbours are grouped by the prefix they all share. Returns the groups, and the
+    indices of all the other requests. Requests that would need truncation are not grouped.
+    """
+    cached_prefixes = sorted(prefix_cache.prefixes(), key=len, reverse=True)
+    groups: Dict[Tuple[int, ...], List[int]] = collections.defaultdict(list)
+    remaining_indices = []
+    candidates = []
+    for index in indices:
+        context_ids, continuation_ids = cc_pairs[index]["input_ids"]
+        max_prefix_length = len(context_ids) - 1
+        if len(context_ids) + len(continuation_ids) - 1 > truncation_length or len(continuation_ids) == 0 or \
+                max_prefix_length < prefix_cache.min_prefix_tokens:
+            remaining_indices.append(index)
+            continue
+        context = tuple(context_ids.tolist())
+        for prefix in cached_prefixes:
+            if len(prefix) <= max_prefix_length and context[:len(prefix)] == prefix:
+                groups[prefix].append(index)
+                break
+        else:
+            candidates.append((context, max_prefix_length, index))
+
+    candidates.sort()
+    run: List[Tuple[Tuple[int, ...], int, int]] = []
+    run_prefix_length = 0
+    for candidate in candidates + [None]:
+        if candidate is not None and len(run) > 0:
+            prefix_length = min(
+                run_prefix_length, candidate[1], _common_prefix_length(run[-1][0], candidate[0]))
+            if prefix_length >= prefix_cache.min_prefix_tokens:
+                run.append(candidate)
+                run_prefix_length = prefix_length
+                continue
+        if len(run) > 1:
+            groups[run[0][0][:run_prefix_length]].extend(index for _, _, index in run)
+        else:
+            remaining_indices.extend(index for _, _, index in run)
+        if candidate is not None:
+            run = [candidate]
+            run_prefix_length = candidate[1]
+    return list(groups.items()), sorted(remaining_indices)
+
+
+def _group_by_longer_context(
+    cc_pairs: Sequence[Dict[str, Tuple[torch.Tensor, torch.Tensor]]],
+    indices: Sequence[int],
+    prefix_length: int,
+    min_prefix_tokens: int
+) -> Tuple[List[int], List[Tuple[Tuple[int, ...], List[int]]]]:
+    """
+    Splits a group of requests that share a prefix of `prefix_length` tokens into the requests that run right
+    on top of the prefix, and groups of requests with the same context, without its last token, that is at
+    least `min_prefix_tokens` longer than the prefix, and that is worth running once: because more than one
+    request has it, or because it shares that many more tokens with a neighbouring context. The groups are
+    sorted by context, so every context shares the most with the one before it.
+    """
+    by_context: Dict[Tuple[int, ...], List[int]] = collections.defaultdict(list)
+    direct_indices = []
+    for index in indices:
+        context_ids = cc_pairs[index]["input_ids"][0]
+        if len(context_ids) - 1 - prefix_length < min_prefix_tokens:
+            direct_indices.append(index)
+        else:
+            by_context[tuple(context_ids[:-1].tolist())].append(index)
+    contexts = sorted(by_context.keys())
+    shared_with_next = [
+        _common_prefix_length(context, next_context) - prefix_length
+        for context, next_context in zip(contexts, contexts[1:])
+    ]
+    context_groups = []
+    for i, context in enumerate(contexts):
+        shared = max(shared_with_next[i - 1] if i > 0 else 0, shared_with_next[i] if i < len(shared_with_next) else 0)
+        if len(by_context[context]) > 1 or shared >= min_prefix_tokens:
+            context_groups.append((context, by_context[context]))
+        else:
+            direct_indices.extend(by_context[context])
+    return sorted(direct_indices), context_groups
+
+
+def _common_prefix_length(a: Sequence[int], b: Sequence[int]) -> int:
+    length = min(len(a), len(b))
+    mismatches = (torch.tensor(a[:length]) != torch.tensor(b[:length])).nonzero()
+    return int(mismatches[0]) if len(mismatches) > 0 else length
+
+
+def _selected_log_probs(
+    model: _Model,
+    rows: Sequence[int],
+    positions: Sequence[int],
+    full_logits: bool = False,
+    compiled_body: Optional[BucketedCompiledModule] = None,
+    **model_inputs
+) -> Tuple[torch.Tensor, Any]:
+    """
+    Runs the model and returns the log-probabilities over the vocabulary at the given `(row, position)` pairs
+    only, as a `[len(rows), vocab]` float32 tensor, together with the model output.
+
+    Unless `full_logits` is set, this runs the model body, and projects only the selected hidden states
+    through the LM head, so the `[batch, seq, vocab]` logits are never materialized. Models whose logits
+    are not just the LM head applied to the last hidden state always take the full path. If `compiled_body` is
+    given, it runs the model body instead of `model.base_model`.
+    """
+    rows = torch.as_tensor(rows, dtype=torch.long)
+    positions = torch.as_tensor(positions, dtype=torch.long)
+    if full_logits or not _projects_hidden_states_only(model):
+        output = model(**model_inputs)
+        logits = output.logits[rows.to(output.logits.device), positions.to(output.logits.device)]
+    else:
+        output = (model.base_model if compiled_body is None else compiled_body)(**model_inputs)
+        hidden_states = output.last_hidden_state
+        hidden_states = hidden_states[rows.to(hidden_states.device), positions.to(hidden_states.device)]
+        logits = model.get_output_embeddings()(hidden_states)
+    # models that run in bfloat16 or float16 still score in float32
+    return log_softmax(logits.float(), dim=-1), output
+
+
+def _projects_hidden_states_only(model: _Model) -> bool:
+    """
+    Whether the model's logits are its output embeddings applied to the last hidden state of its base
+    model, with nothing else in between, such as logit scaling or soft-capping.
+    """
+    if getattr(model, "base_model", model) is model:
+        return False
+    if not hasattr(model, "get_output_embeddings") or model.get_output_embeddings() is None:
+        return False
+    config = getattr(model, "config", None)
+    for name in ["final_logit_softcapping", "logit_scale", "logits_scaling", "output_multiplier_scale"]:
+        if getattr(config, name, None) is not None:
+            return False
+    return True
+
+
+def _packed_attention_mask(segment_ids: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    """
+    Builds the additive `[batch, 1, seq, seq]` attention mask for packed rows, given the segment each position
+    belongs to. A position attends to the earlier positions of its own segment, and padding attends to itself.
+    """
+    length = segment_ids.shape[1]
+    causal = torch.ones(length, length, dtype=torch.bool).tril()
+    same_segment = segment_ids[:, :, None] == segment_ids[:, None, :]
+    allowed = (same_segment & causal) | torch.eye(length, dtype=torch.bool)
+    return _additive_attention_mask(allowed, dtype)
+
+
+def _additive_attention_mask(allowed: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    """Turns a `[batch, seq, seq]` boolean mask of the positions each position may attend to into a 4D mask."""
+    mask = torch.zeros(allowed.shape, dtype=dtype)
+    mask.masked_fill_(~allowed, torch.finfo(dtype).min)
+    return mask.unsqueeze(1)
+
+
+def _continuation_trie(
+    continuations: Sequence[torch.Tensor]
+) -> Tuple[List[int], List[int], List[int], List[List[int]]]:
+    """
+    Builds a token trie of the inputs of the given continuations, all their tokens but the last, which are only
+    ever predicted. Returns the token of every node, its parent (-1 for the first tokens), its depth, and the
+    nodes along the path of every continuation. Nodes are numbered in the order they are added, so a parent
+    always comes before its children.
+    """
+    token_ids: List[int] = []
+    parents: List[int] = []
+    depths: List[int] = []
+    paths: List[List[int]] = []
+    children: Dict[Tuple[int, int], int] = {}
+    for continuation in continuations:
+        path = []
+        parent = -1
+        for depth, token in enumerate(continuation[:-1].tolist()):
+            node = children.get((parent, token))
+            if node is None:
+                node = len(token_ids)
+                children[(parent, token)] = node
+                token_ids.append(token)
+                parents.append(parent)
+                depths.append(depth)
+            path.append(node)
+            parent = node
+        paths.append(path)
+    return token_ids, parents, depths, paths
+
+
+def _extend_past_key_values(
+    model: _Model,
+    past_key_values: Any,
+    token_ids: Sequence[int],
+    start: int,
+    full_logits: bool = False
+) -> Any:
+    """
+    Runs `token_ids[start:]` on top of the `past_key_values` of `token_ids[:start]`, or from scratch if
+    `past_key_values` is `None`, and returns the `past_key_values` of all of `token_ids`.
+    """
+    input_ids = torch.tensor([token_ids[start:]], dtype=torch.long, device=model.device)
+    model_inputs: Dict[str, Any] = {"input_ids": input_ids, "use_cache": True}
+    if past_key_values is not None:
+        model_inputs["attention_mask"] = torch.ones(1, len(token_ids), dtype=torch.long, device=model.device)
+        model_inputs["position_ids"] = (start + torch.arange(len(token_ids) - start))[None, :].to(model.device)
+        model_inputs["past_key_values"] = past_key_values
+    _, output = _selected_log_probs(model, [], [], full_logits, **model_inputs)
+    return output.past_key_values
+
+
+def _truncate_past_key_values(past_key_values: Any, length: int) -> Any:
+    """
+    The `past_key_values` of the first `length` tokens, as a new cache, since the model appends to a `Cache`
+    object in place. Keys and values are indexed `[batch, heads, position, dim]`.
+    """
+    is_cache_object = not isinstance(past_key_values, (tuple, list))
+    legacy = past_key_values.to_legacy_cache() if is_cache_object else past_key_values
+    truncated = tuple(
+        tuple(tensor[:, :, :length] for tensor in layer)
+        for layer in legacy
+    )
+    if is_cache_object:
+        return type(past_key_values).from_legacy_cache(truncated)
+    return truncated
 
 
+def _select_past_key_values(past_key_values: Any, rows: torch.Tensor) -> Any:
+    """
+    Picks the given rows (along the batch dimension) out of a `past_key_values` cache, repeating rows
+    as needed. Supports the legacy tuple format as well as `Cache` objects that can convert to and from it.
+    """
+    is_cache_object = not isinstance(past_key_values, (tuple, list))
+    legacy = past_key_values.to_legacy_cache() if is_cache_object else past_key_values
+    selected = tuple(
+        tuple(tensor.index_select(0, rows.to(tensor.device)) for tensor in layer)
+        for layer in legacy
+    )
+    if is_cache_object:
+        return type(past_key_values).from_legacy_cache(selected)
+    return selected
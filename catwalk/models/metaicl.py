@@ -41,7 +41,10 @@ class MetaICLModel(DecoderOnlyRCModel):
         tokenizer: _Tokenizer,
         batch_size: int = 32,
         num_shots: int = 0,
-        fewshot_seed: Optional[int] = None
+        fewshot_seed: Optional[int] = None,
+        num_recorded_inputs: Optional[int] = 0,
+        instance_indices: Optional[Sequence[int]] = None,
+        **kwargs
     ) -> Iterator[Dict[str, Any]]:
         instance_index_to_tuple_indices: Mapping[int, List[int]] = collections.defaultdict(list)
         tuples: List[Tuple[str, str]] = []
@@ -52,7 +55,9 @@ class MetaICLModel(DecoderOnlyRCModel):
         for i, instance in enumerate(instances):
             # pre-instance processing (both fewshot and test example)
             instance['input'] = self._apply_meta_icl_per_instance_truncation(instance, tokenizer, is_icl_demonstration=False, is_first= not bool(num_shots))
-            fewshot_instances=task.get_fewshot_instances(num_shots, random_seed=fewshot_seed if fewshot_seed is not None else i, exceptions=instance)
+            random_seed = fewshot_seed if fewshot_seed is not None else \
+                (instance_indices[i] if instance_indices is not None else i)
+            fewshot_instances=task.get_fewshot_instances(num_shots, random_seed=random_seed, exceptions=instance)
             truncated_fewshot_instances = []
             for i, fewshot_instance in enumerate(fewshot_instances):
                 fewshot_instance['input'] = self._apply_meta_icl_per_instance_truncation(fewshot_instance, tokenizer, is_first=(i==0))
@@ -75,7 +80,7 @@ class MetaICLModel(DecoderOnlyRCModel):
                 tuples.append(instance_request)
 
         # run the requests
-        results = self._run_loglikelihood(tuples, model, tokenizer, batch_size)
+        results = self._run_loglikelihood(tuples, model, tokenizer, batch_size, **kwargs)
 
         if self.instances_truncated == self.instances_total:
             warnings.warn("All examples in this dataset chunk are being truncated after concatenation, consider using smaller max_length_per_example")
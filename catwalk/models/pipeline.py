@@ -0,0 +1,131 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+def _put(q: queue.Queue, item: Any, stop: threading.Event) -> None:
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def _get(q: queue.Queue, stop: threading.Event) -> Any:
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _DONE
+
+
+def run_pipelined(
+    items: Iterable[Any],
+    prepare: Callable[[Any], Any],
+    run: Callable[[Any], Any],
+    finish: Callable[[Any, Any], None],
+    depth: int = 0,
+) -> Dict[str, Dict[str, float]]:
+    """
+    Calls `finish(prepared, run(prepared))` with `prepared = prepare(item)` for every item, in order.
+
+    With a `depth` of at least 1, the three stages overlap: a background thread prepares up to `depth` items
+    ahead of the one that runs, and another one finishes up to `depth` items behind it, while the calling
+    thread does nothing but `run`. Most of what the stages do happens in `torch` ops, which release the GIL.
+    With a `depth` of 0, everything runs one item at a time in the calling thread. An exception in any stage
+    stops the others and is raised here.
+
+    Returns the seconds every stage spent busy, and idle waiting for the stage before or after it.
+    """
+    stats = {stage: {"busy_seconds": 0.0, "idle_seconds": 0.0} for stage in ["prepare", "run", "finish"]}
+    if depth < 1:
+        for item in items:
+            start = time.perf_counter()
+            prepared = prepare(item)
+            prepared_time = time.perf_counter()
+            output = run(prepared)
+            run_time = time.perf_counter()
+            finish(prepared, output)
+            stats["prepare"]["busy_seconds"] += prepared_time - start
+            stats["run"]["busy_seconds"] += run_time - prepared_time
+            stats["finish"]["busy_seconds"] += time.perf_counter() - run_time
+        return stats
+
+    prepared_queue: queue.Queue = queue.Queue(maxsize=depth)
+    output_queue: queue.Queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    errors = []
+
+    def prepare_worker():
+        try:
+            for item in items:
+                start = time.perf_counter()
+                prepared = prepare(item)
+                prepared_time = time.perf_counter()
+                _put(prepared_queue, prepared, stop)
+                stats["prepare"]["busy_seconds"] += prepared_time - start
+                stats["prepare"]["idle_seconds"] += time.perf_counter() - prepared_time
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            _put(prepared_queue, _DONE, stop)
+
+    def finish_worker():
+        try:
+            # inference mode is per thread
+            with torch.inference_mode():
+                while True:
+                    start = time.perf_counter()
+                    entry = _get(output_queue, stop)
+                    got_time = time.perf_counter()
+                    stats["finish"]["idle_seconds"] += got_time - start
+                    if entry is _DONE:
+                        return
+                    finish(*entry)
+                    stats["finish"]["busy_seconds"] += time.perf_counter() - got_time
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    threads = [threading.Thread(target=prepare_worker, daemon=True), threading.Thread(target=finish_worker, daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            start = time.perf_counter()
+            prepared = _get(prepared_queue, stop)
+            got_time = time.perf_counter()
+            if prepared is _DONE:
+                break
+            output = run(prepared)
+            run_time = time.perf_counter()
+            _put(output_queue, (prepared, output), stop)
+            stats["run"]["idle_seconds"] += got_time - start + time.perf_counter() - run_time
+            stats["run"]["busy_seconds"] += run_time - got_time
+        _put(output_queue, _DONE, stop)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return stats
+
+
+def log_pipeline_stats(stats: Dict[str, Dict[str, float]]) -> None:
+    logger.info("Pipeline stages: %s", ", ".join(
+        f"{stage} {stage_stats['busy_seconds']:.2f}s busy, {stage_stats['idle_seconds']:.2f}s idle"
+        for stage, stage_stats in stats.items()))
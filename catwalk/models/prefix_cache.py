@@ -0,0 +1,82 @@
+import collections
+import logging
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class PrefixCache:
+    """
+    Keeps the `past_key_values` of long token prefixes that many requests start with, such as a fixed set of
+    few-shot demonstrations, so that the prefix is run through the model once and every request only runs
+    the tokens after it. Entries live for as long as the cache, so a prefix is also shared by the requests
+    of later batches and rounds of the same task.
+
+    At most `max_tokens` tokens of prefixes are kept; the least recently used ones are evicted first.
+    Prefixes shorter than `min_prefix_tokens` are not worth sharing. The stats count how many prefill
+    tokens were not run because they came from the cache, or from a longer context that several requests of
+    a prefix share, such as the prompts of an instance with more and more nested few-shot examples.
+    """
+
+    def __init__(self, max_tokens: int = 16 * 1024, *, min_prefix_tokens: int = 64):
+        if max_tokens < 1:
+            raise ValueError(f"max_tokens must be at least 1, got {max_tokens}")
+        self.max_tokens = max_tokens
+        self.min_prefix_tokens = min_prefix_tokens
+        self._entries: "collections.OrderedDict[Tuple[int, ...], Any]" = collections.OrderedDict()
+        self._num_tokens = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.requests = 0
+        self.extensions = 0
+        self.prefill_tokens_saved = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def prefixes(self) -> Sequence[Tuple[int, ...]]:
+        return list(self._entries.keys())
+
+    def get(self, prefix: Tuple[int, ...]) -> Optional[Any]:
+        past_key_values = self._entries.get(prefix)
+        if past_key_values is not None:
+            self._entries.move_to_end(prefix)
+        return past_key_values
+
+    def put(self, prefix: Tuple[int, ...], past_key_values: Any) -> None:
+        if len(prefix) > self.max_tokens or prefix in self._entries:
+            return
+        while self._num_tokens + len(prefix) > self.max_tokens:
+            evicted, _ = self._entries.popitem(last=False)
+            self._num_tokens -= len(evicted)
+            self.evictions += 1
+        self._entries[prefix] = past_key_values
+        self._num_tokens += len(prefix)
+
+    def record(self, prefix_length: int, num_requests: int, hit: bool) -> None:
+        """Counts a group of `num_requests` requests that were scored on top of a prefix."""
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.requests += num_requests
+        self.prefill_tokens_saved += prefix_length * (num_requests if hit else num_requests - 1)
+
+    def record_extension(self, extension_length: int, num_run: int, num_requests: int) -> None:
+        """
+        Counts a group of `num_requests` requests that were scored on top of a context `extension_length`
+        tokens longer than their prefix, of which `num_run` tokens had to be run.
+        """
+        self.extensions += 1
+        self.prefill_tokens_saved += extension_length * num_requests - num_run
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "requests": self.requests,
+            "extensions": self.extensions,
+            "prefill_tokens_saved": self.prefill_tokens_saved,
+        }
@@ -30,6 +30,9 @@ class PromptsourceEncoderDecoderRCModel(EncoderDecoderRCModel):
         batch_size: int = 32,
         num_shots: int = 0,
         fewshot_seed: Optional[int] = None,
+        num_recorded_inputs: Optional[int] = 0,
+        instance_indices: Optional[Sequence[int]] = None,
+        **kwargs
     ) -> Iterator[Dict[str, Any]]:
         instance_index_to_tuple_indices: Mapping[Tuple[int, str], List[int]] = collections.defaultdict(list)
         tuples: List[Tuple[str, str]] = []
@@ -42,7 +45,8 @@ class PromptsourceEncoderDecoderRCModel(EncoderDecoderRCModel):
                 InstanceFormat.PROMPTSOURCE,
                 fewshot_instances=task.get_fewshot_instances(
                     num_shots,
-                    random_seed=fewshot_seed if fewshot_seed is not None else i,
+                    random_seed=fewshot_seed if fewshot_seed is not None else
+                        (instance_indices[i] if instance_indices is not None else i),
                     exceptions=instance))
 
         map_fn = functools.partial(bettermap.map_in_chunks, chunk_size=64)
@@ -70,7 +74,7 @@ class PromptsourceEncoderDecoderRCModel(EncoderDecoderRCModel):
                     tuples.append(instance_request)
 
         # run the requests
-        results = self._run_loglikelihood(tuples, model, tokenizer, batch_size)
+        results = self._run_loglikelihood(tuples, model, tokenizer, batch_size, **kwargs)
 
         # collect the results
         for instance_index, instance_dict in enumerate(rc_instances):
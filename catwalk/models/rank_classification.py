@@ -1,5 +1,6 @@
 import collections
 import functools
+import json
 from typing import Dict, Any, List, Tuple, Sequence, Iterator, Union, Mapping, Optional, cast, Callable
 
 import more_itertools
@@ -12,6 +13,8 @@ from transformers import AutoModelForCausalLM, AutoModelForSeq2SeqLM, T5ForCondi
 
 from catwalk import cached_transformers
 from catwalk.model import Model, TrainableModel, Instance
+from catwalk.models.batching import make_batches, logits_bytes_per_token
+from catwalk.models.result_cache import RequestCache, model_identity
 from catwalk.task import Task, InstanceFormat, RankClassificationInstance
 
 _Model = Union[T5ForConditionalGeneration, GPT2LMHeadModel]
@@ -38,7 +41,8 @@ class RankClassificationModel(Model):
             The method for averaging the sum likelihood of the continuation. 'char' averages by 
             character length, 'token' averages by token length.
         model_kwargs:
-            Additional kwargs passed to the `_make_model` method.
+            Additional kwargs passed to the `_make_model` method, for example `quantize="int8-dynamic"` to
+            quantize the model for CPU inference (see :func:`catwalk.cached_transformers.quantize_model`).
         """
         assert likelihood_averaging in {'char', 'token'}
         self.pretrained_model_name_or_path = pretrained_model_name_or_path
@@ -62,18 +66,27 @@ class RankClassificationModel(Model):
         instances: Sequence[Dict[str, Any]],
         *,
         batch_size: int = 32,
+        max_batch_tokens: Optional[int] = None,  # If set, max number of padded tokens in a batch
+        max_batch_memory: Optional[int] = None,  # If set, max bytes of logits in a batch
         max_instances_in_memory: int = 32 * 1024,
         num_shots: int = 0,
         fewshot_seed: Optional[int] = None,
         num_recorded_inputs: Optional[int] = 0,  # Number of instances to log in detail
+        request_cache: Optional[RequestCache] = None,  # On-disk cache of the results of individual requests
+        instance_indices: Optional[Sequence[int]] = None,  # Seeds the few-shot examples of each instance
     ) -> Iterator[Dict[str, Any]]:
         model = self._make_model(
             self.pretrained_model_name_or_path,
             device_map="auto" if torch.cuda.device_count() > 0 else None,
             **self.model_kwargs).eval()
         tokenizer = self._make_tokenizer()
+        if instance_indices is None:
+            instance_indices = range(len(instances))
 
-        for instance_chunk in more_itertools.chunked(instances, max_instances_in_memory):
+        for chunk_start, instance_chunk in zip(
+            range(0, len(instances), max_instances_in_memory),
+            more_itertools.chunked(instances, max_instances_in_memory)
+        ):
             yield from self.predict_chunk(
                 task,
                 instance_chunk,
@@ -83,6 +96,10 @@ class RankClassificationModel(Model):
                 num_shots=num_shots,
                 fewshot_seed=fewshot_seed,
                 num_recorded_inputs=num_recorded_inputs,
+                max_batch_tokens=max_batch_tokens,
+                max_batch_memory=max_batch_memory,
+                request_cache=request_cache,
+                instance_indices=instance_indices[chunk_start:chunk_start + len(instance_chunk)],
             )
 
     def predict_chunk(
@@ -95,6 +112,8 @@ class RankClassificationModel(Model):
         num_shots: int = 0,
         fewshot_seed: Optional[int] = None,
         num_recorded_inputs: Optional[int] = 0, # Number of model inputs to log in detail
+        instance_indices: Optional[Sequence[int]] = None,
+        **kwargs
     ) -> Iterator[Dict[str, Any]]:
         instance_index_to_tuple_indices: Mapping[int, List[int]] = collections.defaultdict(list)
         tuples: List[Tuple[str, str]] = []
@@ -104,19 +123,23 @@ class RankClassificationModel(Model):
                 InstanceFormat.RANK_CLASSIFICATION,
                 fewshot_instances=task.get_fewshot_instances(
                     num_shots,
-                    random_seed=fewshot_seed if fewshot_seed is not None else i,
+                    random_seed=fewshot_seed if fewshot_seed is not None else
+                        (instance_indices[i] if instance_indices is not None else i),
                     exceptions=instance))
             for i, instance in enumerate(instances)
         ]
 
-        # get all the tuples
+        # get all the tuples, identical ones only once
+        tuple_indices: Dict[Tuple[str, str], int] = {}
         for instance_index, instance in enumerate(rc_instances):
             for instance_request in instance.choices:
-                instance_index_to_tuple_indices[instance_index].append(len(tuples))
-                tuples.append(instance_request)
+                tuple_index = tuple_indices.setdefault(tuple(instance_request), len(tuples))
+                if tuple_index == len(tuples):
+                    tuples.append(instance_request)
+                instance_index_to_tuple_indices[instance_index].append(tuple_index)
 
         # run the requests
-        results = self._run_loglikelihood(tuples, model, tokenizer, batch_size)
+        results = self._run_loglikelihood(tuples, model, tokenizer, batch_size, **kwargs)
 
         # collect the results
         for instance_index, instance in enumerate(rc_instances):
@@ -137,6 +160,9 @@ class RankClassificationModel(Model):
         model: _Model,
         tokenizer: _Tokenizer,
         batch_size: int = 32,
+        max_batch_tokens: Optional[int] = None,
+        max_batch_memory: Optional[int] = None,
+        request_cache: Optional[RequestCache] = None,
     ) -> Sequence[float]:
         raise NotImplementedError
 
@@ -162,19 +188,26 @@ class TrainableRankClassificationModel(TrainableModel):
         *,
         batch_size: int = 32,
         max_instances_in_memory: int = 32 * 1024,
-        num_shots: int = 0
+        num_shots: int = 0,
+        instance_indices: Optional[Sequence[int]] = None
     ) -> Iterator[Dict[str, Any]]:
+        if instance_indices is None:
+            instance_indices = range(len(instances))
         training_mode = self.model.training
         try:
             self.model.eval()
-            for instance_chunk in more_itertools.chunked(instances, max_instances_in_memory):
+            for chunk_start, instance_chunk in zip(
+                range(0, len(instances), max_instances_in_memory),
+                more_itertools.chunked(instances, max_instances_in_memory)
+            ):
                 yield from self.predict_chunk(
                     task,
                     instance_chunk,
                     self.model,
                     self.tokenizer,
                     batch_size=batch_size,
-                    num_shots=num_shots)
+                    num_shots=num_shots,
+                    instance_indices=instance_indices[chunk_start:chunk_start + len(instance_chunk)])
         finally:
             self.model.train(training_mode)
 
@@ -253,6 +286,9 @@ class EncoderDecoderRCModel(RankClassificationModel):
         model: _Model,
         tokenizer: _Tokenizer,
         batch_size: int = 32,
+        max_batch_tokens: Optional[int] = None,
+        max_batch_memory: Optional[int] = None,
+        request_cache: Optional[RequestCache] = None,
     ) -> Sequence[float]:
         encoder_inputs = tokenizer([t[0] for t in tuples])
         model_inputs: List[Dict[str, torch.Tensor]] = []
@@ -270,20 +306,43 @@ class EncoderDecoderRCModel(RankClassificationModel):
             model_inputs[i]["labels"] = torch.tensor(input_as_list, dtype=torch.long)
         del decoder_inputs
 
+        if request_cache is not None:
+            requests = [
+                [
+                    "rc_loglikelihood",
+                    self.likelihood_averaging,
+                    len(t[1]) if self.likelihood_averaging == 'char' else None,
+                    model_input["input_ids"].tolist(),
+                    model_input["labels"].tolist()
+                ]
+                for t, model_input in zip(tuples, model_inputs)
+            ]
+            options = {"batch_size": batch_size, "max_batch_tokens": max_batch_tokens, "max_batch_memory": max_batch_memory}
+            return request_cache.get_or_compute(
+                model_identity(self, model, tokenizer),
+                requests,
+                tuples,
+                lambda missing_tuples: self._run_loglikelihood(missing_tuples, model, tokenizer, **options),
+                # the options only schedule the requests, they do not change the results
+                group=json.dumps(["rc_loglikelihood"]),
+                sizes=[len(model_input["input_ids"]) + len(model_input["labels"]) for model_input in model_inputs],
+                placeholder=0.0)
+
         # find out the order to process sequences in
-        lengths = torch.tensor([
-            len(model_input["input_ids"])
-            for model_input in model_inputs
-        ], dtype=torch.int)
-        ordered_indices = torch.argsort(lengths, descending=True)
-        del lengths
+        batches = make_batches(
+            [len(model_input["input_ids"]) for model_input in model_inputs],
+            batch_size=batch_size,
+            max_batch_tokens=max_batch_tokens,
+            max_batch_memory=max_batch_memory,
+            bytes_per_token=logits_bytes_per_token(model))
 
         # actually do the processing
-        results: List[Optional[float]] = [None] * len(ordered_indices)
+        results: List[Optional[float]] = [None] * len(model_inputs)
         with torch.inference_mode():
-            with Tqdm.tqdm(ordered_indices, desc="Running log-likelihood queries") as ordered_indices_tqdm:
-                batches_of_indices = more_itertools.chunked(ordered_indices_tqdm, batch_size)
-                for batch_of_indices in batches_of_indices:
+            with Tqdm.tqdm(total=len(model_inputs), desc="Running log-likelihood queries") as requests_tqdm:
+                for batch in batches:
+                    requests_tqdm.update(len(batch))
+                    batch_of_indices = batch.indices
                     unpadded_batch = collections.defaultdict(list)
                     for index in batch_of_indices:
                         for field_name, model_input in model_inputs[index].items():
@@ -335,6 +394,9 @@ class DecoderOnlyRCModel(RankClassificationModel):
         model: _Model,
         tokenizer: _Tokenizer,
         batch_size: int = 32,
+        max_batch_tokens: Optional[int] = None,
+        max_batch_memory: Optional[int] = None,
+        request_cache: Optional[RequestCache] = None,
     ) -> Sequence[float]:
         tokenized_contexts = tokenizer([t[0] for t in tuples], add_special_tokens=False)
         tokenized_continuations = tokenizer([self._prefix_with_space(t[1]) for t in tuples], add_special_tokens=False)
@@ -356,20 +418,51 @@ class DecoderOnlyRCModel(RankClassificationModel):
                     torch.tensor(continuation, dtype=torch.long)
                 )
 
+        if request_cache is not None:
+            requests = [
+                [
+                    "rc_loglikelihood",
+                    self.likelihood_averaging,
+                    len(t[1]) if self.likelihood_averaging == 'char' else None,
+                    tokenizer.model_max_length,
+                    cc_pair["input_ids"][0].tolist(),
+                    cc_pair["input_ids"][1].tolist()
+                ]
+                for t, cc_pair in zip(tuples, cc_pairs)
+            ]
+            options = {"batch_size": batch_size, "max_batch_tokens": max_batch_tokens, "max_batch_memory": max_batch_memory}
+            return request_cache.get_or_compute(
+                model_identity(self, model, tokenizer),
+                requests,
+                tuples,
+                lambda missing_tuples: self._run_loglikelihood(missing_tuples, model, tokenizer, **options),
+                # the options only schedule the requests, they do not change the results
+                group=json.dumps(["rc_loglikelihood"]),
+                sizes=[
+                    min(len(cc_pair["input_ids"][0]) + len(cc_pair["input_ids"][1]), tokenizer.model_max_length + 1)
+                    for cc_pair in cc_pairs
+                ],
+                placeholder=0.0)
+
         # find out the order to process sequences in
-        lengths = torch.tensor([
-            len(cc_pair["input_ids"][0]) + len(cc_pair["input_ids"][1])
-            for cc_pair in cc_pairs
-        ], dtype=torch.int)
-        ordered_indices = torch.argsort(lengths, descending=True)
-        del lengths
+        # Use model_max_length+1 since the last token is not in the input
+        batches = make_batches(
+            [
+                min(len(cc_pair["input_ids"][0]) + len(cc_pair["input_ids"][1]), tokenizer.model_max_length + 1) - 1
+                for cc_pair in cc_pairs
+            ],
+            batch_size=batch_size,
+            max_batch_tokens=max_batch_tokens,
+            max_batch_memory=max_batch_memory,
+            bytes_per_token=logits_bytes_per_token(model))
 
         # actually do the processing
-        results: List[Optional[float]] = [None] * len(ordered_indices)
+        results: List[Optional[float]] = [None] * len(cc_pairs)
         with torch.inference_mode():
-            with Tqdm.tqdm(ordered_indices, desc="Running log-likelihood queries") as ordered_indices_tqdm:
-                batches_of_indices = more_itertools.chunked(ordered_indices_tqdm, batch_size)
-                for batch_of_indices in batches_of_indices:
+            with Tqdm.tqdm(total=len(cc_pairs), desc="Running log-likelihood queries") as requests_tqdm:
+                for batch in batches:
+                    requests_tqdm.update(len(batch))
+                    batch_of_indices = batch.indices
                     unpadded_batch = collections.defaultdict(list)
                     input_lengths = []
                     batch_contexts = []
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from typing import Any, Callable, Dict, Sequence, Tuple
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class StoredRequests:
+    """
+    The compiled requests of one entry of a :class:`RequestStore`: a list of token id sequences, read from a
+    memory-mapped array, and an `index` that maps them back to the instances they came from.
+    """
+
+    def __init__(self, tokens: np.ndarray, offsets: np.ndarray, index: Dict[str, Any]):
+        self.tokens = tokens
+        self.offsets = offsets
+        self.index = index
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def sequence(self, i: int) -> torch.Tensor:
+        return torch.from_numpy(self.tokens[self.offsets[i]:self.offsets[i + 1]].astype(np.int64))
+
+
+class RequestStore:
+    """
+    A content-addressed on-disk store of compiled requests, so that running the same tasks again, for example
+    with another checkpoint of the same model, skips converting the instances, building the few-shot prompts,
+    and tokenizing them.
+
+    Every entry is a directory named by a hash of its `description`, which has to name everything the
+    requests depend on: the task and its instances, the few-shot settings, and the tokenizer. It holds all
+    token ids in one `tokens.npy`, the offsets of the sequences in `offsets.npy`, and the `index.json` that
+    maps the sequences back to instances. Entries are written to a temporary directory and renamed into
+    place, and read back memory-mapped.
+    """
+
+    VERSION = "001"
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, description: Dict[str, Any]) -> str:
+        return hashlib.sha256(
+            json.dumps([self.VERSION, description], sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get_or_build(
+        self,
+        description: Dict[str, Any],
+        build: Callable[[], Tuple[Sequence[Sequence[int]], Dict[str, Any]]]
+    ) -> StoredRequests:
+        """
+        Returns the entry for `description`, calling `build` to make it if it is not in the store yet.
+        `build` returns the token id sequences and a json-serializable index.
+        """
+        entry_path = os.path.join(self.path, self.key(description))
+        if not os.path.exists(entry_path):
+            self.misses += 1
+            sequences, index = build()
+            lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+            offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            tokens = np.zeros(int(offsets[-1]), dtype=np.int32)
+            for sequence, start, end in zip(sequences, offsets[:-1], offsets[1:]):
+                tokens[start:end] = sequence
+            temp_path = tempfile.mkdtemp(dir=self.path, prefix=".tmp-")
+            try:
+                np.save(os.path.join(temp_path, "tokens.npy"), tokens)
+                np.save(os.path.join(temp_path, "offsets.npy"), offsets)
+                with open(os.path.join(temp_path, "index.json"), "w") as file:
+                    json.dump({"description": description, "index": index}, file)
+                os.rename(temp_path, entry_path)
+            except OSError:
+                # another process stored the same entry first
+                shutil.rmtree(temp_path, ignore_errors=True)
+                if not os.path.exists(entry_path):
+                    raise
+            logger.info("Request store: stored %d sequences in %s", len(sequences), entry_path)
+        else:
+            self.hits += 1
+            logger.info("Request store: reading requests from %s", entry_path)
+        with open(os.path.join(entry_path, "index.json")) as file:
+            index = json.load(file)["index"]
+        return StoredRequests(
+            np.load(os.path.join(entry_path, "tokens.npy"), mmap_mode="r"),
+            np.load(os.path.join(entry_path, "offsets.npy")),
+            index)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def instances_fingerprint(instances: Sequence[Dict[str, Any]]) -> str:
+    """A hash of the content of the instances."""
+    digest = hashlib.sha256()
+    for instance in instances:
+        digest.update(json.dumps(instance, sort_keys=True, default=repr).encode("utf-8"))
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+def task_identity(task: Any) -> Dict[str, Any]:
+    """The class and version of a task, and the dataset it reads, when it says."""
+    return {
+        "class": f"{type(task).__module__}.{type(task).__qualname__}",
+        "version": getattr(task, "VERSION", None),
+        "dataset_path": getattr(task, "dataset_path", None),
+        "dataset_name": getattr(task, "dataset_name", None),
+    }
+
@@ -0,0 +1,240 @@
+import copy
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class RequestCache:
+    """
+    An on-disk cache of the results of individual model requests, such as the log-likelihood of one
+    continuation or the text generated for one context, so that re-running a task only runs the model on
+    requests it has not seen before.
+
+    Results are stored as JSON in a SQLite database, keyed by a hash of the model identity (see
+    :func:`model_identity`) and the exact request, usually its token ids. Every lookup and every write of a
+    batch of requests happens in one transaction. When `max_entries` is set, the least recently used results
+    are evicted once the cache grows beyond it. A `path` of `":memory:"` keeps the cache in memory, which still
+    collapses identical requests within and across tasks.
+
+    `hits` counts the requests that were answered from the cache, `deduplicated` the ones that were identical
+    to another request in the same batch, and `misses` the ones that had to be run.
+    """
+
+    def __init__(self, path: str, max_entries: Optional[int] = None):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.deduplicated = 0
+        self.pool: Optional[RequestPool] = None
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, last_used REAL NOT NULL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+
+    @staticmethod
+    def _hash(namespace: str, request: Any) -> str:
+        return hashlib.sha256(json.dumps([namespace, request]).encode("utf-8")).hexdigest()
+
+    def get_many(self, namespace: str, requests: Sequence[Any]) -> List[Optional[Any]]:
+        """Looks up a batch of requests, returning `None` for the ones that are not in the cache."""
+        return self._get_by_keys([self._hash(namespace, request) for request in requests])
+
+    def _get_by_keys(self, keys: Sequence[str]) -> List[Optional[Any]]:
+        found: Dict[str, Any] = {}
+        with self._connection:
+            # SQLite limits the number of parameters per statement
+            for start in range(0, len(keys), 500):
+                key_chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(key_chunk))
+                rows = self._connection.execute(
+                    f"SELECT key, value FROM results WHERE key IN ({placeholders})", key_chunk).fetchall()
+                found.update((key, json.loads(value)) for key, value in rows)
+                self._connection.execute(
+                    f"UPDATE results SET last_used = ? WHERE key IN ({placeholders})", [time.time(), *key_chunk])
+        results = [found.get(key) for key in keys]
+        num_hits = sum(result is not None for result in results)
+        self.hits += num_hits
+        self.misses += len(results) - num_hits
+        return results
+
+    def put_many(self, namespace: str, requests: Sequence[Any], results: Sequence[Any]) -> None:
+        """Writes a batch of results, then evicts the least recently used ones beyond `max_entries`."""
+        assert len(requests) == len(results)
+        self._put_by_keys([self._hash(namespace, request) for request in requests], results)
+
+    def _put_by_keys(self, keys: Sequence[str], results: Sequence[Any]) -> None:
+        now = time.time()
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO results (key, value, last_used) VALUES (?, ?, ?)",
+                [(key, json.dumps(result), now) for key, result in zip(keys, results)])
+            if self.max_entries is not None:
+                self._connection.execute(
+                    "DELETE FROM results WHERE key NOT IN "
+                    "(SELECT key FROM results ORDER BY last_used DESC LIMIT ?)", (self.max_entries,))
+
+    def get_or_compute(
+        self,
+        namespace: str,
+        requests: Sequence[Any],
+        items: Sequence[Any],
+        run: Callable[[List[Any]], Sequence[Any]],
+        *,
+        group: Optional[str] = None,
+        sizes: Optional[Sequence[int]] = None,
+        placeholder: Any = None,
+    ) -> List[Any]:
+        """
+        Returns the results for all `requests`, calling `run` with the `items` of the requests that are not
+        cached, and caching what it returns. `requests` are the keys, `items` what `run` needs to compute them.
+        Identical requests are only computed once, and every one of them gets its own copy of the result.
+
+        While a :class:`RequestPool` is attached as `self.pool`, requests that are not cached are handed to
+        the pool instead, to be run later together with the requests that share their `group`, and this
+        returns `placeholder` for them. `sizes` says how many tokens each request costs, for attributing the
+        time of a pooled run.
+        """
+        keys = [self._hash(namespace, request) for request in requests]
+        results = self._get_by_keys(keys)
+        missing = [i for i, result in enumerate(results) if result is None]
+        first_index_for_key: Dict[str, int] = {}
+        for i in missing:
+            first_index_for_key.setdefault(keys[i], i)
+        unique_missing = list(first_index_for_key.values())
+        num_duplicates = len(missing) - len(unique_missing)
+        self.misses -= num_duplicates
+        self.deduplicated += num_duplicates
+        if len(unique_missing) > 0 and self.pool is not None and group is not None:
+            self.pool.add(
+                namespace, group, run,
+                [keys[i] for i in unique_missing],
+                [items[i] for i in unique_missing],
+                [sizes[i] for i in unique_missing] if sizes is not None else [1] * len(unique_missing))
+            for i in missing:
+                results[i] = copy.deepcopy(placeholder)
+        elif len(unique_missing) > 0:
+            computed = run([items[i] for i in unique_missing])
+            assert len(computed) == len(unique_missing)
+            self._put_by_keys([keys[i] for i in unique_missing], computed)
+            computed_by_key = {keys[i]: result for i, result in zip(unique_missing, computed)}
+            for i in missing:
+                result = computed_by_key[keys[i]]
+                results[i] = result if first_index_for_key[keys[i]] == i else copy.deepcopy(result)
+        logger.info(
+            "Request cache: %d of %d requests found, %d identical to another request, %d run",
+            len(requests) - len(missing), len(requests), num_duplicates, len(unique_missing))
+        return results
+
+    def run_pool(self) -> Dict[str, float]:
+        """
+        Runs all the requests collected by `self.pool` and caches their results, so the tasks they came from
+        can then be predicted from the cache. Returns the model time attributed to every task.
+        """
+        assert self.pool is not None
+        return self.pool.run(self._put_by_keys)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "deduplicated": self.deduplicated}
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+def model_identity(model_obj: Any, model: torch.nn.Module, tokenizer: Any) -> str:
+    """
+    Describes everything about a catwalk model that determines the results of its requests: its class and
+    version, the pretrained weights and any weights that override them, the extra model arguments, the
+    dtype the model runs in, and the tokenizer.
+    """
+    model_kwargs = {
+        key: value.__qualname__ if isinstance(value, type) else repr(value)
+        for key, value in sorted(getattr(model_obj, "model_kwargs", {}).items())
+    }
+    return json.dumps({
+        "class": f"{type(model_obj).__module__}.{type(model_obj).__qualname__}",
+        "version": getattr(model_obj, "VERSION", None),
+        "model": getattr(model_obj, "pretrained_model_name_or_path", None),
+        "model_kwargs": model_kwargs,
+        "dtype": str(getattr(model, "dtype", None)),
+        "tokenizer": getattr(model_obj, "pretrained_tokenizer_name_or_path", None),
+        "tokenizer_class": type(tokenizer).__qualname__,
+        "vocab_size": len(tokenizer) if hasattr(tokenizer, "__len__") else None,
+    }, sort_keys=True)
+
+
+@dataclass
+class _PoolGroup:
+    run: Callable[[List[Any]], Sequence[Any]]
+    keys: List[str] = field(default_factory=list)
+    items: List[Any] = field(default_factory=list)
+    sizes: List[int] = field(default_factory=list)
+    tasks: List[Optional[str]] = field(default_factory=list)
+
+
+class RequestPool:
+    """
+    Collects the requests of several tasks, so that requests that can run the same way are scheduled
+    together, instead of every task running its own batches. Set `task` to the name of the task whose
+    requests are being collected.
+    """
+
+    def __init__(self):
+        self.task: Optional[str] = None
+        self._groups: Dict[Tuple[str, str], _PoolGroup] = {}
+        self._keys: set = set()
+
+    def add(
+        self,
+        namespace: str,
+        group: str,
+        run: Callable[[List[Any]], Sequence[Any]],
+        keys: Sequence[str],
+        items: Sequence[Any],
+        sizes: Sequence[int]
+    ) -> None:
+        pool_group = self._groups.setdefault((namespace, group), _PoolGroup(run))
+        for key, item, size in zip(keys, items, sizes):
+            # the first task to ask for a request gets charged for it
+            if key in self._keys:
+                continue
+            self._keys.add(key)
+            pool_group.keys.append(key)
+            pool_group.items.append(item)
+            pool_group.sizes.append(size)
+            pool_group.tasks.append(self.task)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def run(self, write: Callable[[Sequence[str], Sequence[Any]], None]) -> Dict[str, float]:
+        """
+        Runs every group of requests in one go, and passes the results to `write`. The time each group takes
+        is split between the tasks in proportion to the tokens of their requests.
+        """
+        seconds_by_task: Dict[str, float] = {}
+        for (_, group), pool_group in self._groups.items():
+            logger.info("Running %d pooled requests for %s", len(pool_group.keys), group)
+            start = time.perf_counter()
+            results = pool_group.run(pool_group.items)
+            elapsed = time.perf_counter() - start
+            assert len(results) == len(pool_group.keys)
+            write(pool_group.keys, results)
+            total_size = sum(pool_group.sizes) or 1
+            for task, size in zip(pool_group.tasks, pool_group.sizes):
+                seconds_by_task[task] = seconds_by_task.get(task, 0.0) + elapsed * size / total_size
+        self._groups = {}
+        self._keys = set()
+        return seconds_by_task
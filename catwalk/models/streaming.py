@@ -0,0 +1,198 @@
+import collections
+import contextvars
+import functools
+import logging
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+from tango.common import Tqdm
+
+logger = logging.getLogger(__name__)
+
+# Instances are converted into requests, and their text tokenized, this many at a time
+INSTANCE_BLOCK_SIZE = 1024
+
+# Whether a round of stream_predictions is running, whose progress its own bar already shows
+_in_round: contextvars.ContextVar[bool] = contextvars.ContextVar("_in_round", default=False)
+
+
+def request_progress(*args, **kwargs):
+    """
+    A progress bar over the requests of one call, like `Tqdm.tqdm`. Within a round of
+    :func:`stream_predictions` it stays hidden, since the bar over all instances shows the progress instead.
+    """
+    return Tqdm.tqdm(*args, disable=_in_round.get(), **kwargs)
+
+
+@dataclass
+class InstanceRequests:
+    """
+    The requests of one instance, each given as `(kind, item, length)`, and how to turn their results, in the
+    same order, into the prediction for the instance. Requests of the same `kind` run together, and `length`
+    is the cost of a request that batches are sorted by, usually its number of tokens.
+    """
+    requests: List[Tuple[str, Any, int]]
+    finish: Callable[[List[Any]], Any]
+
+
+def combine_instance_requests(variants: Mapping[Any, InstanceRequests]) -> InstanceRequests:
+    """
+    Combines the requests of several variants of one instance, such as the instance with different numbers of
+    few-shot examples, into the requests of one instance, whose prediction maps the key of every variant to
+    its prediction. All the requests get the length of the longest one, so that they run in the same round,
+    where they can share the tokens they have in common.
+    """
+    keys = list(variants.keys())
+    length = max((length for key in keys for _, _, length in variants[key].requests), default=0)
+    return InstanceRequests(
+        [(kind, item, length) for key in keys for kind, item, _ in variants[key].requests],
+        functools.partial(
+            _finish_variants,
+            keys=keys,
+            sizes=[len(variants[key].requests) for key in keys],
+            finishes=[variants[key].finish for key in keys]))
+
+
+def _finish_variants(
+    results: List[Any],
+    keys: Sequence[Any],
+    sizes: Sequence[int],
+    finishes: Sequence[Callable[[List[Any]], Any]]
+) -> Dict[Any, Any]:
+    predictions = {}
+    offset = 0
+    for key, size, finish in zip(keys, sizes, finishes):
+        predictions[key] = finish(results[offset:offset + size])
+        offset += size
+    return predictions
+
+
+@dataclass
+class _BufferedInstance:
+    finish: Callable[[List[Any]], Any]
+    results: List[Any]
+    num_pending: int
+
+
+@dataclass
+class _BufferedRequest:
+    item: Any
+    length: int
+    instance: _BufferedInstance
+    position: int
+
+
+@dataclass
+class StreamStats:
+    """What :func:`stream_predictions` did, for logging and tests."""
+    num_instances: int = 0
+    num_requests: int = 0
+    num_rounds: int = 0
+    max_buffered_requests: int = 0
+
+
+def stream_predictions(
+    instance_requests: Iterable[InstanceRequests],
+    run: Mapping[str, Callable[[List[Any]], Sequence[Any]]],
+    *,
+    max_buffered_requests: Optional[int] = 32 * 1024,
+    round_multiple: int = 1,
+    stats: Optional[StreamStats] = None,
+    num_instances: Optional[int] = None,
+) -> Iterator[Any]:
+    """
+    Runs the requests of a stream of instances, and yields the prediction of every instance, in order, as soon as
+    all of its requests are done.
+
+    Instances are read into a buffer until it holds `max_buffered_requests` requests (or the stream ends). Then
+    the requests of half the buffer run, in one call to `run[kind]`: the requests of one kind with the narrowest
+    range of lengths that includes the oldest request in the buffer, so that the batches `run` makes out of
+    them are about as long as each other, and the oldest instance gets done. The rest stay in the buffer and are
+    batched together with the requests of the instances read next, instead of ending in a ragged batch. The
+    number of requests run at once is rounded to a multiple of `round_multiple`, such as the batch size. Once the
+    stream ends, the remaining requests run as they are. With `max_buffered_requests` set to `None`, the whole
+    stream is read before anything runs.
+
+    One progress bar counts the instances that are done, out of `num_instances` if it is given, and the bars of
+    the rounds, made by :func:`request_progress`, stay hidden.
+    """
+    if max_buffered_requests is not None and max_buffered_requests < 1:
+        raise ValueError(f"max_buffered_requests must be at least 1, got {max_buffered_requests}")
+    if stats is None:
+        stats = StreamStats()
+    iterator = iter(instance_requests)
+    exhausted = False
+    instances: Deque[_BufferedInstance] = collections.deque()
+    # the buffered requests of every kind, oldest first
+    pending: Dict[str, List[_BufferedRequest]] = collections.defaultdict(list)
+    # the order in which the instances were read, to find the oldest request
+    admitted: Dict[int, int] = {}
+    num_buffered = 0
+    round_size = None
+    if max_buffered_requests is not None:
+        round_size = max(round_multiple, (max_buffered_requests // 2) // round_multiple * round_multiple)
+    # closed when the stream is abandoned or fails, too
+    with Tqdm.tqdm(total=num_instances, desc="Predicting instances") as instances_tqdm:
+        while True:
+            while not exhausted and (max_buffered_requests is None or num_buffered < max_buffered_requests):
+                try:
+                    instance = next(iterator)
+                except StopIteration:
+                    exhausted = True
+                    break
+                buffered_instance = _BufferedInstance(
+                    instance.finish, [None] * len(instance.requests), len(instance.requests))
+                admitted[id(buffered_instance)] = stats.num_instances
+                instances.append(buffered_instance)
+                stats.num_instances += 1
+                for position, (kind, item, length) in enumerate(instance.requests):
+                    pending[kind].append(_BufferedRequest(item, length, buffered_instance, position))
+                num_buffered += len(instance.requests)
+                stats.num_requests += len(instance.requests)
+            stats.max_buffered_requests = max(stats.max_buffered_requests, num_buffered)
+
+            while len(instances) > 0 and instances[0].num_pending == 0:
+                done = instances.popleft()
+                del admitted[id(done)]
+                instances_tqdm.update(1)
+                yield done.finish(done.results)
+            if num_buffered == 0:
+                if exhausted:
+                    break
+                continue
+
+            kind = min(
+                (kind for kind, requests in pending.items() if len(requests) > 0),
+                key=lambda kind: admitted[id(pending[kind][0].instance)])
+            requests = pending[kind]
+            if exhausted or len(requests) <= round_size:
+                selected = requests
+                pending[kind] = []
+            else:
+                # the window of the requests sorted by length that holds the oldest one and the narrowest lengths
+                by_length = sorted(range(len(requests)), key=lambda i: (requests[i].length, i))
+                lengths = [requests[i].length for i in by_length]
+                oldest_position = by_length.index(0)
+                start = min(
+                    range(max(0, oldest_position - round_size + 1),
+                          min(oldest_position, len(requests) - round_size) + 1),
+                    key=lambda start: lengths[start + round_size - 1] - lengths[start])
+                selected_indices = set(by_length[start:start + round_size])
+                selected = [request for i, request in enumerate(requests) if i in selected_indices]
+                pending[kind] = [request for i, request in enumerate(requests) if i not in selected_indices]
+
+            in_round = _in_round.set(True)
+            try:
+                results = run[kind]([request.item for request in selected])
+            finally:
+                _in_round.reset(in_round)
+            assert len(results) == len(selected)
+            for request, result in zip(selected, results):
+                request.instance.results[request.position] = result
+                request.instance.num_pending -= 1
+            num_buffered -= len(selected)
+            stats.num_rounds += 1
+
+    logger.info(
+        "Streamed %d instances with %d requests in %d rounds, at most %d requests buffered",
+        stats.num_instances, stats.num_requests, stats.num_rounds, stats.max_buffered_requests)
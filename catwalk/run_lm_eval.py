@@ -1,14 +1,27 @@
 import argparse
+import copy
+import hashlib
 import json
 import logging
+import os
+import resource
+import sys
 from pydoc import locate
 import time
+from typing import Any, Dict, List, Optional
+
 import torch
 
 from tango.common.logging import initialize_logging
 
+from catwalk.cached_transformers import QUANTIZATION_MODES
 from catwalk.dependencies.lm_eval.utils import simple_parse_args_string
 from catwalk.models import MODELS, add_decoder_only_model
+from catwalk.models.language_model import LanguageModel
+from catwalk.models.rank_classification import RankClassificationModel
+from catwalk.models.prefix_cache import PrefixCache
+from catwalk.models.request_store import RequestStore
+from catwalk.models.result_cache import RequestCache, RequestPool
 from catwalk.steps_simple import CalculateMetricsStep, PredictStep
 from catwalk.task import rc_metrics
 from catwalk.tasks import TASKS, TASK_SETS, get_instances
@@ -25,9 +38,11 @@ _parser.add_argument('--task_file', type=str, help="Jsonl file with task specs")
 _parser.add_argument('--split', type=str, default="validation")
 _parser.add_argument('--batch_size', type=int, default=32)
 _parser.add_argument('--max_batch_tokens', type=int, help="Limit batch size to max tokens")
+_parser.add_argument('--max_batch_memory', type=int, help="Limit batch size to max bytes of logits")
 _parser.add_argument('--model_max_length', type=int, help="Max input length the model should accept")
 _parser.add_argument('--num_shots', type=int, help="Number of examples in prompt")
 _parser.add_argument('--fewshot_seed', type=int, help="Random seed for picking fixed prompt examples, leave out for varied examples")
+_parser.add_argument('--nested_fewshot', action='store_true', help="Pick prompt examples such that those for fewer shots are the first of those for more shots")
 _parser.add_argument('--limit', type=int, help="Max number of instances for a task")
 _parser.add_argument('--full_output_file', type=str, default=None, help="Filename for verbose output")
 _parser.add_argument('--metrics_file', type=str, default=None, help="Filename for metrics output")
@@ -35,40 +50,167 @@ _parser.add_argument('--num_recorded_inputs', type=int, default=0, help="Number
 _parser.add_argument('--model_path', type=str, help="Explicit path to load model from")
 _parser.add_argument('--model_class', type=str, help="Custom Python class for loading model")
 _parser.add_argument('--random_subsample_seed', type=int, help="Random seed for subsampling task instances using limit")
+_parser.add_argument('--share_context_kv', action='store_true', help="Run shared contexts once and score all continuations from the KV cache")
+_parser.add_argument('--continuation_trie', action='store_true', help="Score the continuations of a shared context as a token trie in one row, running their shared leading tokens once")
+_parser.add_argument('--pack_requests', action='store_true', help="Pack short requests into shared rows instead of padding them")
+_parser.add_argument('--no_single_token_scoring', action='store_true', help="Score single-token continuations on the same paths as the others")
+_parser.add_argument('--perplexity_stride', type=int, help="Score perplexity in overlapping windows, each scoring this many new tokens")
+_parser.add_argument('--quantize', type=str, choices=sorted(QUANTIZATION_MODES), help="Quantize the model for CPU inference")
+_parser.add_argument('--compute_dtype', type=str, help="Run lm:: models in this dtype, e.g. bfloat16, scoring in float32")
+_parser.add_argument('--compile_bucket_size', type=int, help="Run lm:: models through torch.compile, padding lengths to multiples of this")
+_parser.add_argument('--pipeline_depth', type=int, help="Prepare and finish this many batches in background threads, overlapping the model")
+_parser.add_argument('--max_buffered_requests', type=int, help="Max requests read ahead and waiting to be batched")
+_parser.add_argument('--full_logits', action='store_true', help="Compute logits at every position, not just for the continuation")
+_parser.add_argument('--num_workers', '--workers', type=int, help="Split requests across this many forked CPU worker processes")
+_parser.add_argument('--request_cache', type=str, help="SQLite file for caching the results of individual model requests")
+_parser.add_argument('--request_store', type=str, help="Directory for storing tokenized requests of lm:: models across runs")
+_parser.add_argument('--prefix_cache_tokens', type=int, help="Reuse the past key values of long shared prefixes, such as fixed few-shot examples, keeping at most this many tokens of them")
+_parser.add_argument('--request_cache_max_entries', type=int, help="Evict least recently used results beyond this many")
+_parser.add_argument('--num_shards', type=int, default=1, help="Split the instances of every task into this many shards")
+_parser.add_argument('--shard_index', type=int, default=0, help="Which shard to run, from 0 to num_shards - 1")
+_parser.add_argument('--checkpoint_dir', type=str, help="Directory for logs of the predictions so far, to resume interrupted runs")
+_parser.add_argument('--checkpoint_every', type=int, default=1000, help="Instances to predict between checkpoints")
+_parser.add_argument('--pool_tasks', action='store_true', help="Batch the requests of all tasks together instead of task by task")
+
+
+logger = logging.getLogger()
+
+
+def register_model(model: str, model_path: Optional[str] = None, model_class: Optional[str] = None):
+    # Add arbitrary pretrained Huggingface models to MODELS on the fly
+    # TODO add support for model types other than decoder_only
+    if model in MODELS:
+        return
+    prefix_split = model.split("::", 1)
+    model_name = prefix_split[-1]
+    # prefix = "" if len(prefix_split) == 1 else prefix_split[0]+"::"
+    model_args = simple_parse_args_string(model_name)
+    if 'pretrained' not in model_args:
+        raise ValueError(f"Unknown model {model}")
+    hf_name = model_args['pretrained']
+    del model_args['pretrained']
+    if model_path:
+        hf_name = model_path
+    if model_class:
+        model_args['model_class'] = locate(model_class)
+        # Assuming tokenizer will be loaded with model, so fail if trying to load it otherwise
+        model_args['pretrained_tokenizer_name_or_path'] = 'UnknownTokenizer'
+
+    logger.info(f"Dynamically adding decoder-only models for: {model_name}")
+    add_decoder_only_model(model_name, hf_name, **model_args)
+    if model not in MODELS:
+        # Happens if prefix not present
+        raise ValueError(f"Unknown model {model}")
+
+
+def load_task(task: Dict[str, Any], default_split: Optional[str] = None):
+    """Normalizes a task spec in place, adding its task object as `task_obj`."""
+    task_name = task['name']
+    if task_name in TASKS_LM:
+        task_obj = TASKS_LM[task_name]
+    elif task_name in TASKS:
+        task_obj = TASKS[task_name]
+    else:
+        raise ValueError(f"Task name {task_name} not known!")
+    if "task_options" in task:
+        if not hasattr(task_obj, "clone"):
+            raise ValueError("Cannot specify task_options for this task")
+        task_obj = task_obj.clone(**task['task_options'])
+    if "task_rename" in task:
+        task['name'] = task_name = task["task_rename"]
+    task['task_obj'] = task_obj
+    if 'split' not in task and not default_split:
+        task['split'] = task_obj.default_split
+    # TODO support various task construction overrides here?
+    # Hack to change MC accuracy metrics TODO Fix this!
+    if "relative_improvement" in task_obj.metrics or 'primary_metric' in task:
+        kwargs = {}
+        if 'primary_metric' in task:
+            kwargs['primary'] = task['primary_metric']
+            logger.info(f"Overriding metric for {task_name} with rc_metrics ({kwargs})")
+        else:
+            logger.warning(f"Overriding 'acc' metric for {task_name} with rc_metrics")
+        task_obj.metrics = {}
+        task_obj.add_metrics(rc_metrics(**kwargs))
+    if 'unconditioned_prompt' not in task:
+        if hasattr(task_obj, "inner_task") and hasattr(task_obj.inner_task, "unconditioned_prompt"):
+            prompt = task_obj.inner_task.unconditioned_prompt()
+            logger.info(f"Using unconditioned prompt for {task_name}: '{prompt}'")
+            task['unconditioned_prompt'] = prompt
+
+
+def instance_prediction(pred: Dict[str, Any]):
+    """Splits a prediction into what the verbose output records as the prediction, and the model input."""
+    prediction = pred.get('prediction', pred)
+    model_input = None
+    # Move model_input from prediction if need be
+    if 'model_input' in pred:
+        model_input = pred['model_input']
+        if 'model_input' in prediction:
+            del prediction['model_input']
+    return prediction, model_input
+
+
+def shard_file_name(file_name: str, shard_index: int, num_shards: int) -> str:
+    """The name of one shard's output file, e.g. `out.jsonl` -> `out.shard-2-of-8.jsonl`."""
+    root, extension = os.path.splitext(file_name)
+    return f"{root}.shard-{shard_index}-of-{num_shards}{extension}"
+
+
+def peak_memory() -> Dict[str, float]:
+    """
+    The peak GPU memory allocated by torch since the last reset, and the peak resident memory of the
+    process so far, which never goes down.
+    """
+    result = {}
+    if torch.cuda.is_available():
+        result["peak_gpu_memory_mb"] = torch.cuda.max_memory_allocated() / 2**20
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result["peak_rss_mb"] = max_rss / (2**20 if sys.platform == "darwin" else 2**10)
+    return result
+
+
+def write_outputs(verbose_output: List[Dict[str, Any]], full_output_file: Optional[str], metrics_file: Optional[str]):
+    if full_output_file:
+        logger.info(f"Saving full output in {full_output_file}...")
+        with open(full_output_file, 'w') as file:
+            for d in verbose_output:
+                file.write(json.dumps(sanitize(d)) + "\n")
+    if metrics_file:
+        logger.info(f"Saving metrics in {metrics_file}...")
+        with open(metrics_file, 'w') as file:
+            metrics = [{key: value for key, value in d.items() if key not in ('per_instance', 'shard')}
+                       for d in verbose_output]
+            file.write(json.dumps(sanitize({"metrics": metrics})))
+
+
+def log_metrics(verbose_output: List[Dict[str, Any]]):
+    metrics_printed = []
+    for d in verbose_output:
+        metrics_printed.append(f" *** {d['task']} ***  (n = {d['num_instances']})  [{d['task_options']}]")
+        metrics = {}
+        # Code is a bit confused about nestedness of metrics
+        for metric_name, metric in d['metrics'].items():
+            if isinstance(metric, dict):
+                metrics.update(metric)
+            else:
+                metrics[metric_name] = metric
+        for metric_name, metric in metrics.items():
+            metrics_printed.append(f"    {metric_name}: {metric}")
+        metrics_printed.append("-----------------")
+    logger.info("Overall metrics:\n  " + "\n".join(metrics_printed))
 
 
 def main(args: argparse.Namespace):
     initialize_logging(log_level="INFO")
-    logger = logging.getLogger()
 
     #if args.workspace is None:
     #    workspace = None
     #else:
     #    workspace = Workspace.from_url(args.workspace)
 
-    # Add arbitrary pretrained Huggingface models to MODELS on the fly
-    # TODO add support for model types other than decoder_only
-    if args.model not in MODELS:
-        prefix_split = args.model.split("::", 1)
-        model_name = prefix_split[-1]
-        # prefix = "" if len(prefix_split) == 1 else prefix_split[0]+"::"
-        model_args = simple_parse_args_string(model_name)
-        if 'pretrained' not in model_args:
-            raise ValueError(f"Unknown model {args.model}")
-        hf_name = model_args['pretrained']
-        del model_args['pretrained']
-        if args.model_path:
-            hf_name = args.model_path
-        if args.model_class:
-            model_args['model_class'] = locate(args.model_class)
-            # Assuming tokenizer will be loaded with model, so fail if trying to load it otherwise
-            model_args['pretrained_tokenizer_name_or_path'] = 'UnknownTokenizer'
-
-        logger.info(f"Dynamically adding decoder-only models for: {model_name}")
-        add_decoder_only_model(model_name, hf_name, **model_args)
-        if args.model not in MODELS:
-            # Happens if prefix not present
-            raise ValueError(f"Unknown model {args.model}")
+    register_model(args.model, model_path=args.model_path, model_class=args.model_class)
 
     default_task_args = {"limit": args.limit if hasattr(args, "limit") else None}
     default_task_args["split"] = args.split
@@ -78,14 +220,54 @@ def main(args: argparse.Namespace):
         default_task_args["model_max_length"] = args.model_max_length
     if args.max_batch_tokens is not None:
         default_task_args["max_batch_tokens"] = args.max_batch_tokens
+    if args.max_batch_memory is not None:
+        default_task_args["max_batch_memory"] = args.max_batch_memory
     if args.num_shots is not None:
         default_task_args["num_shots"] = args.num_shots
     if args.fewshot_seed is not None:
         default_task_args["fewshot_seed"] = args.fewshot_seed
+    if args.nested_fewshot:
+        default_task_args["nested_fewshot"] = True
     if args.num_recorded_inputs:
         default_task_args["num_recorded_inputs"] = args.num_recorded_inputs
     if args.random_subsample_seed:
         default_task_args["random_subsample_seed"] = args.random_subsample_seed
+    if args.share_context_kv:
+        default_task_args["share_context_kv"] = True
+    if args.continuation_trie:
+        default_task_args["continuation_trie"] = True
+    if args.pack_requests:
+        default_task_args["pack_requests"] = True
+    if args.no_single_token_scoring:
+        default_task_args["single_token_scoring"] = False
+    if args.full_logits:
+        default_task_args["full_logits"] = True
+    if args.perplexity_stride is not None:
+        default_task_args["perplexity_stride"] = args.perplexity_stride
+    if args.num_workers is not None:
+        default_task_args["num_workers"] = args.num_workers
+    if args.compute_dtype is not None:
+        default_task_args["compute_dtype"] = args.compute_dtype
+    if args.compile_bucket_size is not None:
+        default_task_args["compile_bucket_size"] = args.compile_bucket_size
+    if args.pipeline_depth is not None:
+        default_task_args["pipeline_depth"] = args.pipeline_depth
+    if args.max_buffered_requests is not None:
+        default_task_args["max_buffered_requests"] = args.max_buffered_requests
+    if args.num_shards > 1:
+        if not 0 <= args.shard_index < args.num_shards:
+            raise ValueError(f"--shard_index must be between 0 and {args.num_shards - 1}")
+        default_task_args["num_shards"] = args.num_shards
+        default_task_args["shard_index"] = args.shard_index
+        # every shard writes its own output files, which catwalk.merge_lm_eval combines
+        if not args.full_output_file:
+            raise ValueError("--num_shards needs a --full_output_file for catwalk.merge_lm_eval to merge")
+        root, extension = os.path.splitext(args.full_output_file)
+        raw_predictions_file = shard_file_name(f"{root}.predictions{extension}", args.shard_index, args.num_shards)
+        open(raw_predictions_file, 'w').close()
+        args.full_output_file = shard_file_name(args.full_output_file, args.shard_index, args.num_shards)
+        if args.metrics_file:
+            args.metrics_file = shard_file_name(args.metrics_file, args.shard_index, args.num_shards)
 
     tasks = []
     task_names = set()
@@ -111,129 +293,177 @@ def main(args: argparse.Namespace):
         raise ValueError("No tasks specified!")
 
     # Normalize the tasks, check that they exist, etc
+    task_specs = {}
     for task in tasks:
-        task_name = task['name']
-        if task_name in TASKS_LM:
-            task_obj = TASKS_LM[task_name]
-        elif task_name in TASKS:
-            task_obj = TASKS[task_name]
-        else:
-            raise ValueError(f"Task name {task_name} not known!")
-        if "task_options" in task:
-            if not hasattr(task_obj, "clone"):
-                raise ValueError("Cannot specify task_options for this task")
-            task_obj = task_obj.clone(**task['task_options'])
-        if "task_rename" in task:
-            task['name'] = task_name = task["task_rename"]
-        task['task_obj'] = task_obj
-        if 'split' not in task and not default_task_args['split']:
-            task['split'] = task_obj.default_split
-        # TODO support various task construction overrides here?
-        # Hack to change MC accuracy metrics TODO Fix this!
-        if "relative_improvement" in task_obj.metrics or 'primary_metric' in task:
-            kwargs = {}
-            if 'primary_metric' in task:
-                kwargs['primary'] = task['primary_metric']
-                logger.info(f"Overriding metric for {task_name} with rc_metrics ({kwargs})")
-            else:
-                logger.warning(f"Overriding 'acc' metric for {task_name} with rc_metrics")
-            task_obj.metrics = {}
-            task_obj.add_metrics(rc_metrics(**kwargs))
-        if 'unconditioned_prompt' not in task:
-            if hasattr(task_obj, "inner_task") and hasattr(task_obj.inner_task, "unconditioned_prompt"):
-                prompt = task_obj.inner_task.unconditioned_prompt()
-                logger.info(f"Using unconditioned prompt for {task_name}: '{prompt}'")
-                task['unconditioned_prompt'] = prompt
+        task_spec = task.copy()
+        load_task(task, default_task_args['split'])
+        task_specs[task['name']] = task_spec
 
     verbose_output = []
 
     # Initial loading of model done here for early failures and overrides if needed
     model_obj = MODELS[args.model]
+    if args.quantize:
+        if not hasattr(model_obj, "model_kwargs"):
+            raise ValueError(f"Model {args.model} does not support --quantize")
+        model_obj = copy.copy(model_obj)
+        model_obj.model_kwargs = dict(model_obj.model_kwargs, quantize=args.quantize)
+    quantize = getattr(model_obj, "model_kwargs", {}).get("quantize", getattr(model_obj, "quantize", None))
+    if args.compute_dtype is not None and not isinstance(model_obj, LanguageModel):
+        raise ValueError(f"Model {args.model} does not support --compute_dtype")
     if hasattr(model_obj, "_make_model"):
         logger.info("Loading model...")
         model_cached = model_obj._make_model(
             model_obj.pretrained_model_name_or_path,
             device_map="auto" if torch.cuda.device_count() > 0 else None,
-            **model_obj.model_kwargs).eval()
+            **(model_obj.model_kwargs_for(args.compute_dtype) if isinstance(model_obj, LanguageModel)
+               else model_obj.model_kwargs)).eval()
         if not hasattr(model_cached, "tokenizer"):
             tokenizer_cached = model_obj._make_tokenizer()
 
-    valid_model_args = ['split', 'limit', 'batch_size', 'max_batch_tokens', 'num_shots', 'model_max_length',
-                        'fewshot_seed', 'num_recorded_inputs', 'unconditioned_prompt', 'random_subsample_seed']
+    # One cache for all tasks, so identical requests are only run once across the whole run. Pooling the tasks
+    # collects their requests in it, in memory unless --request_cache is set.
+    predict_kwargs = {}
+    request_cache = None
+    if (args.request_cache or args.pool_tasks) and isinstance(model_obj, (LanguageModel, RankClassificationModel)):
+        request_cache = RequestCache(args.request_cache or ":memory:", max_entries=args.request_cache_max_entries)
+        predict_kwargs["request_cache"] = request_cache
+    elif args.request_cache:
+        logger.warning(f"Model {args.model} does not support --request_cache, ignoring it")
+    if args.pool_tasks and request_cache is None:
+        logger.warning(f"Model {args.model} does not support --pool_tasks, ignoring it")
+    if args.request_store and isinstance(model_obj, LanguageModel):
+        predict_kwargs["request_store"] = RequestStore(args.request_store)
+    elif args.request_store:
+        logger.warning(f"Model {args.model} does not support --request_store, ignoring it")
+    prefix_cache = None
+    if args.prefix_cache_tokens and isinstance(model_obj, LanguageModel):
+        prefix_cache = PrefixCache(args.prefix_cache_tokens)
+        predict_kwargs["prefix_cache"] = prefix_cache
+    elif args.prefix_cache_tokens:
+        logger.warning(f"Model {args.model} does not support --prefix_cache_tokens, ignoring it")
+
+    valid_model_args = ['split', 'limit', 'batch_size', 'max_batch_tokens', 'max_batch_memory', 'num_shots', 'model_max_length',
+                        'fewshot_seed', 'nested_fewshot', 'num_recorded_inputs', 'unconditioned_prompt', 'random_subsample_seed',
+                        'share_context_kv', 'continuation_trie', 'pack_requests', 'full_logits', 'perplexity_stride', 'num_workers',
+                        'num_shards', 'shard_index', 'compute_dtype', 'compile_bucket_size', 'single_token_scoring',
+                        'pipeline_depth', 'max_buffered_requests']
+
+    # With --pool_tasks, first collect the requests of every task without running them, then run them all
+    # in one pool so batches are sorted and filled across tasks. The tasks are then predicted from the cache.
+    # Collecting predicts every task once without the model, which is reported apart from the processing time.
+    pooled_seconds = {}
+    collect_seconds = {}
+    pooled_cache_stats = {}
+    if args.pool_tasks and request_cache is not None:
+        request_cache.pool = RequestPool()
+        for task in tasks:
+            start_time = time.time()
+            task_name = task['name']
+            logger.info(f"Collecting requests for task: {task_name}")
+            task_dict = task.copy()
+            task_dict.update(default_task_args)
+            cache_stats_before = request_cache.stats()
+            request_cache.pool.task = task_name
+            PredictStep().run(
+                model=model_obj,
+                task=task['task_obj'],
+                **predict_kwargs,
+                **filter_dict_keys(task_dict, valid_model_args))
+            pooled_cache_stats[task_name] = \
+                {key: value - cache_stats_before[key] for key, value in request_cache.stats().items()}
+            collect_seconds[task_name] = time.time() - start_time
+        logger.info(f"Running {len(request_cache.pool)} pooled requests from {len(tasks)} tasks")
+        pooled_seconds = request_cache.run_pool()
+        request_cache.pool = None
+
     for task in tasks:
         start_time = time.time()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
         task_name = task['name']
         task_obj = task['task_obj']
         logger.info(f"Processing task: {task_name}")
         task_dict = task.copy()
         task_dict.update(default_task_args)
+        cache_stats_before = request_cache.stats() if request_cache is not None else None
+        prefix_stats_before = prefix_cache.stats() if prefix_cache is not None else None
+        checkpoint_kwargs = {}
+        if args.checkpoint_dir:
+            # one file per model and task spec, the checkpoint itself checks the rest of the options
+            digest = hashlib.sha256(json.dumps([args.model, task_specs[task_name]], sort_keys=True).encode("utf-8"))
+            checkpoint_file = os.path.join(args.checkpoint_dir, f"{task_name}-{digest.hexdigest()[:16]}.jsonl")
+            if args.num_shards > 1:
+                checkpoint_file = shard_file_name(checkpoint_file, args.shard_index, args.num_shards)
+            checkpoint_kwargs = {"checkpoint_file": checkpoint_file, "checkpoint_every": args.checkpoint_every}
         predictions = PredictStep().run(
             model=model_obj,
             task=task_obj,
+            **predict_kwargs,
+            **checkpoint_kwargs,
             **filter_dict_keys(task_dict, valid_model_args))
+        if args.num_shards > 1:
+            # computing the metrics adds to the predictions, so keep them as they were for the merge
+            with open(raw_predictions_file, 'a') as file:
+                raw_predictions = [{key: value for key, value in pred.items() if key != 'model_input'}
+                                   for pred in predictions]
+                file.write(json.dumps(sanitize({"task": task_name, "raw_predictions": raw_predictions})) + "\n")
         metrics, predictions_updated = CalculateMetricsStep().run(
             model=model_obj,
             task=task_obj,
             predictions=predictions)
-        instances = get_instances(task_obj,
-                                  **filter_dict_keys(task_dict, ['split', 'limit', 'random_subsample_seed']))
+        instances = get_instances(task_obj, **filter_dict_keys(
+            task_dict, ['split', 'limit', 'random_subsample_seed', 'num_shards', 'shard_index']))
         output = {"task": task_name, "model": args.model,
                   "task_options": filter_dict_keys(task_dict, valid_model_args, remove_none=True),
                   "metrics": metrics,
                   "num_instances": len(instances),
-                  "processing_time_seconds": time.time() - start_time}
+                  "processing_time_seconds": time.time() - start_time + pooled_seconds.get(task_name, 0.0)}
+        if quantize is not None:
+            output["quantize"] = quantize
+        output["performance"] = {
+            "instances_per_second": len(instances) / max(output["processing_time_seconds"], 1e-9),
+            **peak_memory()
+        }
+        if task_name in collect_seconds:
+            output["pooled"] = {"collect_seconds": collect_seconds[task_name],
+                                "model_seconds": pooled_seconds.get(task_name, 0.0)}
+        if request_cache is not None:
+            cache_stats = pooled_cache_stats.get(task_name) or \
+                {key: value - cache_stats_before[key] for key, value in request_cache.stats().items()}
+            cache_stats["requests_saved"] = cache_stats["hits"] + cache_stats["deduplicated"]
+            output["request_cache"] = cache_stats
+        if prefix_cache is not None:
+            output["prefix_cache"] = \
+                {key: value - prefix_stats_before[key] for key, value in prefix_cache.stats().items()}
         if "task_options" in task_dict:
             output["custom_task_options"] = task_dict['task_options']
         logger.info(f"Results from task {task_name}: {output}")
         per_instance = []
         for instance, pred in zip(instances, predictions_updated):
-            instance_id = guess_instance_id(instance, idx=len(per_instance))
+            # the index of the instance in the whole task, not just in this shard
+            instance_id = guess_instance_id(instance, idx=args.shard_index + len(per_instance) * args.num_shards)
             if "keep_instance_fields" in task_dict:
                 for field in task_dict['keep_instance_fields']:
                     if field in instance:
                         instance_id[field] = instance[field]
-            prediction = pred.get('prediction', pred)
-            model_input = None
-            # Move model_input from prediction if need be
-            if 'model_input' in pred:
-                model_input = pred['model_input']
-                if 'model_input' in prediction:
-                    del prediction['model_input']
+            prediction, model_input = instance_prediction(pred)
             res1 = {"instance": instance_id, "prediction": prediction}
             if model_input is not None:
                 res1['model_input'] = model_input
             per_instance.append(res1)
         output["per_instance"] = per_instance
+        if args.num_shards > 1:
+            output["shard"] = {"shard_index": args.shard_index, "num_shards": args.num_shards,
+                               "task_spec": task_specs[task_name],
+                               "raw_predictions_file": os.path.basename(raw_predictions_file)}
         if per_instance:
             logger.info(f"First instance details for task {task_name}: {per_instance[0]}")
         verbose_output.append(output)
-        if args.full_output_file:
-            logger.info(f"Saving full output in {args.full_output_file}...")
-            with open(args.full_output_file, 'w') as file:
-                for d in verbose_output:
-                    file.write(json.dumps(sanitize(d)) + "\n")
-
-    if args.metrics_file:
-        logger.info(f"Saving metrics in {args.metrics_file}...")
-        with open(args.metrics_file, 'w') as file:
-            for d in verbose_output:
-                del d['per_instance']  # Destructive
-            file.write(json.dumps(sanitize({"metrics": verbose_output})))
+        write_outputs(verbose_output, args.full_output_file, None)
 
-    metrics_printed = []
-    for d in verbose_output:
-        metrics_printed.append(f" *** {d['task']} ***  (n = {d['num_instances']})  [{d['task_options']}]")
-        metrics = {}
-        # Code is a bit confused about nestedness of metrics
-        for metric_name, metric in d['metrics'].items():
-            if isinstance(metric, dict):
-                metrics.update(metric)
-            else:
-                metrics[metric_name] = metric
-        for metric_name, metric in metrics.items():
-            metrics_printed.append(f"    {metric_name}: {metric}")
-        metrics_printed.append("-----------------")
-    logger.info("Overall metrics:\n  " + "\n".join(metrics_printed))
+    write_outputs(verbose_output, None, args.metrics_file)
+    log_metrics(verbose_output)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,109 @@
 from typing import (
     Dict,
     Any,
+    List,
     Optional,
     Sequence,
 )
+import hashlib
+import json
+import logging
+import os
+
+import more_itertools
 
 from catwalk.task import Task
 from catwalk.tasks import get_instances
 from catwalk.model import Model
+from catwalk.models.result_cache import model_identity
+from catwalk.utils import guess_instance_id, sanitize
+
+logger = logging.getLogger(__name__)
+
+# Predict options that only change how requests are scheduled, not the predictions
+_SCHEDULING_OPTIONS = {"batch_size", "max_batch_tokens", "max_batch_memory", "num_workers", "request_cache",
+                       "num_recorded_inputs", "compile_bucket_size", "request_store", "pipeline_depth",
+                       "max_buffered_requests", "prefix_cache"}
+
+
+class PredictionLog:
+    """
+    An append-only jsonl file with the predictions of one task, so that a run that was interrupted can
+    pick up where it stopped. The first line records a fingerprint of the model and the options the
+    predictions were made with, and every other line one prediction with the index and id of its instance.
+    Predictions are written in batches, each flushed and fsync'd before the run moves on.
+    """
+
+    def __init__(self, path: str, description: Dict[str, Any]):
+        self.path = path
+        self.description = description
+        self.fingerprint = hashlib.sha256(
+            json.dumps(description, sort_keys=True, default=repr).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _instance_id(instance: Dict[str, Any], index: int) -> Any:
+        # as it reads back from json
+        return json.loads(json.dumps(sanitize(guess_instance_id(instance, idx=index))))
+
+    def load(self, instances: Sequence[Dict[str, Any]]) -> List[Any]:
+        """
+        Returns the predictions already in the log, for a prefix of `instances`, and truncates anything after
+        them. A log of another model or other options, or of other instances, is started over.
+        """
+        predictions: List[Any] = []
+        end = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as file:
+                header = file.readline()
+                try:
+                    fingerprint = json.loads(header)["fingerprint"]
+                except (ValueError, KeyError):
+                    fingerprint = None
+                if fingerprint != self.fingerprint:
+                    logger.warning(f"Starting over {self.path}, which has predictions with other options")
+                else:
+                    end = len(header)
+                    for line, instance in zip(file, instances):
+                        try:
+                            if not line.endswith(b"\n"):
+                                raise ValueError()
+                            entry = json.loads(line)
+                        except ValueError:
+                            break  # the end of a write that was cut off
+                        if entry["index"] != len(predictions) or \
+                                entry["id"] != self._instance_id(instance, len(predictions)):
+                            logger.warning(f"Starting over {self.path}, which has predictions for other instances")
+                            predictions = []
+                            end = 0
+                            break
+                        predictions.append(entry["prediction"])
+                        end += len(line)
+        if end == 0:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            header = json.dumps({"fingerprint": self.fingerprint, "description": self.description}, default=repr)
+            with open(self.path, 'w') as file:
+                file.write(header + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+        else:
+            with open(self.path, 'r+b') as file:
+                file.truncate(end)
+        return predictions
+
+    def append(self, start_index: int, instances: Sequence[Dict[str, Any]], predictions: Sequence[Any]) -> List[Any]:
+        """Writes the predictions of the instances from `start_index` on, and returns them as they read back."""
+        assert len(instances) == len(predictions)
+        written = []
+        with open(self.path, 'a') as file:
+            for index, (instance, prediction) in enumerate(zip(instances, predictions), start=start_index):
+                line = json.dumps({"index": index, "id": self._instance_id(instance, index),
+                                   "prediction": sanitize(prediction)})
+                file.write(line + "\n")
+                written.append(json.loads(line)["prediction"])
+            file.flush()
+            os.fsync(file.fileno())
+        return written
+
 
 class PredictStep():
     def run(
@@ -17,12 +113,55 @@ class PredictStep():
         split: Optional[str] = None,
         limit: Optional[int] = None,
         random_subsample_seed: Optional[int] = None,
+        num_shards: int = 1,
+        shard_index: int = 0,
+        checkpoint_file: Optional[str] = None,  # log of the predictions so far, to resume an interrupted run
+        checkpoint_every: int = 1000,  # instances to predict between writes to the checkpoint_file
         **kwargs
     ) -> Sequence[Any]:
         results = []
-        instances = get_instances(task, split, limit, random_subsample_seed)
-        for result in model.predict(task, instances, **kwargs):
-            results.append(result)
+        instances = get_instances(task, split, limit, random_subsample_seed, num_shards, shard_index)
+        if model.supports_instance_indices:
+            # few-shot examples are seeded by the index of the instance in the task, not in its shard,
+            # so every shard predicts its instances as the unsharded run does
+            kwargs["instance_indices"] = range(shard_index, shard_index + len(instances) * num_shards, num_shards)
+        elif num_shards > 1 and kwargs.get("num_shots") and kwargs.get("fewshot_seed") is None:
+            raise ValueError(
+                f"{model.__class__.__name__} seeds few-shot examples by the position of an instance in its shard, "
+                f"so a sharded run would not match an unsharded one. Set a fewshot_seed, or do not shard.")
+        if checkpoint_file is None:
+            for result in model.predict(task, instances, **kwargs):
+                results.append(result)
+            return results
+
+        # The instances are predicted in one stream, and its predictions appended to the log in batches of
+        # checkpoint_every. Resuming predicts the rest of the instances as they would have been.
+        log = PredictionLog(checkpoint_file, {
+            "model": model_identity(model, None, None),
+            "split": split,
+            "limit": limit,
+            "random_subsample_seed": random_subsample_seed,
+            "num_shards": num_shards,
+            "shard_index": shard_index,
+            "options": {key: value for key, value in kwargs.items()
+                        if key not in _SCHEDULING_OPTIONS and key != "instance_indices"},
+        })
+        results = log.load(instances)
+        if results:
+            logger.info(f"Resuming from {len(results)} of {len(instances)} predictions in {checkpoint_file}")
+        start = len(results)
+        if start >= len(instances):
+            return results
+        if "num_recorded_inputs" in kwargs:
+            # only record the inputs of the first instances of the task, not again when resuming
+            kwargs["num_recorded_inputs"] = max(0, (kwargs["num_recorded_inputs"] or 0) - start)
+        if "instance_indices" in kwargs:
+            kwargs["instance_indices"] = kwargs["instance_indices"][start:]
+        predictions = model.predict(task, instances[start:], **kwargs)
+        for batch in more_itertools.chunked(predictions, checkpoint_every):
+            # as they read back, so a run that resumes sees the same predictions as one that did not stop
+            results.extend(log.append(start, instances[start:start + len(batch)], batch))
+            start += len(batch)
         return results
 
 
@@ -3,7 +3,7 @@ from dataclasses import dataclass
 from enum import Enum
 from functools import partial
 from random import Random
-from typing import Dict, Any, Optional, Sequence, Union, List, Callable, Mapping, Tuple, Iterable
+from typing import Dict, Any, Optional, Sequence, Union, List, Callable, Mapping, Tuple, Iterable, TypeVar
 
 import torchmetrics
 from mypy_extensions import KwArg
@@ -24,6 +24,8 @@ QA_METRICS = {
     "squad_metrics": torchmetrics.SQuAD,
 }
 
+T = TypeVar("T")
+
 try:
     from functools import cache as memoize  # type: ignore
 except ImportError:
@@ -78,6 +80,7 @@ class InstanceFormat(Enum):
     T5_PROMPT = 6
     RANK_CLASSIFICATION = 7
     PROMPTSOURCE = 9
+    TOKENS = 11
 
 
 @dataclass
@@ -144,8 +147,14 @@ class Task(Registrable, ABC):
         num_shots: int,
         *,
         exceptions: Union[None, Dict[str, Any], Iterable[Dict[str, Any]]] = None,
-        random_seed: int = 18830087
+        random_seed: int = 18830087,
+        nested: bool = False
     ) -> Sequence[Dict[str, Any]]:
+        """
+        Samples `num_shots` instances from the few-shot split, none of which are in `exceptions`. With `nested`,
+        the instances for `num_shots` are the first ones of the instances for any larger `num_shots` with the
+        same `random_seed`, so that prompts with more shots start with the prompts with fewer shots.
+        """
         if num_shots <= 0:
             return []
 
@@ -157,6 +166,10 @@ class Task(Registrable, ABC):
 
         r = Random(random_seed)
         instances = self.get_split(self.fewshot_instances_split)
+        if nested:
+            return nested_sample(
+                r, instances, min(num_shots, len(instances)),
+                skip=lambda instance: det_hash(instance) in exceptions)
         sampled_instances = [
             instance
             for instance in r.sample(instances, num_shots + len(exceptions))
@@ -188,6 +201,45 @@ class Task(Registrable, ABC):
         return self
 
 
+def nested_sample(
+    rnd: Random,
+    population: Sequence[T],
+    k: int,
+    *,
+    skip: Optional[Callable[[T], bool]] = None
+) -> List[T]:
+    """
+    Samples `k` items from `population` without replacement, like `rnd.sample()`, but drawing one item at a
+    time, so that starting from the same state of `rnd`, the sample of `k` items is the start of the sample of
+    `k + 1` items. Items for which `skip` returns `True` are passed over, so there may be fewer than `k` of them.
+    """
+    if k > len(population):
+        raise ValueError("Sample larger than population")
+    picked = set()
+    sample: List[T] = []
+    while len(sample) < k and len(picked) < len(population):
+        index = rnd.randrange(len(population))
+        if index in picked:
+            continue
+        picked.add(index)
+        item = population[index]
+        if skip is None or not skip(item):
+            sample.append(item)
+    return sample
+
+
+class NestedRandom(Random):
+    """
+    A `Random` whose `sample()` is :func:`nested_sample`, for code that draws few-shot examples with
+    `rnd.sample()`, such as the Eleuther tasks.
+    """
+
+    def sample(self, population, k, *, counts=None):  # type: ignore
+        if counts is not None:
+            return super().sample(population, k, counts=counts)
+        return nested_sample(self, population, k)
+
+
 class WithAnswerOptionsMixin:
     def __init__(self, answer_options: Sequence[str]):
         self.answer_options = answer_options
@@ -14,6 +14,7 @@ from catwalk.tasks.raft import RaftTask
 from catwalk.tasks.metaicl import MetaICLTask
 from catwalk.tasks.mrqa import MrqaTask
 from catwalk.tasks.t5 import t5_prompt_conversion
+from catwalk.tasks.perplexity_jsonl import JsonLInstances
 
 TASKS = {}
 # Comment out bulk of tasks to avoid spurious errors when trying to load them
@@ -599,9 +600,20 @@ def get_instances(task: Union[str, Task],
                   split: Optional[str] = None,
                   limit: Optional[int] = None,
                   random_subsample_seed: Optional[int] = None,
+                  num_shards: int = 1,
+                  shard_index: int = 0,
                   ) -> Sequence[Dict[str, Any]]:
     instances = task.get_split(split)
     if limit is not None and len(instances) > limit:
-        instances = instances[:limit] if random_subsample_seed is None else Random(random_subsample_seed).sample(instances, limit)
+        if random_subsample_seed is None:
+            instances = instances[:limit]
+        elif isinstance(instances, JsonLInstances):
+            # same sample as Random.sample(instances, limit), but read in one pass over the files
+            instances = instances.take(Random(random_subsample_seed).sample(range(len(instances)), limit))
+        else:
+            instances = Random(random_subsample_seed).sample(instances, limit)
+    if num_shards > 1:
+        # every num_shards-th instance, so the shards are alike and can be interleaved back into order
+        instances = instances[shard_index::num_shards]
     return instances
 
@@ -10,7 +10,7 @@ from catwalk.dependencies.lm_eval.tasks import get_task as get_eai_task
 from catwalk.dependencies.lm_eval.tasks.hendrycks_test import SUBJECTS
 from catwalk.metrics import EleutherMetrics
 from catwalk.task import Task, InstanceFormat, RankClassificationInstance, WithAnswerOptionsMixin, \
-    classification_metrics, rc_metrics
+    classification_metrics, rc_metrics, NestedRandom
 from catwalk.tasks.promptsource import WithPromptsourceMixin
 
 T = TypeVar("T")
@@ -104,12 +104,16 @@ class EleutherTask(Task, WithPromptsourceMixin):
                                      instance: Dict[str, Any],
                                      *,
                                      num_fewshot: int = 0,
-                                     fewshot_seed: int = 18830087) -> str:
-        rnd = random.Random(fewshot_seed)
+                                     fewshot_seed: int = 18830087,
+                                     nested_fewshot: bool = False) -> str:
+        # nested sampling makes the examples for fewer shots the first ones of the examples for more shots
+        rnd = NestedRandom(fewshot_seed) if nested_fewshot else random.Random(fewshot_seed)
         return self.inner_task.fewshot_context(self.instance_as_eleuther_doc(instance), num_fewshot, rnd=rnd)
 
-    def instance_as_eleuther_requests(self, instance: Dict[str, Any], *, num_fewshot: int =0, fewshot_seed=None):
-        context = self.instance_to_eleuther_context(instance, num_fewshot=num_fewshot, fewshot_seed=fewshot_seed)
+    def instance_as_eleuther_requests(self, instance: Dict[str, Any], *, num_fewshot: int =0, fewshot_seed=None,
+                                      nested_fewshot: bool = False):
+        context = self.instance_to_eleuther_context(
+            instance, num_fewshot=num_fewshot, fewshot_seed=fewshot_seed, nested_fewshot=nested_fewshot)
         return self.inner_task.construct_requests(self.instance_as_eleuther_doc(instance), context)
 
     def _guess_label(self, instance: Dict[str, Any]) -> int:
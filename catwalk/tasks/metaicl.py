@@ -49,7 +49,9 @@ class MetaICLTask(Task):
         *,
         exceptions: Union[None, Dict[str, Any], Iterable[Dict[str, Any]]] = None,
         random_seed: int = 100,
+        nested: bool = False,
     ) -> Sequence[Dict[str, Any]]:
+        # The prebuilt few-shot instances are subsampled from the front, so they are always nested.
         if num_shots == 0:
             return []
         assert random_seed in [100, 13, 21, 42, 87] and num_shots <= 16, "Only prebuilt seeds supported for now"
@@ -1,6 +1,10 @@
-from typing import Dict, Any, Sequence
+from typing import Dict, Any, Sequence, List, Tuple, Optional, Iterator, Union
+from array import array
+from bisect import bisect_right
 from copy import deepcopy
 import gzip
+import hashlib
+import itertools
 import json
 import os
 
@@ -9,21 +13,215 @@ from cached_path import cached_path
 
 # Task for evaluating a generic set of files (or URLs) on perplexity metrics
 
+
+class JsonLInstances(Sequence[Dict[str, Any]]):
+    """
+    The instances of a set of jsonl (or jsonl.gz) files, read from the files as they are needed instead of
+    being loaded into memory up front. Iterating streams through the files one after the other, and
+    slicing gives a view that streams a range of lines.
+
+    Random access and the length rely on a sparse index with the byte offset of every `INDEX_STRIDE`-th
+    instance of each file, which is built in one pass over the file the first time it is needed. If
+    `index_dir` is set, the index is saved there and reused as long as the file does not change.
+    Taking the length of a view that was not sliced (as `predict` does) therefore reads every file once
+    before the first instance is scored, unless the index is already in `index_dir`.
+
+    The index only makes random access cheap for uncompressed files. A .gz file can only seek by
+    decompressing from its start, so every integer index into it costs a pass over the file up to that
+    instance. Iterate, slice or `take()` instead, which read each file in one forward pass.
+    """
+
+    INDEX_STRIDE = 1024
+
+    def __init__(
+        self,
+        files: Sequence[Tuple[str, str]],  # (original file name, local path)
+        index_dir: Optional[str] = None,
+        _indices: Optional[range] = None,
+        _file_indexes: Optional[List[Optional[Tuple[int, array]]]] = None,
+    ):
+        self.files = list(files)
+        self.index_dir = index_dir
+        self._indices = _indices
+        # per file, the number of instances and the offsets of every INDEX_STRIDE-th instance
+        self._file_indexes = _file_indexes if _file_indexes is not None else [None] * len(self.files)
+
+    def _open(self, file_index: int):
+        orig_file, path = self.files[file_index]
+        if orig_file.endswith('.gz'):
+            return gzip.open(path, 'rb')
+        return open(path, 'rb')
+
+    def _parse(self, file_index: int, line: bytes) -> Dict[str, Any]:
+        instance = json.loads(line.decode("utf-8").strip())
+        instance["orig_file_name"] = self.files[file_index][0]
+        return instance
+
+    def _index_path(self, path: str) -> Optional[str]:
+        if self.index_dir is None:
+            return None
+        stat = os.stat(path)
+        key = json.dumps([os.path.abspath(path), stat.st_size, stat.st_mtime, self.INDEX_STRIDE])
+        return os.path.join(self.index_dir, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json")
+
+    def _file_index(self, file_index: int) -> Tuple[int, array]:
+        if self._file_indexes[file_index] is not None:
+            return self._file_indexes[file_index]
+        path = self.files[file_index][1]
+        index_path = self._index_path(path)
+        if index_path is not None and os.path.exists(index_path):
+            with open(index_path, 'r') as index_file:
+                saved = json.load(index_file)
+            result = (saved["num_instances"], array('q', saved["offsets"]))
+        else:
+            num_instances = 0
+            offsets = array('q')
+            offset = 0
+            with self._open(file_index) as file:
+                for line in file:
+                    if line.strip():
+                        if num_instances % self.INDEX_STRIDE == 0:
+                            offsets.append(offset)
+                        num_instances += 1
+                    offset += len(line)
+            result = (num_instances, offsets)
+            if index_path is not None:
+                os.makedirs(self.index_dir, exist_ok=True)
+                with open(index_path, 'w') as index_file:
+                    json.dump({"num_instances": num_instances, "offsets": offsets.tolist()}, index_file)
+        self._file_indexes[file_index] = result
+        return result
+
+    def _file_starts(self) -> List[int]:
+        starts = [0]
+        for file_index in range(len(self.files)):
+            starts.append(starts[-1] + self._file_index(file_index)[0])
+        return starts
+
+    @property
+    def indices(self) -> range:
+        """The positions of the instances in this view, counting over all the files."""
+        if self._indices is None:
+            self._indices = range(self._file_starts()[-1])
+        return self._indices
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def _iter_from(self, position: int, stop: int) -> Iterator[Dict[str, Any]]:
+        """Streams the instances from `position` up to `stop`, counting over all the files."""
+        if position >= stop:
+            return
+        starts = self._file_starts()
+        file_index = bisect_right(starts, position) - 1
+        while position < stop and file_index < len(self.files):
+            num_instances, offsets = self._file_index(file_index)
+            local_position = position - starts[file_index]
+            if local_position < num_instances:
+                with self._open(file_index) as file:
+                    file.seek(offsets[local_position // self.INDEX_STRIDE])
+                    skip = local_position % self.INDEX_STRIDE
+                    for line in file:
+                        if not line.strip():
+                            continue
+                        if skip > 0:
+                            skip -= 1
+                            continue
+                        yield self._parse(file_index, line)
+                        position += 1
+                        if position >= stop:
+                            return
+            file_index += 1
+            position = starts[file_index]
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        if self._indices is None:
+            # streaming the whole set does not need the index
+            for file_index in range(len(self.files)):
+                with self._open(file_index) as file:
+                    for line in file:
+                        if line.strip():
+                            yield self._parse(file_index, line)
+        elif self._indices.step > 0:
+            # a strided view (a shard) streams its whole range and keeps every step-th instance
+            if len(self._indices) > 0:
+                yield from itertools.islice(
+                    self._iter_from(self._indices.start, self._indices[-1] + 1), 0, None, self._indices.step)
+        else:
+            yield from self.take(range(len(self)))
+
+    def __getitem__(self, item: Union[int, slice]):
+        if isinstance(item, slice):
+            return JsonLInstances(self.files, self.index_dir, self.indices[item], self._file_indexes)
+        position = self.indices[item]
+        return next(self._iter_from(position, position + 1))
+
+    def take(self, indices: Sequence[int]) -> List[Dict[str, Any]]:
+        """Reads the instances at `indices`, opening each file once and only ever seeking forward."""
+        positions = [self.indices[i] for i in indices]
+        wanted = sorted(set(positions))
+        starts = self._file_starts()
+        found: Dict[int, Dict[str, Any]] = {}
+        w = 0
+        while w < len(wanted):
+            file_index = bisect_right(starts, wanted[w]) - 1
+            _, offsets = self._file_index(file_index)
+            with self._open(file_index) as file:
+                local_position = None  # the position of the next instance in the file
+                while w < len(wanted) and wanted[w] < starts[file_index + 1]:
+                    target = wanted[w] - starts[file_index]
+                    checkpoint = target - target % self.INDEX_STRIDE
+                    if local_position is None or local_position < checkpoint:
+                        file.seek(offsets[target // self.INDEX_STRIDE])
+                        local_position = checkpoint
+                    for line in file:
+                        if not line.strip():
+                            continue
+                        local_position += 1
+                        if local_position > target:
+                            found[wanted[w]] = self._parse(file_index, line)
+                            break
+                    w += 1
+        result = []
+        seen = set()
+        for position in positions:
+            result.append(deepcopy(found[position]) if position in seen else found[position])
+            seen.add(position)
+        return result
+
+    def shards(self) -> List["JsonLInstances"]:
+        """Splits this view into one view per file, so files can be read and scored independently."""
+        assert self.indices.step == 1
+        starts = self._file_starts()
+        result = []
+        for file_index in range(len(self.files)):
+            file_range = range(
+                max(starts[file_index], self.indices.start),
+                min(starts[file_index + 1], self.indices.stop))
+            if len(file_range) > 0:
+                result.append(JsonLInstances(self.files, self.index_dir, file_range, self._file_indexes))
+        return result
+
+
 class PerplexityJsonLTask(Task):
     def __init__(
         self,
-        files=None  # files (or URLs) to be used
+        files=None,  # files (or URLs) to be used
+        index_dir: Optional[str] = None  # where to keep the offset index of each file, if anywhere
     ):
         Task.__init__(self)
         self.files = files
+        self.index_dir = index_dir
         self._cached_paths = None
         self._cache_dir = None   # Can override cache dir
         self.add_instance_conversion(InstanceFormat.ELEUTHER_DOC, self.instance_as_eleuther_doc)
         self.file_extensions = ['.jsonl.gz']
 
-    def clone(self, files):
+    def clone(self, files, index_dir: Optional[str] = None):
         new_task = deepcopy(self)
         new_task.files = files
+        if index_dir is not None:
+            new_task.index_dir = index_dir
         return new_task
 
     def has_split(self, split: str) -> bool:
@@ -36,8 +234,7 @@ class PerplexityJsonLTask(Task):
                 self._cached_paths.append((file, cached_path(file, cache_dir=self._cache_dir)))
         return self._cached_paths
 
-    def get_split(self, split: str) -> Sequence[Dict[str, Any]]:
-        instances = []
+    def get_split(self, split: str) -> JsonLInstances:
         all_files = []
         # expand directories if need be
         for (orig_file, cache_file) in self.cached_paths():
@@ -49,21 +246,7 @@ class PerplexityJsonLTask(Task):
                                 all_files.append((file, os.path.join(root, file)))
             else:
                 all_files.append((orig_file, cache_file))
-
-        for (orig_file, cache_file) in all_files:
-            if orig_file.endswith('.gz'):
-                with gzip.open(cache_file, 'r') as file:
-                    for line in file:
-                        instance = json.loads(line.decode("utf-8").strip())
-                        instance["orig_file_name"] = orig_file
-                        instances.append(instance)
-            else:
-                with open(cache_file, 'r') as file:
-                    for line in file:
-                        instance = json.loads(line.strip())
-                        instance["orig_file_name"] = orig_file
-                        instances.append(instance)
-        return instances
+        return JsonLInstances(all_files, index_dir=self.index_dir)
 
     def instance_as_eleuther_doc(self, instance):
         return instance.get('text', instance.get('doc'))
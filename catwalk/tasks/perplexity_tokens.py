@@ -0,0 +1,144 @@
+from typing import Dict, Any, Sequence, List, Tuple, Optional, Union
+from bisect import bisect_right
+from copy import deepcopy
+from dataclasses import dataclass
+import json
+import os
+
+import numpy as np
+from cached_path import cached_path
+
+from catwalk.task import Task, InstanceFormat
+
+# Task for evaluating perplexity on documents that were tokenized ahead of time, see catwalk/tokenize_jsonl.py
+
+SHARD_SUFFIX = ".shard.json"
+
+
+@dataclass
+class TokenizedDocument:
+    token_ids: np.ndarray  # a read-only view into the memory-mapped tokens of the shard
+    num_chars: int
+    num_words: int
+    num_bytes: int
+    tokenizer_fingerprint: str
+
+
+class TokenShard:
+    """
+    One shard of pre-tokenized documents, written by `catwalk.tokenize_jsonl`:
+
+    * `<name>.shard.json`: the metadata, including the dtype of the tokens and the fingerprint of the
+      tokenizer (see :func:`catwalk.utils.tokenizer_fingerprint`)
+    * `<name>.tokens.bin`: the tokens of all documents, back to back, as raw uint16 or uint32
+    * `<name>.offsets.npy`: where every document starts in the tokens, plus the total number of tokens
+    * `<name>.stats.npy`: the number of characters, words and bytes of every document
+
+    The tokens are read through `numpy.memmap`, so only the pages that are scored are ever loaded.
+    """
+
+    def __init__(self, metadata_path: str):
+        self.metadata_path = metadata_path
+        with open(metadata_path, 'r') as file:
+            self.metadata = json.load(file)
+        prefix = metadata_path[:-len(SHARD_SUFFIX)]
+        self.offsets = np.load(prefix + ".offsets.npy", mmap_mode='r')
+        self.stats = np.load(prefix + ".stats.npy", mmap_mode='r')
+        if self.offsets[-1] > 0:
+            self.tokens = np.memmap(prefix + ".tokens.bin", dtype=self.metadata["dtype"], mode='r')
+        else:
+            self.tokens = np.zeros(0, dtype=self.metadata["dtype"])  # numpy cannot map an empty file
+        assert len(self.offsets) == len(self.stats) + 1
+        assert len(self.tokens) == self.offsets[-1]
+
+    @property
+    def tokenizer_fingerprint(self) -> str:
+        return self.metadata["tokenizer_fingerprint"]
+
+    def __len__(self) -> int:
+        return len(self.stats)
+
+    def document(self, index: int) -> TokenizedDocument:
+        num_chars, num_words, num_bytes = (int(x) for x in self.stats[index])
+        return TokenizedDocument(
+            token_ids=self.tokens[self.offsets[index]:self.offsets[index + 1]],
+            num_chars=num_chars,
+            num_words=num_words,
+            num_bytes=num_bytes,
+            tokenizer_fingerprint=self.tokenizer_fingerprint)
+
+
+class TokenShardInstances(Sequence[Dict[str, Any]]):
+    """The documents of a list of shards, as small instances that only say where each document is."""
+
+    def __init__(self, shards: Sequence[Tuple[str, TokenShard]]):
+        self.shards = list(shards)
+        self._starts = [0]
+        for _, shard in self.shards:
+            self._starts.append(self._starts[-1] + len(shard))
+
+    def __len__(self) -> int:
+        return self._starts[-1]
+
+    def __getitem__(self, item: Union[int, slice]):
+        if isinstance(item, slice):
+            return [self[i] for i in range(len(self))[item]]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError(item)
+        shard_index = bisect_right(self._starts, item) - 1
+        orig_file, shard = self.shards[shard_index]
+        return {"orig_file_name": orig_file, "shard": shard.metadata_path, "doc_id": item - self._starts[shard_index]}
+
+
+class PerplexityTokensTask(Task):
+    def __init__(
+        self,
+        files=None  # shard metadata files, or directories (or archives) of them
+    ):
+        Task.__init__(self)
+        self.files = files
+        self._cache_dir = None   # Can override cache dir
+        self._shards: Optional[Dict[str, TokenShard]] = None
+        self.add_instance_conversion(InstanceFormat.TOKENS, self.instance_as_tokens)
+
+    def clone(self, files):
+        # copying the loaded shards would read their memory-mapped tokens
+        shards, self._shards = self._shards, None
+        new_task = deepcopy(self)
+        self._shards = shards
+        new_task.files = files
+        return new_task
+
+    def has_split(self, split: str) -> bool:
+        return True  # Assume the files are for the requested split
+
+    def _load_shards(self) -> Dict[str, TokenShard]:
+        if self._shards is None:
+            self._shards = {}
+            for file in self.files:
+                local_path = str(cached_path(file, cache_dir=self._cache_dir))
+                if os.path.isdir(local_path):
+                    for root, dirs, files in os.walk(local_path):
+                        for name in sorted(files):
+                            if name.endswith(SHARD_SUFFIX):
+                                path = os.path.join(root, name)
+                                self._shards[path] = TokenShard(path)
+                else:
+                    self._shards[local_path] = TokenShard(local_path)
+            fingerprints = {shard.tokenizer_fingerprint for shard in self._shards.values()}
+            if len(fingerprints) > 1:
+                raise ValueError(f"Shards of {self.files} were made with {len(fingerprints)} different tokenizers")
+        return self._shards
+
+    def get_split(self, split: str) -> TokenShardInstances:
+        return TokenShardInstances(
+            [(shard.metadata.get("source", path), shard) for path, shard in self._load_shards().items()])
+
+    def instance_as_tokens(self, instance) -> TokenizedDocument:
+        return self._load_shards()[instance["shard"]].document(instance["doc_id"])
+
+    @property
+    def default_split(self) -> str:
+        return "validation"
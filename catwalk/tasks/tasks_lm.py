@@ -9,6 +9,7 @@ from catwalk.task import InstanceFormat, ENTAILMENT_METRICS, QA_METRICS, Task, \
 from catwalk.tasks.eleuther import EleutherTask, RaceEleutherTask, EleutherTaskWithRenamedSplits, \
     EleutherClassificationTask, EleutherClassificationTaskWithRenamedSplits, create_mmlu_tasks
 from catwalk.tasks.perplexity_jsonl import PerplexityJsonLTask
+from catwalk.tasks.perplexity_tokens import PerplexityTokensTask
 from catwalk.tasks.huggingface import hfmc_conversion, HFDatasetsTask, hfqa_conversion, hfclassification_conversion
 from catwalk.tasks.p3 import P3Task
 from catwalk.tasks.raft import RaftTask
@@ -23,6 +24,7 @@ TASKS_LM: Dict[str, Task] = {
     "squad2": EleutherTask("squad2", eleuther_metrics=True),
     "drop": EleutherTask("drop", eleuther_metrics=True, model_args = {"max_gen_toks": 50}),
     "ppl_custom": PerplexityJsonLTask().add_metrics(ppl_metrics(primary="ppl_token")),
+    "ppl_tokens": PerplexityTokensTask().add_metrics(ppl_metrics(primary="ppl_token")),
     "wikitext": EleutherTask("wikitext").add_metrics(ppl_metrics(primary="ppl_token")),
     "piqa": EleutherTask("piqa", ranked_classification=True).add_metrics(rc_metrics(primary="acc_per_token")),
     "mrpc": EleutherClassificationTask("mrpc", answer_options=["no", "yes"], metrics=rc_metrics(primary="acc_raw")),
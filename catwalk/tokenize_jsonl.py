@@ -0,0 +1,82 @@
+import argparse
+import json
+import logging
+import os
+import re
+
+import more_itertools
+import numpy as np
+from tango.common import Tqdm
+from tango.common.logging import initialize_logging
+from transformers import AutoTokenizer
+
+from catwalk import cached_transformers
+from catwalk.tasks.perplexity_jsonl import PerplexityJsonLTask, JsonLInstances
+from catwalk.tasks.perplexity_tokens import SHARD_SUFFIX
+from catwalk.utils import tokenizer_fingerprint
+
+# Tokenizes jsonl(.gz) files once into shards that the ppl_tokens task can score with any model sharing the
+# tokenizer, for example:
+#
+#   python -m catwalk.tokenize_jsonl --tokenizer EleutherAI/pythia-160m --output_dir shards/ data/*.jsonl.gz
+
+_parser = argparse.ArgumentParser()
+_parser.add_argument('files', type=str, nargs="+", help="Jsonl(.gz) files (or URLs, or directories of them)")
+_parser.add_argument('--tokenizer', type=str, required=True, help="Name or path of the Huggingface tokenizer")
+_parser.add_argument('--output_dir', type=str, required=True)
+_parser.add_argument('--text_field', type=str, help="Field with the text, defaults to 'text' or 'doc'")
+_parser.add_argument('--batch_size', type=int, default=1000, help="Documents to tokenize at once")
+
+
+def write_shard(documents, prefix: str, tokenizer, *, source: str, text_field=None, batch_size: int = 1000) -> dict:
+    """
+    Tokenizes `documents` into the shard at `prefix` (see :class:`catwalk.tasks.perplexity_tokens.TokenShard`),
+    streaming the tokens to disk so only `batch_size` documents are in memory at a time.
+    """
+    dtype = np.uint16 if len(tokenizer) <= np.iinfo(np.uint16).max + 1 else np.uint32
+    offsets = [0]
+    stats = []
+    with open(prefix + ".tokens.bin", 'wb') as tokens_file:
+        for batch in more_itertools.chunked(documents, batch_size):
+            texts = [
+                document[text_field] if text_field else document.get('text', document.get('doc'))
+                for document in batch
+            ]
+            for text, token_ids in zip(texts, tokenizer(texts, add_special_tokens=False)["input_ids"]):
+                tokens_file.write(np.asarray(token_ids, dtype=dtype).tobytes())
+                offsets.append(offsets[-1] + len(token_ids))
+                # the same counts predict_chunk_perplexity reports for a text
+                stats.append((len(text), len(re.split(r"\s+", text)), len(text.encode("utf-8"))))
+    np.save(prefix + ".offsets.npy", np.asarray(offsets, dtype=np.int64))
+    np.save(prefix + ".stats.npy", np.asarray(stats, dtype=np.int64).reshape(-1, 3))
+    metadata = {
+        "source": source,
+        "dtype": np.dtype(dtype).name,
+        "num_documents": len(stats),
+        "num_tokens": offsets[-1],
+        "tokenizer": getattr(tokenizer, "name_or_path", None),
+        "tokenizer_fingerprint": tokenizer_fingerprint(tokenizer),
+    }
+    with open(prefix + SHARD_SUFFIX, 'w') as file:
+        json.dump(metadata, file, indent=2)
+    return metadata
+
+
+def main(args: argparse.Namespace):
+    initialize_logging(log_level="INFO")
+    logger = logging.getLogger()
+    tokenizer = cached_transformers.get_tokenizer(AutoTokenizer, args.tokenizer)
+    os.makedirs(args.output_dir, exist_ok=True)
+    task = PerplexityJsonLTask(files=args.files)
+    task.file_extensions = ['.jsonl.gz', '.jsonl']
+    # one shard per input file, streamed without building an offset index
+    for source, path in Tqdm.tqdm(task.get_split("validation").files, desc="Tokenizing files"):
+        name = re.sub(r"\.jsonl(\.gz)?$", "", os.path.basename(source))
+        metadata = write_shard(
+            JsonLInstances([(source, path)]), os.path.join(args.output_dir, name), tokenizer,
+            source=source, text_field=args.text_field, batch_size=args.batch_size)
+        logger.info(f"Wrote {metadata['num_documents']} documents, {metadata['num_tokens']} tokens from {source}")
+
+
+if __name__ == "__main__":
+    main(_parser.parse_args())
@@ -1,4 +1,6 @@
 from typing import Any
+import hashlib
+import json
 import dataclasses
 import numpy
 import torch
@@ -64,3 +66,20 @@ def filter_dict_keys(dictionary, key_list, remove_none=False):
     if remove_none:
         res = {k: v for k, v in res.items() if v is not None}
     return res
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """
+    A hash of everything that decides how a tokenizer splits text: its full serialization for fast
+    tokenizers, otherwise its vocabulary and special tokens. Used to check that pre-tokenized data
+    was produced by the tokenizer of the model that scores it.
+    """
+    backend_tokenizer = getattr(tokenizer, "backend_tokenizer", None)
+    if backend_tokenizer is not None:
+        description = backend_tokenizer.to_str()
+    else:
+        description = json.dumps({
+            "vocab": sorted(tokenizer.get_vocab().items()),
+            "special_tokens": {key: str(value) for key, value in tokenizer.special_tokens_map.items()},
+        })
+    return hashlib.sha256(description.encode("utf-8")).hexdigest()
@@ -0,0 +1,62 @@
+"""
+Compares the wall-clock time of log-likelihood requests of varied lengths, run eagerly and through
+`torch.compile` with shape buckets (`compile_bucket_size`). The compiled requests are run twice: the first
+pass pays for compiling the graph of every bucket, the second one shows the steady-state speed.
+
+    python experiments/benchmarks/compile_buckets.py --num_requests 512 --n_layer 6 --n_embd 512
+"""
+import argparse
+import time
+import types
+
+import torch
+
+from catwalk.models.compiled import compiled_base_model
+from catwalk.models.language_model import DecoderOnlyLanguageModel
+
+from tiny_model import make_tiny_gpt2
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_requests', type=int, default=512)
+    parser.add_argument('--max_length', type=int, default=256)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--compile_bucket_size', type=int, default=64)
+    parser.add_argument('--n_layer', type=int, default=6)
+    parser.add_argument('--n_embd', type=int, default=512)
+    args = parser.parse_args()
+
+    model = make_tiny_gpt2(n_layer=args.n_layer, n_embd=args.n_embd, n_head=8)
+    tokenizer = types.SimpleNamespace(model_max_length=args.max_length, eos_token_id=0)
+    g = torch.Generator().manual_seed(0)
+    cc_pairs = []
+    for _ in range(args.num_requests):
+        length = int(torch.randint(8, args.max_length, (1,), generator=g))
+        ids = torch.randint(1, model.config.vocab_size, (length,), generator=g)
+        cc_pairs.append({"input_ids": (ids[:-4], ids[-4:])})
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+
+    def run(name, **kwargs):
+        start = time.perf_counter()
+        results = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, args.batch_size, **kwargs)
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {elapsed:.2f}s, {len(cc_pairs) / elapsed:.1f} requests/s")
+        return results, elapsed
+
+    eager, eager_seconds = run("eager")
+    run("compiled, first pass", compile_bucket_size=args.compile_bucket_size)
+    compiled, compiled_seconds = run("compiled, second pass", compile_bucket_size=args.compile_bucket_size)
+
+    stats = compiled_base_model(model, args.compile_bucket_size, args.max_length).stats()
+    diffs = [abs(a["sum_logits"] - b["sum_logits"]) for a, b in zip(eager, compiled)]
+    print(f"{stats['num_shapes']} shapes compiled in {stats['compile_seconds']:.1f}s, "
+          f"{stats['eager_calls']} batches ran eagerly")
+    print(f"steady-state speedup: {eager_seconds / compiled_seconds:.2f}x, "
+          f"compiling pays off after {stats['compile_seconds'] / max(eager_seconds - compiled_seconds, 1e-9):.1f} "
+          f"passes over these requests")
+    print(f"sum_logits difference: max {max(diffs):.5f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Compares the peak memory and the wall-clock time of log-likelihood scoring with and without `full_logits`.
+Each setting runs in a fresh process, so the peak resident memory of one does not hide the other.
+
+    python experiments/benchmarks/continuation_logits.py --vocab_size 50257 --context_length 512
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+import types
+
+from catwalk.models.language_model import DecoderOnlyLanguageModel
+
+from tiny_model import make_tiny_gpt2, make_mc_pairs
+
+
+def run(args: argparse.Namespace, full_logits: bool, queue: multiprocessing.Queue):
+    model = make_tiny_gpt2(vocab_size=args.vocab_size)
+    tokenizer = types.SimpleNamespace(model_max_length=model.config.n_positions, eos_token_id=0)
+    cc_pairs = make_mc_pairs(
+        num_instances=args.num_instances,
+        num_choices=args.num_choices,
+        context_length=args.context_length,
+        vocab_size=args.vocab_size)
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    results = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, args.batch_size, full_logits=full_logits)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((elapsed, (peak - baseline) / 1024, [r["sum_logits"] for r in results]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_instances', type=int, default=32)
+    parser.add_argument('--num_choices', type=int, default=4)
+    parser.add_argument('--context_length', type=int, default=512)
+    parser.add_argument('--vocab_size', type=int, default=50257)
+    parser.add_argument('--batch_size', type=int, default=16)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    outputs = {}
+    for full_logits in [True, False]:
+        queue = context.Queue()
+        process = context.Process(target=run, args=(args, full_logits, queue))
+        process.start()
+        elapsed, peak_mb, outputs[full_logits] = queue.get()
+        process.join()
+        print(f"full_logits={full_logits}: peak memory growth {peak_mb:.0f} MB, {elapsed:.2f}s")
+
+    max_diff = max(abs(a - b) for a, b in zip(outputs[True], outputs[False]))
+    print(f"max sum_logits difference: {max_diff:.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Compares the number of tokens run through the model, and the wall-clock time, for multiple-choice scoring
+where the choices of an instance start with the same tokens, such as an "The answer is" preamble: with no
+sharing, with `share_context_kv`, and with `continuation_trie`.
+
+    python experiments/benchmarks/continuation_trie.py --preamble_length 8 --num_choices 4
+"""
+import argparse
+import time
+import types
+
+import torch
+
+from catwalk.models.language_model import DecoderOnlyLanguageModel
+
+from tiny_model import make_tiny_gpt2, count_tokens
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_instances', type=int, default=64)
+    parser.add_argument('--num_choices', type=int, default=4)
+    parser.add_argument('--context_length', type=int, default=256)
+    parser.add_argument('--preamble_length', type=int, default=8)
+    parser.add_argument('--answer_length', type=int, default=8)
+    parser.add_argument('--batch_size', type=int, default=16)
+    args = parser.parse_args()
+
+    model = make_tiny_gpt2()
+    tokenizer = types.SimpleNamespace(model_max_length=model.config.n_positions, eos_token_id=0)
+    g = torch.Generator().manual_seed(0)
+
+    def tokens(length):
+        return torch.randint(1, model.config.vocab_size, (length,), generator=g)
+
+    preamble = tokens(args.preamble_length)
+    cc_pairs = []
+    for _ in range(args.num_instances):
+        context = tokens(args.context_length)
+        for _ in range(args.num_choices):
+            answer = tokens(int(torch.randint(1, args.answer_length + 1, (1,), generator=g)))
+            cc_pairs.append({"input_ids": (context, torch.cat([preamble, answer]))})
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+
+    outputs = {}
+    for name, kwargs in [("no sharing", {}),
+                         ("share_context_kv", {"share_context_kv": True}),
+                         ("continuation_trie", {"continuation_trie": True})]:
+        with count_tokens(model.base_model) as counts:
+            start = time.perf_counter()
+            outputs[name] = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, args.batch_size, **kwargs)
+            elapsed = time.perf_counter() - start
+        # the rows of continuation_trie have a 4D mask, so their padding is counted as real tokens
+        print(f"{name}: {counts['real']} tokens processed ({counts['padded']} incl. padding) "
+              f"in {counts['forward_calls']} forward calls, {elapsed:.2f}s")
+
+    for name in ["share_context_kv", "continuation_trie"]:
+        max_diff = max(abs(a["sum_logits"] - b["sum_logits"]) for a, b in zip(outputs["no sharing"], outputs[name]))
+        same_greedy = all(a["is_greedy"] == b["is_greedy"] for a, b in zip(outputs["no sharing"], outputs[name]))
+        print(f"{name}: max sum_logits difference {max_diff:.2e}, is_greedy identical: {same_greedy}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Measures how the wall-clock time of log-likelihood requests scales with `num_workers`, the number of forked
+CPU worker processes the requests are split across, from one worker up to `--max_workers`.
+
+    python experiments/benchmarks/data_parallel.py --num_requests 1024 --max_workers 8
+"""
+import argparse
+import os
+import time
+import types
+
+import torch
+
+from catwalk.models.language_model import DecoderOnlyLanguageModel
+
+from tiny_model import make_tiny_gpt2
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_requests', type=int, default=1024)
+    parser.add_argument('--min_length', type=int, default=30)
+    parser.add_argument('--max_length', type=int, default=150)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--max_workers', type=int, default=len(os.sched_getaffinity(0)))
+    args = parser.parse_args()
+
+    model = make_tiny_gpt2()
+    tokenizer = types.SimpleNamespace(model_max_length=1024, eos_token_id=0)
+    g = torch.Generator().manual_seed(0)
+    cc_pairs = []
+    for _ in range(args.num_requests):
+        length = int(torch.randint(args.min_length, args.max_length + 1, (1,), generator=g))
+        ids = torch.randint(1, model.config.vocab_size, (length,), generator=g)
+        cc_pairs.append({"input_ids": (ids[:-3], ids[-3:])})
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+
+    num_workers = 1
+    baseline = None
+    while num_workers <= args.max_workers:
+        start = time.perf_counter()
+        outputs = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, args.batch_size, num_workers=num_workers)
+        elapsed = time.perf_counter() - start
+        if baseline is None:
+            baseline = (elapsed, outputs)
+        max_diff = max(abs(a["sum_logits"] - b["sum_logits"]) for a, b in zip(baseline[1], outputs))
+        print(f"num_workers={num_workers}: {elapsed:.2f}s, {baseline[0] / elapsed:.2f}x, "
+              f"max sum_logits difference: {max_diff:.2e}")
+        num_workers *= 2
+
+
+if __name__ == "__main__":
+    main()
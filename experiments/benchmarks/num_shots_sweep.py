@@ -0,0 +1,85 @@
+"""
+Compares the number of tokens run through the model, and the wall-clock time, for scoring multiple-choice
+instances at several numbers of nested few-shot examples: one run per number of shots with `share_context_kv`,
+and all of them in one run with a `PrefixCache`, where the prompt with more shots runs on top of the one with
+fewer.
+
+    python experiments/benchmarks/num_shots_sweep.py --shots 0 1 2 4 8 16 --demo_length 48
+"""
+import argparse
+import time
+import types
+
+import torch
+
+from catwalk.models.language_model import DecoderOnlyLanguageModel
+from catwalk.models.prefix_cache import PrefixCache
+
+from tiny_model import make_tiny_gpt2, count_tokens
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_instances', type=int, default=16)
+    parser.add_argument('--num_choices', type=int, default=4)
+    parser.add_argument('--shots', type=int, nargs="+", default=[0, 1, 2, 4, 8, 16])
+    parser.add_argument('--demo_length', type=int, default=48)
+    parser.add_argument('--question_length', type=int, default=24)
+    parser.add_argument('--batch_size', type=int, default=16)
+    args = parser.parse_args()
+
+    model = make_tiny_gpt2()
+    tokenizer = types.SimpleNamespace(model_max_length=model.config.n_positions, eos_token_id=0)
+    g = torch.Generator().manual_seed(0)
+
+    def tokens(length):
+        return torch.randint(1, model.config.vocab_size, (length,), generator=g)
+
+    # every instance has its own nested demos, the k-shot prompt starts with the first k of them
+    cc_pairs_by_shots = {num_shots: [] for num_shots in args.shots}
+    for _ in range(args.num_instances):
+        demos = [tokens(args.demo_length) for _ in range(max(args.shots))]
+        question = tokens(args.question_length)
+        continuations = [tokens(int(torch.randint(1, 8, (1,), generator=g))) for _ in range(args.num_choices)]
+        for num_shots in args.shots:
+            context = torch.cat(demos[:num_shots] + [question])
+            cc_pairs_by_shots[num_shots].extend({"input_ids": (context, continuation)} for continuation in continuations)
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+
+    with count_tokens(model.base_model) as counts:
+        start = time.perf_counter()
+        separate = {
+            num_shots: lm._run_loglikelihood_tokens(
+                cc_pairs, model, tokenizer, args.batch_size, share_context_kv=True)
+            for num_shots, cc_pairs in cc_pairs_by_shots.items()
+        }
+        elapsed = time.perf_counter() - start
+    print(f"one run per number of shots: {counts['real']} tokens processed in {counts['forward_calls']} "
+          f"forward calls, {elapsed:.2f}s")
+
+    # one instance after the other, with all its numbers of shots, as num_shots_sweep streams them
+    swept_pairs = [
+        cc_pairs_by_shots[num_shots][instance * args.num_choices + choice]
+        for instance in range(args.num_instances)
+        for num_shots in args.shots
+        for choice in range(args.num_choices)
+    ]
+    prefix_cache = PrefixCache(min_prefix_tokens=16)
+    with count_tokens(model.base_model) as counts:
+        start = time.perf_counter()
+        swept = lm._run_loglikelihood_tokens(swept_pairs, model, tokenizer, args.batch_size, prefix_cache=prefix_cache)
+        elapsed = time.perf_counter() - start
+    print(f"one sweep: {counts['real']} tokens processed in {counts['forward_calls']} forward calls, {elapsed:.2f}s")
+    print(f"  prefix cache: {prefix_cache.stats()}")
+
+    max_diff = 0.0
+    for i, result in enumerate(swept):
+        instance, rest = divmod(i, len(args.shots) * args.num_choices)
+        shots_index, choice = divmod(rest, args.num_choices)
+        expected = separate[args.shots[shots_index]][instance * args.num_choices + choice]
+        max_diff = max(max_diff, abs(expected["sum_logits"] - result["sum_logits"]))
+    print(f"max sum_logits difference {max_diff:.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Compares the number of positions run through the model, and the wall-clock time, for short log-likelihood
+requests of mixed length with and without `pack_requests`.
+
+    python experiments/benchmarks/packed_requests.py --num_requests 512 --min_length 30 --max_length 150
+"""
+import argparse
+import time
+import types
+
+import torch
+
+from catwalk.models.language_model import DecoderOnlyLanguageModel
+
+from tiny_model import make_tiny_gpt2, count_tokens
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_requests', type=int, default=512)
+    parser.add_argument('--min_length', type=int, default=30)
+    parser.add_argument('--max_length', type=int, default=150)
+    parser.add_argument('--model_max_length', type=int, default=1024)
+    parser.add_argument('--batch_size', type=int, default=32)
+    args = parser.parse_args()
+
+    model = make_tiny_gpt2()
+    tokenizer = types.SimpleNamespace(model_max_length=args.model_max_length, eos_token_id=0)
+    g = torch.Generator().manual_seed(0)
+    cc_pairs = []
+    for _ in range(args.num_requests):
+        length = int(torch.randint(args.min_length, args.max_length + 1, (1,), generator=g))
+        ids = torch.randint(1, model.config.vocab_size, (length,), generator=g)
+        cc_pairs.append({"input_ids": (ids[:-3], ids[-3:])})
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+
+    outputs = {}
+    for pack_requests in [False, True]:
+        # Packed rows are few and long, so give both runs the same token budget per batch.
+        max_batch_tokens = args.batch_size * args.max_length
+        with count_tokens(model) as counts:
+            start = time.perf_counter()
+            outputs[pack_requests] = lm._run_loglikelihood_tokens(
+                cc_pairs, model, tokenizer, args.batch_size,
+                max_batch_tokens=max_batch_tokens, pack_requests=pack_requests)
+            elapsed = time.perf_counter() - start
+        print(f"pack_requests={pack_requests}: {counts['padded']} positions "
+              f"in {counts['forward_calls']} forward calls, {elapsed:.2f}s")
+
+    max_diff = max(
+        abs(a["sum_logits"] - b["sum_logits"])
+        for a, b in zip(outputs[False], outputs[True]))
+    same_greedy = all(a["is_greedy"] == b["is_greedy"] for a, b in zip(outputs[False], outputs[True]))
+    print(f"max sum_logits difference: {max_diff:.2e}, is_greedy identical: {same_greedy}")
+
+
+if __name__ == "__main__":
+    main()
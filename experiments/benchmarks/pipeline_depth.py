@@ -0,0 +1,50 @@
+"""
+Compares the wall-clock time of log-likelihood requests with the batches prepared, run and finished one
+after another in one thread (`pipeline_depth=0`), and with preparing and finishing overlapped with the
+model in background threads. Logs how long every stage was busy and idle.
+
+    python experiments/benchmarks/pipeline_depth.py --num_requests 2048 --depths 0 1 4
+"""
+import argparse
+import logging
+import time
+import types
+
+import torch
+
+from catwalk.models.language_model import DecoderOnlyLanguageModel
+
+from tiny_model import make_tiny_gpt2
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_requests', type=int, default=2048)
+    parser.add_argument('--max_length', type=int, default=128)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--depths', type=int, nargs="+", default=[0, 1, 4])
+    parser.add_argument('--n_layer', type=int, default=2)
+    parser.add_argument('--n_embd', type=int, default=128)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logging.getLogger("catwalk.models.batching").setLevel(logging.WARNING)
+
+    model = make_tiny_gpt2(n_layer=args.n_layer, n_embd=args.n_embd)
+    tokenizer = types.SimpleNamespace(model_max_length=args.max_length, eos_token_id=0)
+    g = torch.Generator().manual_seed(0)
+    cc_pairs = []
+    for _ in range(args.num_requests):
+        length = int(torch.randint(8, args.max_length, (1,), generator=g))
+        ids = torch.randint(1, model.config.vocab_size, (length,), generator=g)
+        cc_pairs.append({"input_ids": (ids[:-4], ids[-4:]), "attention_mask": (torch.ones(length - 4), torch.ones(4))})
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+
+    for depth in args.depths:
+        start = time.perf_counter()
+        lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, args.batch_size, pipeline_depth=depth)
+        elapsed = time.perf_counter() - start
+        print(f"pipeline_depth={depth}: {elapsed:.2f}s, {len(cc_pairs) / elapsed:.1f} requests/s")
+
+
+if __name__ == "__main__":
+    main()
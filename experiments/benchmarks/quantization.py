@@ -0,0 +1,62 @@
+"""
+Compares the wall-clock time and the results of log-likelihood requests for a model in fp32 and with
+`quantize="int8-dynamic"`, on multiple choice style requests: several continuations of each context. Reports
+how far the log-likelihoods move, and how often both models pick the same continuation.
+
+    python experiments/benchmarks/quantization.py --num_contexts 256 --n_layer 6 --n_embd 512
+"""
+import argparse
+import copy
+import time
+import types
+
+import torch
+
+from catwalk.cached_transformers import quantize_model
+from catwalk.models.language_model import DecoderOnlyLanguageModel
+
+from tiny_model import make_tiny_gpt2
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_contexts', type=int, default=256)
+    parser.add_argument('--num_choices', type=int, default=4)
+    parser.add_argument('--context_length', type=int, default=100)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--n_layer', type=int, default=6)
+    parser.add_argument('--n_embd', type=int, default=512)
+    args = parser.parse_args()
+
+    model = make_tiny_gpt2(n_layer=args.n_layer, n_embd=args.n_embd, n_head=8)
+    tokenizer = types.SimpleNamespace(model_max_length=1024, eos_token_id=0)
+    g = torch.Generator().manual_seed(0)
+    cc_pairs = []
+    for _ in range(args.num_contexts):
+        context = torch.randint(1, model.config.vocab_size, (args.context_length,), generator=g)
+        for _ in range(args.num_choices):
+            continuation = torch.randint(1, model.config.vocab_size, (int(torch.randint(1, 6, (1,), generator=g)),), generator=g)
+            cc_pairs.append({"input_ids": (context, continuation)})
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+
+    outputs = {}
+    models = {"fp32": model, "int8-dynamic": quantize_model(copy.deepcopy(model), "int8-dynamic")}
+    for name, benchmarked_model in models.items():
+        start = time.perf_counter()
+        outputs[name] = lm._run_loglikelihood_tokens(cc_pairs, benchmarked_model, tokenizer, args.batch_size)
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {elapsed:.2f}s, {len(cc_pairs) / elapsed:.1f} requests/s")
+
+    diffs = [abs(a["sum_logits"] - b["sum_logits"]) for a, b in zip(outputs["fp32"], outputs["int8-dynamic"])]
+    same_choice = 0
+    for start in range(0, len(cc_pairs), args.num_choices):
+        choices = range(start, start + args.num_choices)
+        picks = [max(choices, key=lambda i: outputs[name][i]["sum_logits"] / outputs[name][i]["num_tokens"])
+                 for name in models]
+        same_choice += picks[0] == picks[1]
+    print(f"sum_logits difference: max {max(diffs):.3f}, mean {sum(diffs) / len(diffs):.3f}")
+    print(f"same choice (per token): {same_choice / args.num_contexts:.1%} of {args.num_contexts} contexts")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Compares the number of tokens run through the model, and the wall-clock time, for multiple-choice scoring
+with and without `share_context_kv`.
+
+    python experiments/benchmarks/shared_context_kv.py --context_length 1024 --num_choices 4
+"""
+import argparse
+import time
+import types
+
+from catwalk.models.language_model import DecoderOnlyLanguageModel
+
+from tiny_model import make_tiny_gpt2, make_mc_pairs, count_tokens
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_instances', type=int, default=32)
+    parser.add_argument('--num_choices', type=int, default=4)
+    parser.add_argument('--context_length', type=int, default=512)
+    parser.add_argument('--batch_size', type=int, default=16)
+    args = parser.parse_args()
+
+    model = make_tiny_gpt2()
+    tokenizer = types.SimpleNamespace(model_max_length=model.config.n_positions, eos_token_id=0)
+    cc_pairs = make_mc_pairs(
+        num_instances=args.num_instances,
+        num_choices=args.num_choices,
+        context_length=args.context_length,
+        vocab_size=model.config.vocab_size)
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+
+    outputs = {}
+    for share_context_kv in [False, True]:
+        with count_tokens(model) as counts:
+            start = time.perf_counter()
+            outputs[share_context_kv] = lm._run_loglikelihood_tokens(
+                cc_pairs, model, tokenizer, args.batch_size, share_context_kv=share_context_kv)
+            elapsed = time.perf_counter() - start
+        print(f"share_context_kv={share_context_kv}: {counts['real']} tokens processed "
+              f"({counts['padded']} incl. padding) in {counts['forward_calls']} forward calls, {elapsed:.2f}s")
+
+    max_diff = max(
+        abs(a["sum_logits"] - b["sum_logits"])
+        for a, b in zip(outputs[False], outputs[True]))
+    same_greedy = all(a["is_greedy"] == b["is_greedy"] for a, b in zip(outputs[False], outputs[True]))
+    print(f"max sum_logits difference: {max_diff:.2e}, is_greedy identical: {same_greedy}")
+
+
+if __name__ == "__main__":
+    main()
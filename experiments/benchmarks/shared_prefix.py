@@ -0,0 +1,62 @@
+"""
+Compares the number of tokens run through the model, and the wall-clock time, for multiple-choice scoring
+where every instance starts with the same few-shot demonstrations, as with a fixed `fewshot_seed`: with no
+sharing, with `share_context_kv`, and with a `PrefixCache`.
+
+    python experiments/benchmarks/shared_prefix.py --prefix_length 1024 --question_length 32
+"""
+import argparse
+import time
+import types
+
+import torch
+
+from catwalk.models.language_model import DecoderOnlyLanguageModel
+from catwalk.models.prefix_cache import PrefixCache
+
+from tiny_model import make_tiny_gpt2, make_mc_pairs, count_tokens
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_instances', type=int, default=32)
+    parser.add_argument('--num_choices', type=int, default=4)
+    parser.add_argument('--prefix_length', type=int, default=1024)
+    parser.add_argument('--question_length', type=int, default=32)
+    parser.add_argument('--batch_size', type=int, default=16)
+    args = parser.parse_args()
+
+    model = make_tiny_gpt2()
+    tokenizer = types.SimpleNamespace(model_max_length=model.config.n_positions, eos_token_id=0)
+    prefix = torch.randint(1, model.config.vocab_size, (args.prefix_length,), generator=torch.Generator().manual_seed(1))
+    cc_pairs = [
+        {"input_ids": (torch.cat([prefix, context]), continuation)}
+        for cc_pair in make_mc_pairs(
+            num_instances=args.num_instances,
+            num_choices=args.num_choices,
+            context_length=args.question_length,
+            vocab_size=model.config.vocab_size)
+        for context, continuation in [cc_pair["input_ids"]]
+    ]
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+
+    outputs = {}
+    for name, kwargs in [("no sharing", {}),
+                         ("share_context_kv", {"share_context_kv": True}),
+                         ("prefix_cache", {"prefix_cache": PrefixCache()})]:
+        with count_tokens(model.base_model) as counts:
+            start = time.perf_counter()
+            outputs[name] = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, args.batch_size, **kwargs)
+            elapsed = time.perf_counter() - start
+        print(f"{name}: {counts['real']} tokens processed ({counts['padded']} incl. padding) "
+              f"in {counts['forward_calls']} forward calls, {elapsed:.2f}s")
+        if "prefix_cache" in kwargs:
+            print(f"  prefix cache: {kwargs['prefix_cache'].stats()}")
+
+    for name in ["share_context_kv", "prefix_cache"]:
+        max_diff = max(abs(a["sum_logits"] - b["sum_logits"]) for a, b in zip(outputs["no sharing"], outputs[name]))
+        print(f"{name}: max sum_logits difference {max_diff:.2e}")
+
+
+if __name__ == "__main__":
+    main()
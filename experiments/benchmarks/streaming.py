@@ -0,0 +1,84 @@
+"""
+Compares scoring perplexity documents in fixed chunks of instances, each of which is batched on its own (the
+old `max_instances_in_memory`), with streaming them through a buffer of `max_buffered_requests` requests.
+Reports the wall-clock time, the time until the first prediction, and the padding efficiency of the batches.
+
+    python experiments/benchmarks/streaming.py --batch_size 8 --chunk_size 64 --max_buffered_requests 160
+"""
+import argparse
+import logging
+import time
+import types
+
+import more_itertools
+import torch
+
+from catwalk.models.batching import make_batches
+from catwalk.models.language_model import DecoderOnlyLanguageModel
+
+from tiny_model import make_tiny_gpt2
+
+
+class PaddingCounter(logging.Handler):
+    """Adds up the padding efficiency that `make_batches` logs."""
+
+    def __init__(self):
+        super().__init__()
+        self.tokens = 0
+        self.padded_tokens = 0
+
+    def emit(self, record):
+        if record.msg.startswith("Scheduled"):
+            self.tokens += record.args[-2]
+            self.padded_tokens += record.args[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_docs', type=int, default=1024)
+    parser.add_argument('--max_length', type=int, default=128)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--chunk_size', type=int, default=64)
+    parser.add_argument('--max_buffered_requests', type=int, default=128)
+    parser.add_argument('--n_layer', type=int, default=2)
+    parser.add_argument('--n_embd', type=int, default=128)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    counter = PaddingCounter()
+    batching_logger = logging.getLogger(make_batches.__module__)
+    batching_logger.setLevel(logging.INFO)
+    batching_logger.addHandler(counter)
+    batching_logger.propagate = False
+
+    model = make_tiny_gpt2(n_layer=args.n_layer, n_embd=args.n_embd)
+    tokenizer = types.SimpleNamespace(model_max_length=args.max_length, eos_token_id=0)
+    g = torch.Generator().manual_seed(0)
+    documents = []
+    for _ in range(args.num_docs):
+        length = int(torch.randint(8, 3 * args.max_length, (1,), generator=g))
+        documents.append((torch.randint(1, model.config.vocab_size, (length,), generator=g), {}))
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+
+    def chunked():
+        for chunk in more_itertools.chunked(documents, args.chunk_size):
+            yield from lm._predict_perplexity(chunk, model, tokenizer, args.batch_size)
+
+    def streamed():
+        return lm._predict_perplexity(
+            documents, model, tokenizer, args.batch_size, max_buffered_requests=args.max_buffered_requests)
+
+    for name, predictions in [(f"chunks of {args.chunk_size} docs", chunked),
+                              (f"max_buffered_requests={args.max_buffered_requests}", streamed)]:
+        counter.tokens = counter.padded_tokens = 0
+        start = time.perf_counter()
+        first = None
+        for _ in predictions():
+            if first is None:
+                first = time.perf_counter() - start
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {elapsed:.2f}s, {args.num_docs / elapsed:.1f} docs/s, first after {first:.2f}s, "
+              f"padding efficiency {counter.tokens / counter.padded_tokens:.1%}")
+
+
+if __name__ == "__main__":
+    main()
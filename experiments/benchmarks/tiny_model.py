@@ -0,0 +1,96 @@
+"""
+Helpers for benchmarking the language model engine on a tiny, randomly initialized GPT-2 that is built
+locally, so the benchmarks run without downloading anything.
+"""
+import contextlib
+import random
+from typing import Dict, Iterator, List, Tuple
+
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel, GPT2TokenizerFast
+
+WORDS = "the a cat dog sat ran on under mat table answer question is was yes no true false because".split()
+
+
+def make_tiny_gpt2(
+    *,
+    n_layer: int = 4,
+    n_embd: int = 128,
+    n_head: int = 4,
+    vocab_size: int = 1024,
+    n_positions: int = 2048,
+    seed: int = 0
+) -> GPT2LMHeadModel:
+    torch.manual_seed(seed)
+    config = GPT2Config(
+        n_layer=n_layer, n_embd=n_embd, n_head=n_head, vocab_size=vocab_size, n_positions=n_positions)
+    return GPT2LMHeadModel(config).eval()
+
+
+def make_tiny_tokenizer(vocab_size: int = 1024, model_max_length: int = 2048) -> GPT2TokenizerFast:
+    from tokenizers import ByteLevelBPETokenizer
+
+    r = random.Random(0)
+    corpus = [" ".join(r.choice(WORDS) for _ in range(64)) for _ in range(256)]
+    bpe = ByteLevelBPETokenizer()
+    bpe.train_from_iterator(corpus, vocab_size=vocab_size, min_frequency=1, special_tokens=["<|endoftext|>"])
+    return GPT2TokenizerFast(
+        tokenizer_object=bpe._tokenizer,
+        eos_token="<|endoftext|>",
+        bos_token="<|endoftext|>",
+        unk_token="<|endoftext|>",
+        model_max_length=model_max_length)
+
+
+def random_text(r: random.Random, num_words: int) -> str:
+    return " ".join(r.choice(WORDS) for _ in range(num_words))
+
+
+def make_mc_pairs(
+    *,
+    num_instances: int,
+    num_choices: int,
+    context_length: int,
+    continuation_length: Tuple[int, int] = (1, 8),
+    vocab_size: int = 1024,
+    seed: int = 0
+) -> List[Dict[str, Tuple[torch.Tensor, torch.Tensor]]]:
+    """Builds token-level multiple-choice requests, one context shared by `num_choices` continuations."""
+    g = torch.Generator().manual_seed(seed)
+    cc_pairs = []
+    for _ in range(num_instances):
+        context = torch.randint(1, vocab_size, (context_length,), generator=g)
+        for _ in range(num_choices):
+            length = int(torch.randint(continuation_length[0], continuation_length[1] + 1, (1,), generator=g))
+            continuation = torch.randint(1, vocab_size, (length,), generator=g)
+            cc_pairs.append({"input_ids": (context, continuation)})
+    return cc_pairs
+
+
+@contextlib.contextmanager
+def count_tokens(model: torch.nn.Module) -> Iterator[Dict[str, int]]:
+    """
+    Counts the tokens fed through the model while the context is active. `padded` counts every position
+    of every input tensor, `real` only counts the positions that are not masked out.
+    """
+    counts = {"forward_calls": 0, "padded": 0, "real": 0}
+
+    def hook(module, args, kwargs):
+        input_ids = kwargs.get("input_ids", args[0] if args else None)
+        attention_mask = kwargs.get("attention_mask")
+        if attention_mask is not None and attention_mask.dim() != 2:
+            # packed rows use a 4D mask, and have no padding to speak of
+            attention_mask = None
+        past_length = 0
+        if attention_mask is not None:
+            past_length = attention_mask.shape[1] - input_ids.shape[1]
+            attention_mask = attention_mask[:, past_length:]
+        counts["forward_calls"] += 1
+        counts["padded"] += input_ids.numel()
+        counts["real"] += int(attention_mask.sum()) if attention_mask is not None else input_ids.numel()
+
+    handle = model.register_forward_pre_hook(hook, with_kwargs=True)
+    try:
+        yield counts
+    finally:
+        handle.remove()
@@ -3,8 +3,11 @@ import argparse
 from tango import Workspace
 from tango.common.logging import initialize_logging
 
+from catwalk.models import MODELS
+from catwalk.models.language_model import LanguageModel
+from catwalk.models.prefix_cache import PrefixCache
 from catwalk.steps import PredictStep, CalculateMetricsStep
-from catwalk.tasks import TASK_SETS
+from catwalk.tasks import TASKS, TASK_SETS, get_instances
 
 SHOTS = [0, 1, 2, 4, 8, 16, 32]
 
@@ -49,6 +52,16 @@ def main():
     parser.add_argument('--batch_size', type=int, default=32)
     parser.add_argument('--metric', type=str, nargs="+", default=['acc', 'f1'])
     parser.add_argument('--limit', type=int)
+    parser.add_argument(
+        '--nested',
+        action='store_true',
+        help="pick the few-shot examples such that those for fewer shots are the first of those for more shots")
+    parser.add_argument(
+        '--sweep',
+        action='store_true',
+        help="score all numbers of shots in one pass, with nested few-shot examples that share their "
+             "prompts, instead of a step per number of shots (only for lm:: models, not cached in the workspace)")
+    parser.add_argument('--prefix_cache_tokens', type=int, default=16 * 1024)
     parser.add_argument(
         '-d', '-w',
         type=str,
@@ -72,28 +85,48 @@ def main():
         except KeyError:
             tasks.add(task)
 
+    def metric_value(result):
+        for metric_name in args.metric:
+            value = result.get(metric_name)
+            if value is not None:
+                return value
+        return None
+
     results = {}
     for task in tasks:
+        if args.sweep:
+            model = MODELS[args.model]
+            if not isinstance(model, LanguageModel):
+                raise ValueError(f"--sweep needs an lm:: model, got {args.model}")
+            task_object = TASKS[task]
+            instances = get_instances(task_object, args.split or task_object.default_split, limit)
+            predictions = list(model.predict(
+                task_object,
+                instances,
+                batch_size=args.batch_size,
+                num_shots_sweep=SHOTS,
+                prefix_cache=PrefixCache(args.prefix_cache_tokens)))
+            for num_shots in SHOTS:
+                result = model.calculate_metrics(task_object, [prediction[num_shots] for prediction in predictions])
+                results[(task, num_shots)] = metric_value(result)
+            continue
+
         for num_shots in SHOTS:
+            predict_kwargs = {"nested_fewshot": True} if args.nested else {}
             predictions = PredictStep(
                 model=args.model,
                 task=task,
                 batch_size=args.batch_size,
                 limit=limit,
-                num_shots=num_shots
+                num_shots=num_shots,
+                **predict_kwargs
             )
             metrics = CalculateMetricsStep(
                 model=args.model,
                 task=task,
                 predictions=predictions)
 
-            result = metrics.result(workspace)
-            for metric_name in args.metric:
-                metric_value = result.get(metric_name)
-                if metric_value is not None:
-                    break
-
-            results[(task, num_shots)] = metric_value
+            results[(task, num_shots)] = metric_value(metrics.result(workspace))
 
     for key, value in results.items():
         task, num_shots = key
@@ -0,0 +1,713 @@
+import copy
+import json
+import types
+
+import pytest
+import torch
+import transformers
+from packaging import version
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from catwalk.cached_transformers import _conv1d_to_linear, quantize_model
+from catwalk.models.batching import make_batches, make_packed_rows
+from catwalk.models.compiled import bucket_shape, compiled_base_model
+from catwalk.models.data_parallel import shard_by_length
+from catwalk.dependencies.lm_eval.utils import get_rolling_token_windows, make_disjoint_window
+from catwalk.models.language_model import DecoderOnlyLanguageModel, _continuation_trie, _rolling_windows, \
+    _selected_log_probs
+from catwalk.models.pipeline import run_pipelined
+from catwalk.models.prefix_cache import PrefixCache
+from catwalk.models.request_store import RequestStore
+from catwalk.models.result_cache import RequestCache, RequestPool
+from catwalk.models.streaming import InstanceRequests, StreamStats, request_progress, stream_predictions
+from catwalk.task import InstanceFormat, RankClassificationInstance, Task
+from catwalk.tasks.perplexity_jsonl import PerplexityJsonLTask, JsonLInstances
+from catwalk.tasks.perplexity_tokens import PerplexityTokensTask
+from catwalk.tokenize_jsonl import write_shard
+
+
+@pytest.fixture(scope="module")
+def tiny_gpt2():
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(GPT2Config(n_layer=2, n_embd=32, n_head=2, vocab_size=64, n_positions=64)).eval()
+    tokenizer = types.SimpleNamespace(model_max_length=64, eos_token_id=0)
+    return model, tokenizer
+
+
+def make_cc_pairs(num_contexts=5, num_choices=4, seed=1):
+    g = torch.Generator().manual_seed(seed)
+    cc_pairs = []
+    for _ in range(num_contexts):
+        context = torch.randint(1, 64, (int(torch.randint(2, 30, (1,), generator=g)),), generator=g)
+        for _ in range(num_choices):
+            continuation = torch.randint(1, 64, (int(torch.randint(1, 6, (1,), generator=g)),), generator=g)
+            cc_pairs.append({
+                "input_ids": (context, continuation),
+                "attention_mask": (torch.ones_like(context), torch.ones_like(continuation))
+            })
+    # one request that needs truncation
+    context = torch.randint(1, 64, (80,), generator=g)
+    continuation = torch.tensor([5, 6])
+    cc_pairs.append({
+        "input_ids": (context, continuation),
+        "attention_mask": (torch.ones_like(context), torch.ones_like(continuation))
+    })
+    return cc_pairs
+
+
+def assert_same_results(expected, actual):
+    assert len(expected) == len(actual)
+    for e, a in zip(expected, actual):
+        assert e["sum_logits"] == pytest.approx(a["sum_logits"], abs=1e-4)
+        assert e["is_greedy"] == a["is_greedy"]
+        assert e["num_tokens"] == a["num_tokens"]
+        assert e["num_tokens_all"] == a["num_tokens_all"]
+
+
+def assert_same_predictions(expected, actual):
+    assert len(expected) == len(actual)
+    for e, a in zip(expected, actual):
+        e_output, a_output = e.pop("model_output"), a.pop("model_output")
+        assert e == a
+        if isinstance(e_output, dict):
+            e_output, a_output = [e_output], [a_output]
+        for e_result, a_result in zip(e_output, a_output):
+            for key in ["sum_logits", "sum_logits_uncond"]:
+                assert e_result.pop(key, None) == pytest.approx(a_result.pop(key, None), abs=1e-4)
+            assert e_result == a_result
+
+
+def test_share_context_kv(tiny_gpt2):
+    model, tokenizer = tiny_gpt2
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+    cc_pairs = make_cc_pairs()
+    # add a continuation that is exactly the greedy prediction, so is_greedy is exercised
+    context = cc_pairs[0]["input_ids"][0]
+    with torch.inference_mode():
+        greedy = model(context.unsqueeze(0)).logits[0, -1].argmax().unsqueeze(0)
+    cc_pairs.append({"input_ids": (context, greedy), "attention_mask": (torch.ones_like(context), torch.ones(1, dtype=torch.long))})
+
+    expected = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=4)
+    assert expected[-1]["is_greedy"]
+    for max_batch_tokens in [None, 40]:
+        actual = lm._run_loglikelihood_tokens(
+            cc_pairs, model, tokenizer, batch_size=4, max_batch_tokens=max_batch_tokens, share_context_kv=True)
+        assert_same_results(expected, actual)
+
+
+def test_make_batches():
+    lengths = [5, 50, 7, 48, 6, 49, 8]
+    batches = make_batches(lengths, batch_size=2)
+    assert [len(b) for b in batches] == [2, 2, 2, 1]
+    assert batches[0].indices == [1, 5]
+
+    # With a budget, batches of long requests shrink, and every batch fits the budget and batch_size
+    batches = make_batches(lengths, batch_size=3, max_batch_tokens=100)
+    assert sorted(i for b in batches for i in b.indices) == list(range(len(lengths)))
+    assert all(b.num_padded_tokens <= 100 for b in batches)
+    assert [len(b) for b in batches] == [2, 2, 3]
+    assert batches[-1].padding_efficiency == pytest.approx(18 / 21)
+    batches = make_batches(lengths, batch_size=2, max_batch_tokens=100)
+    assert [len(b) for b in batches] == [2, 2, 2, 1]
+
+    # The memory budget counts the logits of every padded position, or only of the given ones
+    batches = make_batches(lengths, max_batch_memory=1000, bytes_per_token=10)
+    assert [len(b) for b in batches] == [2, 2, 3]
+    batches = make_batches(lengths, max_batch_memory=1000, bytes_per_token=10, logit_lengths=[30] * len(lengths))
+    assert [len(b) for b in batches] == [3, 3, 1]
+
+
+def test_batching_does_not_change_results(tiny_gpt2):
+    model, tokenizer = tiny_gpt2
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+    cc_pairs = make_cc_pairs()
+    expected = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=1)
+    actual = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=4, max_batch_tokens=100)
+    assert_same_results(expected, actual)
+
+
+def test_make_packed_rows():
+    lengths = [30, 10, 25, 40, 5, 20]
+    rows = make_packed_rows(lengths, max_length=50)
+    assert sorted(i for row in rows for i in row.indices) == list(range(len(lengths)))
+    assert all(row.num_tokens <= 50 for row in rows)
+    assert [row.indices for row in rows] == [[3, 1], [0, 5], [2, 4]]
+
+
+@pytest.mark.skipif(
+    version.parse(transformers.__version__) < version.parse("4.52"),
+    reason="GPT-2 only accepts 4D attention masks in newer versions of transformers")
+def test_pack_requests(tiny_gpt2):
+    model, tokenizer = tiny_gpt2
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+    cc_pairs = make_cc_pairs()
+    expected = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=4)
+    for max_batch_tokens in [None, 100]:
+        actual = lm._run_loglikelihood_tokens(
+            cc_pairs, model, tokenizer, batch_size=4, max_batch_tokens=max_batch_tokens, pack_requests=True)
+        assert_same_results(expected, actual)
+    actual = lm._run_loglikelihood_tokens(
+        cc_pairs, model, tokenizer, batch_size=4, pack_requests=True, share_context_kv=True)
+    assert_same_results(expected, actual)
+
+
+@pytest.mark.skipif(
+    version.parse(transformers.__version__) < version.parse("4.52"),
+    reason="GPT-2 only accepts 4D attention masks in newer versions of transformers")
+def test_continuation_trie(tiny_gpt2):
+    model, tokenizer = tiny_gpt2
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+    cc_pairs = make_cc_pairs()
+    # continuations that share their leading tokens, and one that is exactly the greedy prediction
+    context = cc_pairs[0]["input_ids"][0]
+    with torch.inference_mode():
+        greedy = model(context.unsqueeze(0)).logits[0, -1].argmax().unsqueeze(0)
+    for continuation in [[7, 8, 9], [7, 8, 10], [7, 11], [7], greedy.tolist()]:
+        continuation = torch.tensor(continuation)
+        cc_pairs.append({
+            "input_ids": (context, continuation),
+            "attention_mask": (torch.ones_like(context), torch.ones_like(continuation))
+        })
+    # the inputs are all tokens but the last, "7 8" is shared by two continuations, "7" by three
+    assert _continuation_trie([pair["input_ids"][1] for pair in cc_pairs[-5:]]) == \
+        ([7, 8], [-1, 0], [0, 1], [[0, 1], [0, 1], [0], [], []])
+    expected = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=4)
+    assert expected[-1]["is_greedy"]
+    for max_batch_tokens in [None, 60]:
+        actual = lm._run_loglikelihood_tokens(
+            cc_pairs, model, tokenizer, batch_size=4, max_batch_tokens=max_batch_tokens, continuation_trie=True)
+        assert_same_results(expected, actual)
+
+
+def test_single_token_continuations(tiny_gpt2):
+    model, tokenizer = tiny_gpt2
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+    g = torch.Generator().manual_seed(5)
+    cc_pairs = []
+    for continuations in [[[3], [4], [5]], [[6], [7]], [[8], [9], [10, 11]]]:
+        context = torch.randint(1, 64, (int(torch.randint(2, 20, (1,), generator=g)),), generator=g)
+        for continuation in continuations:
+            continuation = torch.tensor(continuation)
+            cc_pairs.append({
+                "input_ids": (context, continuation),
+                "attention_mask": (torch.ones_like(context), torch.ones_like(continuation))
+            })
+    # one at a time, every request runs on its own
+    expected = [lm._run_loglikelihood_tokens([cc_pair], model, tokenizer, batch_size=4)[0] for cc_pair in cc_pairs]
+
+    forward_calls = []
+    handle = model.base_model.register_forward_pre_hook(lambda module, args: forward_calls.append(1))
+    try:
+        actual = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=4)
+    finally:
+        handle.remove()
+    assert_same_results(expected, actual)
+    # one batch of the three contexts for the single tokens, and one for the longer continuation
+    assert len(forward_calls) == 2
+
+    # turned off, all the requests share the padded batches
+    forward_calls.clear()
+    handle = model.base_model.register_forward_pre_hook(lambda module, args: forward_calls.append(1))
+    try:
+        actual = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=8, single_token_scoring=False)
+    finally:
+        handle.remove()
+    assert_same_results(expected, actual)
+    assert len(forward_calls) == 1
+
+
+def test_full_logits(tiny_gpt2):
+    model, tokenizer = tiny_gpt2
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+    cc_pairs = make_cc_pairs()
+    expected = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=4, full_logits=True)
+    assert_same_results(expected, lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=4))
+    assert_same_results(
+        expected,
+        lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=4, share_context_kv=True))
+    assert_same_results(
+        expected,
+        lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=4, share_context_kv=True, full_logits=True))
+
+
+@pytest.fixture(scope="module")
+def tiny_gpt2_with_tokenizer():
+    from tokenizers import ByteLevelBPETokenizer
+    from transformers import GPT2TokenizerFast
+
+    words = "the a cat dog sat ran on under mat table yes no because".split()
+    g = torch.Generator().manual_seed(0)
+    corpus = [" ".join(words[i] for i in torch.randint(0, len(words), (32,), generator=g)) for _ in range(64)]
+    bpe = ByteLevelBPETokenizer()
+    bpe.train_from_iterator(corpus, vocab_size=300, min_frequency=1, special_tokens=["<|endoftext|>"])
+    tokenizer = GPT2TokenizerFast(
+        tokenizer_object=bpe._tokenizer, eos_token="<|endoftext|>", bos_token="<|endoftext|>",
+        unk_token="<|endoftext|>", model_max_length=64)
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(GPT2Config(
+        n_layer=2, n_embd=32, n_head=2, vocab_size=len(tokenizer), n_positions=64,
+        eos_token_id=tokenizer.eos_token_id, bos_token_id=tokenizer.eos_token_id)).eval()
+    return model, tokenizer, corpus
+
+
+def test_greedy_until(tiny_gpt2_with_tokenizer):
+    model, tokenizer, corpus = tiny_gpt2_with_tokenizer
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+    max_gen_toks = 16
+    requests = []
+    for i, text in enumerate(corpus[:12]):
+        context = " ".join(text.split()[:2 + 3 * i])
+        untils = [[" dog dog"], ["\n\n", " yes"], [" table"], [" under under", "nd"], ["77", "\n"], ["PP"]][i % 6]
+        requests.append((context, untils))
+
+    # generating one request at a time, all the way to max_gen_toks
+    expected = []
+    for context, untils in requests:
+        context_ids = torch.tensor([tokenizer(context)["input_ids"]])
+        primary_until = None
+        for tokenized_until in tokenizer(untils)["input_ids"]:
+            if len(tokenized_until) == 1:
+                primary_until = tokenized_until[0]
+        output = model.generate(
+            context_ids,
+            max_new_tokens=max_gen_toks,
+            eos_token_id=primary_until if primary_until is not None else tokenizer.eos_token_id,
+            pad_token_id=tokenizer.eos_token_id,
+            do_sample=False)
+        text = tokenizer.decode(output[0, context_ids.shape[1]:].tolist())
+        for term in untils:
+            text = text.split(term)[0]
+        expected.append(text)
+
+    results = lm._run_greedy_until(requests, model, tokenizer, max_gen_toks=max_gen_toks, batch_size=5)
+    assert [r["text"] for r in results] == expected
+    assert any(r["num_generated_tokens"] < max_gen_toks for r in results)
+    assert [r["num_input_tokens"] for r in results] == [len(tokenizer(c)["input_ids"]) for c, _ in requests]
+
+
+def test_request_cache(tiny_gpt2, tmp_path):
+    model, tokenizer = tiny_gpt2
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+    cc_pairs = make_cc_pairs()
+    expected = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=4)
+
+    cache = RequestCache(str(tmp_path / "cache.sqlite"))
+    actual = lm._run_loglikelihood_tokens(cc_pairs[:10], model, tokenizer, batch_size=4, request_cache=cache)
+    assert_same_results(expected[:10], actual)
+    assert cache.stats() == {"hits": 0, "misses": 10, "deduplicated": 0}
+    actual = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=4, request_cache=cache)
+    assert_same_results(expected, actual)
+    assert cache.stats() == {"hits": 10, "misses": len(cc_pairs), "deduplicated": 0}
+    # options that only schedule the requests share the entries
+    actual = lm._run_loglikelihood_tokens(
+        cc_pairs, model, tokenizer, batch_size=2, pipeline_depth=1, share_context_kv=True, request_cache=cache)
+    assert_same_results(expected, actual)
+    assert cache.stats() == {"hits": 10 + len(cc_pairs), "misses": len(cc_pairs), "deduplicated": 0}
+
+    # identical requests are only run once, and get independent results, with or without a cache
+    cache = RequestCache(":memory:")
+    actual = lm._run_loglikelihood_tokens(cc_pairs + cc_pairs[:5], model, tokenizer, batch_size=4, request_cache=cache)
+    assert_same_results(expected + expected[:5], actual)
+    assert cache.stats() == {"hits": 0, "misses": len(cc_pairs), "deduplicated": 5}
+    for actual in [actual, lm._run_loglikelihood_tokens(cc_pairs + cc_pairs[:5], model, tokenizer, batch_size=4)]:
+        assert_same_results(expected + expected[:5], actual)
+        actual[0]["sum_logits"] = 0.0
+        assert actual[len(cc_pairs)]["sum_logits"] == pytest.approx(expected[0]["sum_logits"], abs=1e-4)
+
+
+def test_request_pool(tiny_gpt2):
+    model, tokenizer = tiny_gpt2
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+    cc_pairs = make_cc_pairs()
+    expected = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=4)
+
+    cache = RequestCache(":memory:")
+    cache.pool = RequestPool()
+    for task, task_pairs in [("first", cc_pairs[:12]), ("second", cc_pairs[8:])]:
+        cache.pool.task = task
+        lm._run_loglikelihood_tokens(task_pairs, model, tokenizer, batch_size=4, request_cache=cache)
+    assert len(cache.pool) == len(cc_pairs)
+    seconds = cache.run_pool()
+    assert set(seconds.keys()) == {"first", "second"}
+
+    cache.pool = None
+    stats_before = cache.stats()
+    actual = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=4, request_cache=cache)
+    assert_same_results(expected, actual)
+    assert cache.stats()["misses"] == stats_before["misses"]
+
+
+def test_rolling_windows():
+    token_ids = list(range(1, 30))
+    for max_seq_len in [1, 5, 29, 40]:
+        for stride in [None, 1, min(2, max_seq_len), max_seq_len]:
+            context_len = 1 if stride is None else max_seq_len - stride + 1
+            expected = [
+                make_disjoint_window(window)
+                for window in get_rolling_token_windows(token_ids, 0, max_seq_len, context_len)
+            ]
+            actual = [
+                (context.tolist(), continuation.tolist())
+                for context, continuation in _rolling_windows(torch.tensor(token_ids), 0, max_seq_len, stride)
+            ]
+            assert actual == expected
+            # every token is scored once, with the tokens right before it as context, within max_seq_len
+            assert sum((continuation for _, continuation in actual), []) == token_ids
+            for context, continuation in actual:
+                assert ([0] + token_ids)[continuation[0] - len(context):continuation[-1] + 1] == context + continuation
+                assert len(context) + len(continuation) <= max_seq_len + 1
+                if stride is not None and continuation[0] > max_seq_len:
+                    assert len(context) >= max_seq_len - stride + 1
+
+
+def test_perplexity_tokens(tiny_gpt2_with_tokenizer, tmp_path):
+    model, tokenizer, corpus = tiny_gpt2_with_tokenizer
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+    with open(tmp_path / "docs.jsonl", "w") as file:
+        for i in range(6):
+            file.write(json.dumps({"text": " ".join(corpus[i:i + i % 3 + 1])}) + "\n")
+    text_task = PerplexityJsonLTask(files=[str(tmp_path / "docs.jsonl")])
+    instances = text_task.get_split("validation")
+    expected = list(lm.predict_chunk_perplexity(text_task, list(instances), model, tokenizer, batch_size=4))
+
+    # a stride of the whole window is the same as no stride, and a shorter one still scores every token once
+    assert list(lm.predict_chunk_perplexity(
+        text_task, list(instances), model, tokenizer, batch_size=4, perplexity_stride=1000)) == expected
+    strided = list(lm.predict_chunk_perplexity(
+        text_task, list(instances), model, tokenizer, batch_size=4, perplexity_stride=16))
+    assert [r["model_output"]["num_tokens"] for r in strided] == [r["model_output"]["num_tokens"] for r in expected]
+
+    (tmp_path / "shards").mkdir()
+    write_shard(JsonLInstances([("docs.jsonl", str(tmp_path / "docs.jsonl"))]),
+                str(tmp_path / "shards" / "docs"), tokenizer, source="docs.jsonl", batch_size=4)
+    tokens_task = PerplexityTokensTask(files=[str(tmp_path / "shards")])
+    token_instances = tokens_task.get_split("validation")
+    assert len(token_instances) == 6
+    actual = list(lm.predict_chunk_perplexity_tokens(tokens_task, token_instances[:], model, tokenizer, batch_size=4))
+    for e, a in zip(expected, actual):
+        assert a["model_output"].pop("sum_logits") == pytest.approx(e["model_output"].pop("sum_logits"), abs=1e-4)
+        assert a["model_output"] == e["model_output"]
+
+    # a model with a different tokenizer refuses to score the shards
+    other_tokenizer = copy.deepcopy(tokenizer)
+    other_tokenizer.add_tokens(["catdog"])
+    with pytest.raises(ValueError):
+        list(lm.predict_chunk_perplexity_tokens(tokens_task, token_instances[:], model, other_tokenizer))
+
+
+def test_loglikelihood_rolling(tiny_gpt2_with_tokenizer):
+    model, tokenizer, corpus = tiny_gpt2_with_tokenizer
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+    texts = [" ".join(corpus[i:i + i % 3 + 1]) for i in range(6)] + [""]
+
+    # every window on its own, in Eleuther's order
+    expected = []
+    for text in texts:
+        windows = [
+            make_disjoint_window(window)
+            for window in get_rolling_token_windows(
+                tokenizer.encode(text), tokenizer.eos_token_id, tokenizer.model_max_length, 1)
+        ]
+        window_results = lm._run_loglikelihood_tokens(
+            [{"input_ids": (torch.tensor(context), torch.tensor(continuation))} for context, continuation in windows],
+            model, tokenizer, batch_size=1)
+        expected.append(sum(r["sum_logits"] for r in window_results))
+
+    results = lm._run_loglikelihood_rolling([(text,) for text in texts], model, tokenizer, batch_size=4)
+    assert [r["sum_logits"] for r in results] == pytest.approx(expected, abs=1e-4)
+    assert [r["num_tokens"] for r in results] == [len(tokenizer.encode(text)) for text in texts]
+
+
+def test_shard_by_length():
+    lengths = [5, 1, 9, 3, 7, 2, 8]
+    shards = shard_by_length(lengths, 3)
+    assert sorted(sum(shards, [])) == list(range(len(lengths)))
+    assert [sum(lengths[i] for i in shard) for shard in shards] == [12, 11, 12]
+
+
+def test_num_workers(tiny_gpt2, tiny_gpt2_with_tokenizer):
+    model, tokenizer = tiny_gpt2
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+    cc_pairs = make_cc_pairs()
+    expected = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=4)
+    actual = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=4, num_workers=3)
+    assert_same_results(expected, actual)
+
+    model, tokenizer, corpus = tiny_gpt2_with_tokenizer
+    requests = [(" ".join(text.split()[:2 + i]), ["\n", " yes"]) for i, text in enumerate(corpus[:7])]
+    expected = lm._run_greedy_until(requests, model, tokenizer, max_gen_toks=8, batch_size=2)
+    actual = lm._run_greedy_until(requests, model, tokenizer, max_gen_toks=8, batch_size=2, num_workers=3)
+    assert actual == expected
+
+
+def test_quantize(tiny_gpt2):
+    model, tokenizer = tiny_gpt2
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+    cc_pairs = make_cc_pairs()
+    expected = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=4)
+
+    # GPT-2 layers become plain linear layers, without changing the results
+    linear_model = copy.deepcopy(model)
+    _conv1d_to_linear(linear_model)
+    assert_same_results(expected, lm._run_loglikelihood_tokens(cc_pairs, linear_model, tokenizer, batch_size=4))
+
+    quantized_model = quantize_model(copy.deepcopy(model), "int8-dynamic")
+    assert isinstance(quantized_model.transformer.h[0].attn.c_attn, torch.ao.nn.quantized.dynamic.Linear)
+    actual = lm._run_loglikelihood_tokens(cc_pairs, quantized_model, tokenizer, batch_size=4)
+    for e, a in zip(expected, actual):
+        assert e["sum_logits"] == pytest.approx(a["sum_logits"], rel=0.05, abs=0.05)
+    with pytest.raises(ValueError):
+        quantize_model(copy.deepcopy(model), "int4")
+
+
+def test_bfloat16_scores_in_float32(tiny_gpt2):
+    model, tokenizer = tiny_gpt2
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+    cc_pairs = make_cc_pairs()
+    expected = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=4)
+
+    bf16_model = copy.deepcopy(model).to(torch.bfloat16)
+    for full_logits in [False, True]:
+        log_probs, _ = _selected_log_probs(bf16_model, [0, 0], [0, 1], full_logits, input_ids=torch.tensor([[1, 2]]))
+        assert log_probs.dtype == torch.float32
+        actual = lm._run_loglikelihood_tokens(cc_pairs, bf16_model, tokenizer, batch_size=4, full_logits=full_logits)
+        for e, a in zip(expected, actual):
+            assert e["sum_logits"] == pytest.approx(a["sum_logits"], rel=0.05, abs=0.05)
+
+    assert lm.model_kwargs_for("bfloat16") == {"torch_dtype": torch.bfloat16}
+    with pytest.raises(ValueError):
+        lm.model_kwargs_for("bf16")
+
+
+def test_bucket_shape():
+    assert bucket_shape(5, 70, 64, 1024) == (8, 128)
+    assert bucket_shape(8, 64, 64, 1024) == (8, 64)
+    assert bucket_shape(1, 90, 64, 100) == (1, 100)
+    assert bucket_shape(3, 101, 64, 100) is None
+
+
+def test_compile_bucket_size(tiny_gpt2):
+    model, tokenizer = tiny_gpt2
+    model = copy.deepcopy(model)
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+    cc_pairs = make_cc_pairs()
+    expected = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=32)
+    actual = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=32, compile_bucket_size=32)
+    assert_same_results(expected, actual)
+    compiled = compiled_base_model(model, 32, 64)
+    assert compiled.stats()["num_shapes"] == 1
+
+    # once there are max_shapes graphs, batches of other shapes run eagerly
+    compiled.max_shapes = 1
+    actual = lm._run_loglikelihood_tokens(cc_pairs[:3], model, tokenizer, batch_size=32, compile_bucket_size=32)
+    assert_same_results(expected[:3], actual)
+    assert compiled.stats()["eager_calls"] == 1
+
+
+class ChoicesTask(Task):
+    def __init__(self, texts):
+        Task.__init__(self)
+        self.texts = texts
+        self.num_conversions = 0
+        self.add_instance_conversion(InstanceFormat.RANK_CLASSIFICATION, self.instance_as_rank_classification)
+
+    def has_split(self, split):
+        return True
+
+    def get_split(self, split):
+        return [
+            {"id": f"q{i}", "question": " ".join(text.split()[:-1]), "choices": [text.split()[-1], "yes", "no"],
+             "label": 0}
+            for i, text in enumerate(self.texts)
+        ]
+
+    def instance_as_rank_classification(self, instance, *, fewshot_instances=None, **kwargs):
+        self.num_conversions += 1
+        prefix = "".join(f"{shot['question']} {shot['choices'][shot['label']]}\n" for shot in fewshot_instances or [])
+        return RankClassificationInstance(
+            [(prefix + instance["question"], choice) for choice in instance["choices"]], instance["label"])
+
+
+def test_request_store(tiny_gpt2_with_tokenizer, tmp_path):
+    model, tokenizer, corpus = tiny_gpt2_with_tokenizer
+    task = ChoicesTask([text[:60] for text in corpus[:8]])
+    instances = task.get_split("test")
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+    kwargs = {"num_shots": 1, "num_recorded_inputs": 2, "unconditioned_prompt": "Answer:"}
+    expected = list(lm.predict_chunk_rank_classification(task, instances, model, tokenizer, **kwargs))
+
+    store = RequestStore(str(tmp_path / "store"))
+    for _ in range(2):
+        task.num_conversions = 0
+        actual = list(lm.predict_chunk_rank_classification(
+            task, instances, model, tokenizer, request_store=store, **kwargs))
+        assert actual == expected
+    assert store.stats() == {"hits": 1, "misses": 1}
+    # from the store, only the recorded instances are converted again
+    assert task.num_conversions == 2
+
+    # other instances are another entry
+    list(lm.predict_chunk_rank_classification(task, instances[:4], model, tokenizer, request_store=store, **kwargs))
+    assert store.stats() == {"hits": 1, "misses": 2}
+
+
+def test_pipeline_depth(tiny_gpt2):
+    model, tokenizer = tiny_gpt2
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+    cc_pairs = make_cc_pairs()
+    expected = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=4)
+    for pipeline_depth in [1, 3]:
+        assert_same_results(
+            expected,
+            lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=4, pipeline_depth=pipeline_depth))
+
+
+def test_run_pipelined():
+    for depth in [0, 2]:
+        finished = []
+        stats = run_pipelined(range(10), lambda x: x, lambda x: x * 2, lambda x, y: finished.append((x, y)), depth)
+        assert finished == [(x, 2 * x) for x in range(10)]
+        assert set(stats) == {"prepare", "run", "finish"}
+
+        def fail(x):
+            if x == 3:
+                raise ValueError(x)
+            return x
+
+        for stages in [(fail, lambda x: x), (lambda x: x, fail)]:
+            with pytest.raises(ValueError):
+                run_pipelined(range(10), *stages, lambda x, y: None, depth)
+        with pytest.raises(ValueError):
+            run_pipelined(range(10), lambda x: x, lambda x: x, lambda x, y: fail(x), depth)
+
+
+def test_stream_predictions():
+    def instance(i):
+        return InstanceRequests([("a" if j % 2 == 0 else "b", (i, j), (i * 7 + j) % 5) for j in range(i % 4)],
+                                lambda results, i=i: (i, results))
+
+    runs = []
+
+    def run(items):
+        runs.append(items)
+        # the bar over all instances shows the progress, not one bar per round
+        with request_progress(total=len(items)) as requests_tqdm:
+            assert requests_tqdm.disable
+        return [f"{i}.{j}" for i, j in items]
+
+    expected = [(i, [f"{i}.{j}" for j in range(i % 4)]) for i in range(40)]
+    for max_buffered_requests in [None, 1, 4, 7, 100]:
+        runs.clear()
+        stats = StreamStats()
+        assert list(stream_predictions(
+            (instance(i) for i in range(40)), {"a": run, "b": run},
+            max_buffered_requests=max_buffered_requests, round_multiple=2, stats=stats)) == expected
+        assert stats.num_instances == 40
+        assert stats.num_requests == sum(len(items) for items in runs) == sum(i % 4 for i in range(40))
+        if max_buffered_requests is not None:
+            # an instance is only read while the buffer has room
+            assert stats.max_buffered_requests < max_buffered_requests + 3
+
+    # the first instances are yielded before the last ones are read
+    read = []
+
+    def instances():
+        for i in range(40):
+            read.append(i)
+            yield instance(i)
+
+    predictions = stream_predictions(instances(), {"a": run, "b": run}, max_buffered_requests=4)
+    assert next(predictions) == expected[0]
+    assert len(read) < 40
+    with request_progress(total=1) as requests_tqdm:
+        assert not requests_tqdm.disable
+
+
+def test_max_buffered_requests(tiny_gpt2_with_tokenizer, tmp_path):
+    model, tokenizer, corpus = tiny_gpt2_with_tokenizer
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+    task = ChoicesTask([text[:60] for text in corpus[:8]])
+    instances = task.get_split("test")
+    kwargs = {"num_shots": 1, "num_recorded_inputs": 3, "unconditioned_prompt": "Answer:", "batch_size": 2}
+    expected = list(lm.predict_chunk_rank_classification(task, instances, model, tokenizer, **kwargs))
+    for max_buffered_requests in [1, 5]:
+        assert_same_predictions(copy.deepcopy(expected), list(lm.predict_chunk_rank_classification(
+            task, instances, model, tokenizer, max_buffered_requests=max_buffered_requests, **kwargs)))
+
+    with open(tmp_path / "docs.jsonl", "w") as file:
+        for i in range(6):
+            file.write(json.dumps({"text": " ".join(corpus[i:i + i % 3 + 1])}) + "\n")
+    text_task = PerplexityJsonLTask(files=[str(tmp_path / "docs.jsonl")])
+    instances = list(text_task.get_split("validation"))
+    kwargs = {"num_recorded_inputs": 2, "batch_size": 2}
+    expected = list(lm.predict_chunk_perplexity(text_task, instances, model, tokenizer, **kwargs))
+    assert_same_predictions(expected, list(lm.predict_chunk_perplexity(
+        text_task, instances, model, tokenizer, max_buffered_requests=3, **kwargs)))
+
+
+def test_prefix_cache(tiny_gpt2):
+    model, tokenizer = tiny_gpt2
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+    g = torch.Generator().manual_seed(3)
+    prefix = torch.randint(1, 64, (20,), generator=g)
+    cc_pairs = make_cc_pairs(num_contexts=2, num_choices=2)
+    for _ in range(6):
+        context = torch.cat([prefix, torch.randint(1, 64, (int(torch.randint(1, 8, (1,), generator=g)),), generator=g)])
+        for _ in range(2):
+            continuation = torch.randint(1, 64, (int(torch.randint(1, 4, (1,), generator=g)),), generator=g)
+            cc_pairs.append({
+                "input_ids": (context, continuation),
+                "attention_mask": (torch.ones_like(context), torch.ones_like(continuation))
+            })
+    expected = lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=4)
+
+    prefix_cache = PrefixCache(max_tokens=64, min_prefix_tokens=8)
+    assert_same_results(
+        expected, lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=4, prefix_cache=prefix_cache))
+    # the choices of the first context share it, the last 12 requests share the prefix, the rest are too short
+    assert prefix_cache.stats()["requests"] == 14
+    assert prefix_cache.stats()["misses"] == 2
+    assert tuple(prefix.tolist()) in prefix_cache.prefixes()
+
+    # later calls reuse the cached prefix, even for a single request
+    before = prefix_cache.stats()
+    assert_same_results(
+        expected[-1:],
+        lm._run_loglikelihood_tokens(cc_pairs[-1:], model, tokenizer, batch_size=4, prefix_cache=prefix_cache))
+    assert prefix_cache.stats()["hits"] == before["hits"] + 1
+    assert prefix_cache.stats()["prefill_tokens_saved"] == before["prefill_tokens_saved"] + len(prefix)
+
+    # prefixes beyond the cap are evicted, oldest first
+    small_cache = PrefixCache(max_tokens=30, min_prefix_tokens=8)
+    assert_same_results(
+        expected, lm._run_loglikelihood_tokens(cc_pairs, model, tokenizer, batch_size=4, prefix_cache=small_cache))
+    assert small_cache.stats()["evictions"] > 0
+    assert sum(len(p) for p in small_cache.prefixes()) <= 30
+
+
+def test_num_shots_sweep(tiny_gpt2_with_tokenizer):
+    model, tokenizer, corpus = tiny_gpt2_with_tokenizer
+    task = ChoicesTask([text[:40] for text in corpus[:16]])
+    instances = task.get_split("test")
+    # the nested examples for fewer shots are the first ones for more shots
+    shots = [task.get_fewshot_instances(k, random_seed=3, exceptions=instances[0], nested=True) for k in range(6)]
+    for k in range(5):
+        assert shots[k] == shots[k + 1][:k]
+    assert instances[0] not in shots[5]
+
+    lm = DecoderOnlyLanguageModel("tiny-gpt2")
+    kwargs = {"num_recorded_inputs": 2, "unconditioned_prompt": "Answer:", "batch_size": 4}
+    sweep = [0, 1, 2, 3]
+    expected = {
+        num_shots: list(lm.predict_chunk_rank_classification(
+            task, instances[:6], model, tokenizer, num_shots=num_shots, nested_fewshot=True, **kwargs))
+        for num_shots in sweep
+    }
+    prefix_cache = PrefixCache(min_prefix_tokens=4)
+    actual = list(lm.predict_chunk_rank_classification(
+        task, instances[:6], model, tokenizer, num_shots_sweep=sweep, prefix_cache=prefix_cache, **kwargs))
+    for num_shots in sweep:
+        assert_same_predictions(expected[num_shots], [prediction[num_shots] for prediction in actual])
+    # the prompts with more shots run on top of the ones with fewer
+    assert prefix_cache.stats()["extensions"] > 0
+    assert prefix_cache.stats()["prefill_tokens_saved"] > 0
@@ -0,0 +1,47 @@
+import gzip
+import json
+from random import Random
+
+from catwalk.tasks import get_instances
+from catwalk.tasks.perplexity_jsonl import PerplexityJsonLTask, JsonLInstances
+
+
+def write_files(tmp_path):
+    texts = [f"document {i}" for i in range(50)]
+    with gzip.open(tmp_path / "a.jsonl.gz", "wt") as file:
+        for text in texts[:30]:
+            file.write(json.dumps({"text": text}) + "\n")
+    with open(tmp_path / "b.jsonl", "w") as file:
+        for text in texts[30:]:
+            file.write(json.dumps({"text": text}) + "\n\n")
+    return texts
+
+
+def test_jsonl_instances(tmp_path, monkeypatch):
+    monkeypatch.setattr(JsonLInstances, "INDEX_STRIDE", 4)
+    texts = write_files(tmp_path)
+    task = PerplexityJsonLTask(files=[str(tmp_path / "a.jsonl.gz"), str(tmp_path / "b.jsonl")],
+                               index_dir=str(tmp_path / "index"))
+    instances = task.get_split("validation")
+    assert [instance["text"] for instance in instances] == texts
+    assert len(instances) == 50
+    assert instances[33]["text"] == texts[33]
+    assert instances[33]["orig_file_name"].endswith("b.jsonl")
+    assert [instance["text"] for instance in instances[27:35]] == texts[27:35]
+    assert [len(shard) for shard in instances[27:35].shards()] == [3, 5]
+    assert [instance["text"] for instance in instances[::-7]] == texts[::-7]
+
+    # a limit only reads what it needs, and a random subsample is the same as sampling a list
+    assert [instance["text"] for instance in get_instances(task, limit=5)] == texts[:5]
+    sampled = get_instances(task, limit=10, random_subsample_seed=3)
+    assert [instance["text"] for instance in sampled] == Random(3).sample(texts, 10)
+
+    # the index is reused by the next split
+    assert len(list((tmp_path / "index").iterdir())) == 2
+    assert len(task.get_split("validation")) == 50
+
+    # a shard streams through the files instead of reading its instances into memory
+    monkeypatch.setattr(JsonLInstances, "take", None)
+    assert [instance["text"] for instance in instances[3::7]] == texts[3::7]
+    assert [instance["text"] for instance in instances[30:][1::4]] == texts[30:][1::4]
+    assert list(instances[45:][10::2]) == []
@@ -0,0 +1,83 @@
+import time
+
+import pytest
+
+from catwalk.models.result_cache import RequestCache, RequestPool
+
+
+def test_request_cache(tmp_path):
+    cache = RequestCache(str(tmp_path / "cache.sqlite"), max_entries=3)
+    computed = []
+
+    def compute(missing):
+        computed.extend(missing)
+        return [{"sum_logits": -float(i)} for i in missing]
+
+    requests = [["loglikelihood", [1, 2], [3]], ["loglikelihood", [1, 2], [4]]]
+    assert cache.get_or_compute("model", requests, [0, 1], compute) == [{"sum_logits": -0.0}, {"sum_logits": -1.0}]
+    assert computed == [0, 1]
+    assert cache.stats() == {"hits": 0, "misses": 2, "deduplicated": 0}
+
+    # a different model never sees these results
+    assert cache.get_many("other model", requests) == [None, None]
+    assert cache.get_or_compute("model", requests, [0, 1], compute) == [{"sum_logits": -0.0}, {"sum_logits": -1.0}]
+    assert computed == [0, 1]
+    assert cache.stats() == {"hits": 2, "misses": 4, "deduplicated": 0}
+
+    # the results survive reopening the cache
+    cache.close()
+    cache = RequestCache(str(tmp_path / "cache.sqlite"), max_entries=3)
+    assert cache.get_many("model", requests[:1]) == [{"sum_logits": -0.0}]
+
+    # the least recently used result is evicted first
+    time.sleep(0.01)
+    cache.put_many("model", [["a"], ["b"]], [1, 2])
+    assert cache.get_many("model", requests) == [{"sum_logits": -0.0}, None]
+
+
+def test_request_cache_deduplicates():
+    cache = RequestCache(":memory:")
+    computed = []
+
+    def compute(missing):
+        computed.extend(missing)
+        return [{"index": i} for i in missing]
+
+    results = cache.get_or_compute("model", [["a"], ["b"], ["a"], ["a"]], [0, 1, 2, 3], compute)
+    assert computed == [0, 1]
+    assert results == [{"index": 0}, {"index": 1}, {"index": 0}, {"index": 0}]
+    assert results[0] is not results[2]
+    assert cache.stats() == {"hits": 0, "misses": 2, "deduplicated": 2}
+
+
+def test_request_pool():
+    cache = RequestCache(":memory:")
+    cache.pool = RequestPool()
+    computed = []
+
+    def compute(items):
+        computed.append(list(items))
+        return [{"sum_logits": -float(item)} for item in items]
+
+    # while collecting, nothing runs and the missing requests get placeholders
+    cache.pool.task = "first"
+    results = cache.get_or_compute(
+        "model", [["a"], ["b"]], [1, 2], compute, group="ll", sizes=[1, 3], placeholder={"sum_logits": 0.0})
+    assert results == [{"sum_logits": 0.0}, {"sum_logits": 0.0}]
+    cache.pool.task = "second"
+    cache.get_or_compute(
+        "model", [["b"], ["c"]], [2, 3], compute, group="ll", sizes=[3, 4], placeholder={"sum_logits": 0.0})
+    assert computed == []
+    assert len(cache.pool) == 3
+
+    # the requests of both tasks run together, and the time is split by their tokens, with the
+    # shared request charged to the task that asked for it first
+    seconds = cache.run_pool()
+    assert computed == [[1, 2, 3]]
+    assert seconds["first"] == pytest.approx(seconds["second"])
+
+    # afterwards the tasks are answered from the cache
+    cache.pool = None
+    results = cache.get_or_compute("model", [["b"], ["c"]], [2, 3], compute, group="ll")
+    assert results == [{"sum_logits": -2.0}, {"sum_logits": -3.0}]
+    assert computed == [[1, 2, 3]]
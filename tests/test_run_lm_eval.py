@@ -0,0 +1,171 @@
+import json
+
+import pytest
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from catwalk import merge_lm_eval, run_lm_eval
+from catwalk.metrics import AccuracyMetric
+from catwalk.task import InstanceFormat, RankClassificationInstance, Task, rc_metrics
+from catwalk.tasks import TASKS
+
+
+def save_tiny_model(path):
+    from tokenizers import ByteLevelBPETokenizer
+    from transformers import GPT2TokenizerFast
+
+    words = "the a cat dog sat ran on under mat table yes no because".split()
+    g = torch.Generator().manual_seed(0)
+    corpus = [" ".join(words[i] for i in torch.randint(0, len(words), (40,), generator=g)) for _ in range(11)]
+    bpe = ByteLevelBPETokenizer()
+    bpe.train_from_iterator(corpus, vocab_size=300, min_frequency=1, special_tokens=["<|endoftext|>"])
+    tokenizer = GPT2TokenizerFast(
+        tokenizer_object=bpe._tokenizer, eos_token="<|endoftext|>", bos_token="<|endoftext|>",
+        unk_token="<|endoftext|>", model_max_length=32)
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(GPT2Config(
+        n_layer=2, n_embd=32, n_head=2, vocab_size=len(tokenizer), n_positions=64,
+        eos_token_id=tokenizer.eos_token_id, bos_token_id=tokenizer.eos_token_id))
+    model.save_pretrained(path)
+    tokenizer.save_pretrained(path)
+    return corpus
+
+
+def test_sharded_run_merges_to_unsharded_run(tmp_path):
+    corpus = save_tiny_model(tmp_path / "model")
+    with open(tmp_path / "docs.jsonl", "w") as file:
+        for i, text in enumerate(corpus):
+            file.write(json.dumps({"id": f"doc{i}", "text": text}) + "\n")
+    with open(tmp_path / "tasks.jsonl", "w") as file:
+        file.write(json.dumps({"name": "ppl_custom", "task_rename": "ppl_tiny",
+                               "task_options": {"files": [str(tmp_path / "docs.jsonl")]}}) + "\n")
+
+    def run(*args):
+        run_lm_eval.main(run_lm_eval._parser.parse_args([
+            "--model", f"lm::pretrained={tmp_path / 'model'}", "--task_file", str(tmp_path / "tasks.jsonl"),
+            "--batch_size", "1", "--num_recorded_inputs", "1", *args]))
+
+    run("--full_output_file", str(tmp_path / "full.jsonl"))
+    with pytest.raises(ValueError):
+        run("--num_shards", "3", "--shard_index", "0")
+    for shard_index in [2, 0, 1]:
+        run("--full_output_file", str(tmp_path / "out.jsonl"), "--metrics_file", str(tmp_path / "metrics.json"),
+            "--num_shards", "3", "--shard_index", str(shard_index), "--checkpoint_dir", str(tmp_path / "checkpoints"))
+    assert len(list((tmp_path / "checkpoints").iterdir())) == 3
+    shard_files = [str(tmp_path / f"out.shard-{shard_index}-of-3.jsonl") for shard_index in range(3)]
+    assert (tmp_path / "metrics.shard-1-of-3.json").exists()
+    with open(shard_files[1]) as file:
+        shard_output = json.loads(file.readline())
+    assert shard_output["num_instances"] == 4
+    assert "raw_predictions" not in shard_output["shard"]
+    assert shard_output["shard"]["raw_predictions_file"] == "out.predictions.shard-1-of-3.jsonl"
+    with open(tmp_path / shard_output["shard"]["raw_predictions_file"]) as file:
+        assert len(json.loads(file.readline())["raw_predictions"]) == 4
+    assert [res["instance"]["id"] for res in shard_output["per_instance"]] == ["doc1", "doc4", "doc7", "doc10"]
+
+    merge_lm_eval.main(merge_lm_eval._parser.parse_args([
+        *reversed(shard_files), "--full_output_file", str(tmp_path / "merged.jsonl")]))
+    with open(tmp_path / "full.jsonl") as file:
+        expected = json.loads(file.readline())
+    with open(tmp_path / "merged.jsonl") as file:
+        merged = json.loads(file.readline())
+    assert merged["task"] == "ppl_tiny"
+    assert merged["metrics"] == expected["metrics"]
+    assert merged["num_instances"] == expected["num_instances"] == len(corpus)
+    assert merged["task_options"] == expected["task_options"]
+    # each shard records the model input of its own first instance
+    for res in expected["per_instance"] + merged["per_instance"]:
+        res.pop("model_input", None)
+    assert merged["per_instance"] == expected["per_instance"]
+
+
+class ChoicesTask(Task):
+    def __init__(self, texts, metrics):
+        Task.__init__(self)
+        self.texts = texts
+        self.add_instance_conversion(InstanceFormat.RANK_CLASSIFICATION, self.instance_as_rank_classification)
+        self.add_metrics(metrics)
+
+    def has_split(self, split):
+        return True
+
+    def get_split(self, split):
+        return [
+            {"id": f"q{i}", "question": " ".join(text.split()[:8]), "choices": [text.split()[8], "yes", "no"],
+             "label": 0}
+            for i, text in enumerate(self.texts)
+        ]
+
+    def instance_as_rank_classification(self, instance, *, fewshot_instances=None, **kwargs):
+        prefix = "".join(f"{shot['question']} {shot['choices'][shot['label']]}\n" for shot in fewshot_instances or [])
+        return RankClassificationInstance(
+            [(prefix + instance["question"], choice) for choice in instance["choices"]], instance["label"])
+
+
+@pytest.mark.parametrize("model_type", ["lm", "rc"])
+def test_sharded_fewshot_run_merges_to_unsharded_run(tmp_path, monkeypatch, model_type):
+    corpus = save_tiny_model(tmp_path / "model")
+    # run_lm_eval would swap mc_metrics for rc_metrics, which rc:: models do not produce
+    metrics = rc_metrics(primary="acc_raw") if model_type == "lm" else {"acc": AccuracyMetric}
+    monkeypatch.setitem(TASKS, "choices_tiny", ChoicesTask(corpus, metrics))
+
+    def run(*args):
+        # without a fewshot_seed, every instance gets its own few-shot examples
+        run_lm_eval.main(run_lm_eval._parser.parse_args([
+            "--model", f"{model_type}::pretrained={tmp_path / 'model'}", "--task", "choices_tiny", "--num_shots", "2",
+            "--batch_size", "2", *args]))
+
+    run("--full_output_file", str(tmp_path / "full.jsonl"))
+    for shard_index in range(3):
+        run("--full_output_file", str(tmp_path / "out.jsonl"), "--num_shards", "3", "--shard_index", str(shard_index),
+            "--checkpoint_dir", str(tmp_path / "checkpoints"), "--checkpoint_every", "2")
+    merge_lm_eval.main(merge_lm_eval._parser.parse_args([
+        *[str(tmp_path / f"out.shard-{shard_index}-of-3.jsonl") for shard_index in range(3)],
+        "--full_output_file", str(tmp_path / "merged.jsonl")]))
+    with open(tmp_path / "full.jsonl") as file:
+        expected = json.loads(file.readline())
+    with open(tmp_path / "merged.jsonl") as file:
+        merged = json.loads(file.readline())
+    assert merged["metrics"] == expected["metrics"]
+    assert merged["per_instance"] == expected["per_instance"]
+
+    # a checkpointed run, resumed after its first batch, predicts the same
+    checkpoint_dir = tmp_path / "resumed_checkpoints"
+    run("--full_output_file", str(tmp_path / "resumed.jsonl"), "--checkpoint_dir", str(checkpoint_dir),
+        "--checkpoint_every", "4")
+    checkpoint_file, = checkpoint_dir.iterdir()
+    with open(checkpoint_file) as file:
+        lines = file.readlines()
+    with open(checkpoint_file, "w") as file:
+        file.writelines(lines[:5])
+    run("--full_output_file", str(tmp_path / "resumed.jsonl"), "--checkpoint_dir", str(checkpoint_dir),
+        "--checkpoint_every", "4")
+    with open(tmp_path / "resumed.jsonl") as file:
+        resumed = json.loads(file.readline())
+    assert resumed["metrics"] == expected["metrics"]
+    assert resumed["per_instance"] == expected["per_instance"]
+
+
+def test_pooled_run_matches_unpooled_run(tmp_path, monkeypatch):
+    corpus = save_tiny_model(tmp_path / "model")
+    monkeypatch.setitem(TASKS, "choices_tiny", ChoicesTask(corpus, rc_metrics(primary="acc_raw")))
+    monkeypatch.setitem(TASKS, "choices_tiny_2", ChoicesTask(corpus[::-1], rc_metrics(primary="acc_raw")))
+
+    def run(output_file, *args):
+        run_lm_eval.main(run_lm_eval._parser.parse_args([
+            "--model", f"lm::pretrained={tmp_path / 'model'}", "--task", "choices_tiny", "choices_tiny_2",
+            "--batch_size", "2", "--full_output_file", str(output_file), *args]))
+        with open(output_file) as file:
+            return [json.loads(line) for line in file]
+
+    expected = run(tmp_path / "full.jsonl")
+    pooled = run(tmp_path / "pooled.jsonl", "--pool_tasks")
+    for expected_output, pooled_output in zip(expected, pooled):
+        # pooled batches are padded differently, which changes the probabilities by float rounding
+        expected_metrics = expected_output["metrics"]["rc_metrics"]
+        for key, value in pooled_output["metrics"]["rc_metrics"].items():
+            assert value == (pytest.approx(expected_metrics[key]) if isinstance(value, float) else expected_metrics[key])
+        assert "pooled" not in expected_output
+        # the collecting pass is not part of the processing time
+        assert set(pooled_output["pooled"]) == {"collect_seconds", "model_seconds"}
+        assert pooled_output["processing_time_seconds"] >= pooled_output["pooled"]["model_seconds"]
@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+from catwalk.model import Model
+from catwalk.steps_simple import PredictStep
+from catwalk.task import Task
+
+
+class ListTask(Task):
+    def __init__(self, texts):
+        Task.__init__(self)
+        self.texts = texts
+
+    def get_split(self, split):
+        return [{"id": f"q{i}", "text": text} for i, text in enumerate(self.texts)]
+
+
+class CountingModel(Model):
+    def __init__(self, fail_after=None):
+        self.fail_after = fail_after
+        self.predicted = []
+
+    def predict(self, task, instances, **kwargs):
+        for instance in instances:
+            if self.fail_after is not None and len(self.predicted) >= self.fail_after:
+                raise RuntimeError("crashed")
+            self.predicted.append(instance["id"])
+            yield {"text": instance["text"].upper(), "suffix": kwargs.get("suffix")}
+
+
+def test_predict_checkpoint(tmp_path):
+    task = ListTask([f"text {i}" for i in range(10)])
+    checkpoint_file = str(tmp_path / "checkpoints" / "task.jsonl")
+    expected = list(CountingModel().predict(task, task.get_split("validation"), suffix="!"))
+
+    model = CountingModel(fail_after=7)
+    with pytest.raises(RuntimeError):
+        PredictStep().run(model, task, checkpoint_file=checkpoint_file, checkpoint_every=3, suffix="!")
+    # the last batch written was the one ending at the sixth instance
+    with open(checkpoint_file, 'a') as file:
+        file.write('{"index": 6, "id": {"id": "q6"}, "predic')  # and a write that was cut off
+
+    model = CountingModel()
+    results = PredictStep().run(model, task, checkpoint_file=checkpoint_file, checkpoint_every=3, suffix="!",
+                                batch_size=2)
+    assert results == expected
+    assert model.predicted == ["q6", "q7", "q8", "q9"]
+    with open(checkpoint_file) as file:
+        assert [json.loads(line)["index"] for line in file.readlines()[1:]] == list(range(10))
+
+    # the same options predict nothing, other options start over
+    model = CountingModel()
+    assert PredictStep().run(model, task, checkpoint_file=checkpoint_file, suffix="!") == expected
+    assert model.predicted == []
+    results = PredictStep().run(model, task, checkpoint_file=checkpoint_file, suffix="?")
+    assert len(model.predicted) == 10
+    assert results[0]["suffix"] == "?"
+
+
+def test_predict_refuses_to_shard_positionally_seeded_fewshot():
+    task = ListTask([f"text {i}" for i in range(10)])
+    # CountingModel does not take instance_indices, so its shards would draw other few-shot examples
+    with pytest.raises(ValueError):
+        PredictStep().run(CountingModel(), task, num_shards=2, shard_index=1, num_shots=1)
+    assert len(PredictStep().run(CountingModel(), task, num_shards=2, shard_index=1, num_shots=1,
+                                 fewshot_seed=5)) == 5